@@ -78,7 +78,7 @@ if 'NZBPO_PATH_MAPPING' in os.environ:
 sys.path.insert(0, MP4folder)
 try:
     from resources.readsettings import ReadSettings
-    from resources.mediaprocessor import MediaProcessor
+    from resources.daemon import getMediaProcessor
     from resources.log import getLogger
     from autoprocess import autoProcessTV, autoProcessTVSR, sonarr, radarr
 except ImportError:
@@ -193,7 +193,7 @@ if 'NZBOP_SCRIPTDIR' in os.environ and not os.environ['NZBOP_VERSION'][0:5] < '1
     if shouldConvert:
         if output_dir:
             settings.output_dir = output_dir
-        mp = MediaProcessor(settings, logger=log)
+        mp = getMediaProcessor(settings, logger=log)
         ignore = []
         for r, d, f in os.walk(path):
             for files in f:
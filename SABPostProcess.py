@@ -5,7 +5,7 @@ import sys
 from autoprocess import autoProcessTV, autoProcessTVSR, sonarr, radarr
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
 
 log = getLogger("SABPostProcess")
 
@@ -57,7 +57,7 @@ try:
             settings.output_dir = settings.SAB['output-dir']
             log.debug("Overriding output_dir to %s." % settings.SAB['output-dir'])
 
-        mp = MediaProcessor(settings)
+        mp = getMediaProcessor(settings)
         ignore = []
         for r, d, f in os.walk(path):
             for files in f:
@@ -1,10 +1,14 @@
 #!/usr/bin/env python3
 
 import os
+import copy
+import threading
+from collections import OrderedDict
 
 from converter.avcodecs import video_codec_list, audio_codec_list, subtitle_codec_list, attachment_codec_list, decoder_list, BaseDecoder
 from converter.formats import format_list
 from converter.ffmpeg import FFMpeg, FFMpegError, FFMpegConvertError
+from converter.cache import ProbeCache
 
 
 class ConverterError(Exception):
@@ -17,19 +21,23 @@ class Converter(object):
 
     >>> c = Converter()
     """
+    PROBE_MEMO_SIZE = 32
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None):
         """
         Initialize a new Converter object.
         """
 
         self.ffmpeg = FFMpeg(ffmpeg_path=ffmpeg_path,
-                             ffprobe_path=ffprobe_path)
+                             ffprobe_path=ffprobe_path,
+                             cache=cache)
         self.video_codecs = {}
         self.audio_codecs = {}
         self.subtitle_codecs = {}
         self.attachment_codecs = {}
         self.formats = {}
+        self._probes = OrderedDict()
+        self._probes_lock = threading.Lock()
 
         for cls in audio_codec_list:
             name = cls.codec_name
@@ -215,17 +223,36 @@ class Converter(object):
         """
         Tag media file (infile) with metadata dictionary and optional cover art
         """
+        outfile, infile = self._tag_paths(infile)
+
+        info = self.probe(outfile)
+        os.rename(outfile, infile)
+        opts = self._tag_options(infile, info, metadata, coverpath, cues_to_front)
+
+        duration = info.format.duration or 0.01
+        for timecode, debug in self.ffmpeg.convert(outfile, opts, timeout=0):
+            yield int((100.0 * timecode) / duration), debug
+        self.invalidate(outfile)
+        os.remove(infile)
+
+    @staticmethod
+    def _tag_paths(infile):
+        """
+        Return the path being tagged and a free temporary path the original
+        is moved to while the tagged copy is written.
+        """
         outfile = infile
         infile = infile + ".tag"
         i = 2
         while os.path.isfile(infile):
             infile = infile + "." + str(i)
             i += 1
+        return outfile, infile
 
-        os.rename(outfile, infile)
+    @staticmethod
+    def _tag_options(infile, info, metadata={}, coverpath=None, cues_to_front=False):
         opts = ['-i', infile, '-map', '0:v?', '-c:v', 'copy', '-map', '0:a?', '-c:a', 'copy', '-map', '0:s?', '-c:s', 'copy', '-map', '0:t?', '-c:t', 'copy']
 
-        info = self.ffmpeg.probe(infile)
         i = len(info.attachment)
 
         if coverpath:
@@ -240,12 +267,9 @@ class Converter(object):
 
         if cues_to_front:
             opts.extend(['-cues_to_front', "true"])
+        return opts
 
-        for timecode, debug in self.ffmpeg.convert(outfile, opts, timeout=0):
-            yield int((100.0 * timecode) / info.format.duration), debug
-        os.remove(infile)
-
-    def convert(self, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, strip_metadata=False, fix_sub_duration=True):
+    def convert(self, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, strip_metadata=False, fix_sub_duration=True, info=None):
         """
         Convert media file (infile) according to specified options, and
         save it to outfile. For two-pass encoding, specify the pass (1 or 2)
@@ -273,10 +297,11 @@ class Converter(object):
         doesn't limit the total conversion time, just the amount of time
         Converter will wait for each update from ffmpeg. As it's usually
         less than a second, the default of 10 is a reasonable default. To
-        disable the timeout, set it to None. You may need to do this if
-        using Converter in a threading environment, since the way the
-        timeout is handled (using signals) has special restriction when
-        using threads.
+        disable the timeout, set it to None. The timeout doesn't rely on
+        signals so it also applies when converting from worker threads.
+
+        The optional info argument takes a MediaInfo object already probed
+        from the source to avoid examining the same file again.
 
         >>> conv = Converter().convert('test1.ogg', '/tmp/output.mkv', {
         ...    'format': 'mkv',
@@ -288,15 +313,86 @@ class Converter(object):
         ...   pass # can be used to inform the user about the progress
         """
 
+        infile = self._convert_source(options)
+
+        info = info or self.probe(infile)
+
+        duration, passes = self._convert_passes(options, info, twopass, strip_metadata, fix_sub_duration)
+        for optlist, start, share in passes:
+            for timecode, debug in self.ffmpeg.convert(outfile,
+                                                       optlist,
+                                                       timeout=timeout,
+                                                       preopts=preopts,
+                                                       postopts=postopts):
+                yield int(start + (share * timecode) / duration), debug
+
+        if outfile:
+            self.invalidate(outfile)
+
+    def convert_multiple(self, outputs, timeout=10, preopts=None, info=None):
+        """
+        Convert one source into several output files with a single ffmpeg
+        process so the source is only read once. Outputs is a list of
+        (outfile, options) tuples with options as described in convert(),
+        all using the same single source. Two pass encoding is not
+        supported.
+
+        Returns a generator yielding the same progress events as convert().
+        """
+        if not outputs:
+            return
+
+        infile = self._convert_source(outputs[0][1])
+
+        info = info or self.probe(infile)
+
+        duration, optlist = self._convert_multiple_options(outputs, info)
+        for timecode, debug in self.ffmpeg.convert(outputs[-1][0],
+                                                   optlist,
+                                                   timeout=timeout,
+                                                   preopts=preopts):
+            yield int((100.0 * timecode) / duration), debug
+
+        for outfile, _ in outputs:
+            self.invalidate(outfile)
+
+    def _convert_multiple_options(self, outputs, info):
+        """
+        Return the source duration and a single option list writing every
+        output. The last outfile is left off to be added by FFMpeg.
+        """
+        source = None
+        optlist = []
+        for i, (outfile, options) in enumerate(outputs):
+            duration, passes = self._convert_passes(options, info, fix_sub_duration=False)
+            opts = passes[0][0]
+            prefix = opts[:opts.index('-i') + 2]
+            if source is None:
+                source = prefix
+                optlist.extend(source)
+            elif prefix != source:
+                raise ConverterError('All outputs must use the same source')
+            optlist.extend(opts[len(prefix):])
+            if i < len(outputs) - 1:
+                optlist.append(outfile)
+        return duration, optlist
+
+    @staticmethod
+    def _convert_source(options):
         if not isinstance(options, dict):
             raise ConverterError('Invalid options')
 
         if 'source' not in options:
             raise ConverterError('No source specified')
 
-        infile = options['source'][0]
+        return options['source'][0]
 
-        info = self.ffmpeg.probe(infile)
+    def _convert_passes(self, options, info, twopass=False, strip_metadata=False, fix_sub_duration=True):
+        """
+        Validate the source info and return the source duration along with
+        a list of (optlist, start, share) tuples, one per ffmpeg pass, where
+        start and share place the progress of the pass in the 0-100 range.
+        """
         if info is None:
             raise ConverterError("Can't get information about source file")
 
@@ -309,46 +405,75 @@ class Converter(object):
             v['src_width'] = info.video.video_width
             v['src_height'] = info.video.video_height
 
-        if not info.format.duration:
-            info.format.duration = 0.01
+        duration = info.format.duration or 0.01
 
-        if info.video and info.format.duration < 0.01:
+        if info.video and duration < 0.01:
             raise ConverterError('Zero-length media')
 
         if twopass:
-            optlist1 = self.parse_options(options, 1, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration)
-            for timecode, debug in self.ffmpeg.convert(outfile,
-                                                       optlist1,
-                                                       timeout=timeout,
-                                                       preopts=preopts,
-                                                       postopts=postopts):
-                yield int((50.0 * timecode) / info.format.duration), debug
+            return duration, [(self.parse_options(options, 1, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration), 0.0, 50.0),
+                              (self.parse_options(options, 2, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration), 50.0, 50.0)]
+        return duration, [(self.parse_options(options, twopass, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration), 0.0, 100.0)]
 
-            optlist2 = self.parse_options(options, 2, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration)
-            for timecode, debug in self.ffmpeg.convert(outfile,
-                                                       optlist2,
-                                                       timeout=timeout,
-                                                       preopts=preopts,
-                                                       postopts=postopts):
-                yield int(50.0 + (50.0 * timecode) / info.format.duration), debug
-        else:
-            optlist = self.parse_options(options, twopass, strip_metadata=strip_metadata, fix_sub_duration=fix_sub_duration)
-            for timecode, debug in self.ffmpeg.convert(outfile,
-                                                       optlist,
-                                                       timeout=timeout,
-                                                       preopts=preopts,
-                                                       postopts=postopts):
-                yield int((100.0 * timecode) / info.format.duration), debug
+    @staticmethod
+    def _signature(fname):
+        try:
+            st = os.stat(fname)
+            return (st.st_size, st.st_mtime_ns, st.st_ino)
+        except OSError:
+            return None
 
     def probe(self, fname, posters_as_video=True):
         """
         Examine the media file. See the documentation of
         converter.FFMpeg.probe() for details.
 
+        Results are remembered for the lifetime of the Converter as long
+        as the size, modification time and inode of the file are unchanged.
+
         :param posters_as_video: Take poster images (mainly for audio files) as
             A video stream, defaults to True
         """
-        return self.ffmpeg.probe(fname, posters_as_video)
+        key, signature, info = self._probe_memo(fname, posters_as_video)
+        if info:
+            return info
+
+        info = self.ffmpeg.probe(fname, posters_as_video)
+        self._probe_remember(key, signature, info)
+        return info
+
+    def _probe_memo(self, fname, posters_as_video):
+        """
+        Return the memo key, current signature and a copy of the remembered
+        MediaInfo for a file, or None in its place if there isn't a valid one.
+        """
+        key = (os.path.abspath(fname), posters_as_video)
+        signature = self._signature(fname)
+
+        with self._probes_lock:
+            entry = self._probes.get(key)
+            if entry and signature and entry[0] == signature:
+                self._probes.move_to_end(key)
+                return key, signature, copy.deepcopy(entry[1])
+        return key, signature, None
+
+    def _probe_remember(self, key, signature, info):
+        if info and signature:
+            with self._probes_lock:
+                self._probes[key] = (signature, copy.deepcopy(info))
+                while len(self._probes) > self.PROBE_MEMO_SIZE:
+                    self._probes.popitem(last=False)
+
+    def invalidate(self, fname):
+        """
+        Forget any probe results for a file that has been rewritten.
+        """
+        path = os.path.abspath(fname)
+        with self._probes_lock:
+            for key in [k for k in self._probes if k[0] == path]:
+                del self._probes[key]
+        if self.ffmpeg.cache:
+            self.ffmpeg.cache.invalidate(fname)
 
     def framedata(self, fname):
         """
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import time
+import asyncio
+from collections import deque
+from asyncio.subprocess import PIPE, DEVNULL
+
+from converter import Converter
+from converter.ffmpeg import FFMpeg, FFMpegError, console_encoding
+
+
+class AsyncFFMpeg(object):
+    """
+    asyncio counterpart of FFMpeg. Probes, thumbnails and conversions run
+    as asyncio subprocesses so many of them can be driven concurrently
+    from a single event loop. Command building, output parsing, the probe
+    cache and capability lookups are shared with the wrapped FFMpeg object,
+    whose synchronous methods remain available as attributes.
+
+    >>> f = AsyncFFMpeg()
+    >>> info = await f.probe('test1.ogg')
+    >>> async for timecode, debug in f.convert('/tmp/output.mp3', ['-i', 'test1.ogg', '-vn']):
+    ...    pass
+    """
+
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None, ffmpeg=None):
+        self.ffmpeg = ffmpeg or FFMpeg(ffmpeg_path=ffmpeg_path, ffprobe_path=ffprobe_path, cache=cache)
+
+    def __getattr__(self, name):
+        return getattr(self.ffmpeg, name)
+
+    @staticmethod
+    async def _spawn(cmds):
+        try:
+            cmds = [str(cmd) for cmd in cmds]
+        except KeyboardInterrupt:
+            raise
+        except:
+            raise FFMpegError("There was an error making all command line parameters a string")
+        return await asyncio.create_subprocess_exec(*cmds, stdin=DEVNULL, stdout=PIPE, stderr=PIPE)
+
+    async def _get_stdout(self, cmds):
+        """
+        Return the decoded stdout output for the command.
+        """
+        p = await self._spawn(cmds)
+        stdout_data, _ = await p.communicate()
+        return stdout_data.decode(console_encoding, errors='ignore')
+
+    async def framedata(self, fname):
+        try:
+            stdout_data = await self._get_stdout(self.ffmpeg._framedata_command(fname))
+            return json.loads(stdout_data)['frames'][0]
+        except KeyboardInterrupt:
+            raise
+        except:
+            raise FFMpegError("Unable to obtain FFMPEG framedata")
+
+    async def probe(self, fname, posters_as_video=True):
+        """
+        Examine the media file. See the documentation of FFMpeg.probe() for
+        details.
+        """
+        if not os.path.exists(fname):
+            return None
+
+        signature, cached = self.ffmpeg._probe_cached(fname)
+
+        if cached:
+            stdout_data, framedata = cached
+        else:
+            stdout_data = await self._get_stdout(self.ffmpeg._probe_command(fname))
+            framedata = None
+
+        info, framedata = self.ffmpeg._probe_parse(fname, posters_as_video, stdout_data, framedata)
+
+        if not cached:
+            if info and info.video and not framedata:
+                try:
+                    framedata = await self.framedata(fname)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    pass
+            if signature:
+                self.ffmpeg.cache.put(signature, stdout_data, framedata if info else None)
+
+        return self.ffmpeg._probe_result(info, framedata)
+
+    async def convert(self, outfile, opts, timeout=10, preopts=None, postopts=None):
+        """
+        Convert the source media according to the specified options. An
+        asynchronous generator yielding the same (timecode, debug) events as
+        FFMpeg.convert(), starting with (0, cmds).
+
+        The optional timeout is the number of seconds to wait for any output
+        from ffmpeg before giving up.
+        """
+        infile, cmds = self.ffmpeg._convert_commands(outfile, opts, preopts, postopts)
+
+        yield 0, cmds
+
+        try:
+            p = await self._spawn(self.ffmpeg._progress_commands(cmds))
+        except OSError:
+            raise FFMpegError('Error while calling ffmpeg binary')
+
+        tail = deque(maxlen=FFMpeg.STDERR_TAIL)
+        activity = [time.monotonic()]
+        reader = asyncio.ensure_future(self._drain(p.stderr, tail, activity))
+
+        yielded = False
+        block = {}
+        try:
+            while True:
+                line = await self._readline(p, reader, activity, timeout)
+                if not line:
+                    break
+                event = self.ffmpeg._progress_event(block, FFMpeg._decode(line).strip())
+                if event:
+                    yielded = True
+                    yield event
+
+            if not yielded:
+                yield 10, ""
+        except BaseException:
+            if p.returncode is None:
+                p.kill()
+            raise
+        finally:
+            await p.wait()
+            await reader
+
+        FFMpeg._check_convert(cmds, infile, tail, p.returncode, p.pid)
+
+    @staticmethod
+    async def _drain(stream, tail, activity):
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            tail.append(FFMpeg._decode(line).rstrip())
+            activity[0] = time.monotonic()
+
+    @staticmethod
+    async def _readline(p, reader, activity, timeout):
+        # Output on stderr also counts as activity so long running analysis before the first progress block isn't a timeout
+        if not timeout:
+            return await p.stdout.readline()
+        pending = asyncio.ensure_future(p.stdout.readline())
+        while True:
+            done, _ = await asyncio.wait([pending], timeout=max(0, timeout - (time.monotonic() - activity[0])))
+            if done:
+                activity[0] = time.monotonic()
+                return pending.result()
+            if time.monotonic() - activity[0] >= timeout or reader.done():
+                pending.cancel()
+                raise Exception('timed out while waiting for ffmpeg')
+
+    async def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
+        """
+        Create a thumbnail of the media file. See the documentation of
+        FFMpeg.thumbnail() for details.
+        """
+        return await self.thumbnails(fname, [(time, outfile, size, quality)])
+
+    async def thumbnails(self, fname, option_list):
+        """
+        Create one or more thumbnails of video. See the documentation of
+        FFMpeg.thumbnails() for details.
+        """
+        p = await self._spawn(self.ffmpeg._thumbnails_command(fname, option_list))
+        _, stderr_data = await p.communicate()
+        # ffmpeg may succeed without writing anything to stderr, the return code and the thumbnails decide
+        if p.returncode != 0 or any(not os.path.exists(option[1]) for option in option_list):
+            raise FFMpegError('Error creating thumbnail: %s' % stderr_data.decode(console_encoding, errors='ignore'))
+
+
+class AsyncConverter(object):
+    """
+    asyncio counterpart of Converter built on AsyncFFMpeg. Option parsing,
+    codecs, formats and the probe memo are shared with the wrapped
+    Converter, whose synchronous methods remain available as attributes.
+
+    >>> c = AsyncConverter()
+    >>> async for timecode, debug in c.convert('/tmp/output.mkv', options):
+    ...    pass
+    """
+
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None, converter=None):
+        self.converter = converter or Converter(ffmpeg_path=ffmpeg_path, ffprobe_path=ffprobe_path, cache=cache)
+        self.ffmpeg = AsyncFFMpeg(ffmpeg=self.converter.ffmpeg)
+
+    def __getattr__(self, name):
+        return getattr(self.converter, name)
+
+    async def probe(self, fname, posters_as_video=True):
+        """
+        Examine the media file. See the documentation of Converter.probe()
+        for details.
+        """
+        key, signature, info = self.converter._probe_memo(fname, posters_as_video)
+        if info:
+            return info
+
+        info = await self.ffmpeg.probe(fname, posters_as_video)
+        self.converter._probe_remember(key, signature, info)
+        return info
+
+    async def framedata(self, fname):
+        try:
+            return await self.ffmpeg.framedata(fname)
+        except FFMpegError:
+            return None
+
+    async def convert(self, outfile, options, twopass=False, timeout=10, preopts=None, postopts=None, strip_metadata=False, fix_sub_duration=True, info=None):
+        """
+        Convert media file according to the specified options. See the
+        documentation of Converter.convert() for details, the progress
+        events are the same but are yielded by an asynchronous generator.
+        """
+        infile = self.converter._convert_source(options)
+
+        info = info or await self.probe(infile)
+
+        duration, passes = self.converter._convert_passes(options, info, twopass, strip_metadata, fix_sub_duration)
+        for optlist, start, share in passes:
+            async for timecode, debug in self.ffmpeg.convert(outfile, optlist, timeout=timeout, preopts=preopts, postopts=postopts):
+                yield int(start + (share * timecode) / duration), debug
+
+        if outfile:
+            self.converter.invalidate(outfile)
+
+    async def convert_multiple(self, outputs, timeout=10, preopts=None, info=None):
+        """
+        Convert one source into several output files with a single ffmpeg
+        process. See the documentation of Converter.convert_multiple() for
+        details.
+        """
+        if not outputs:
+            return
+
+        infile = self.converter._convert_source(outputs[0][1])
+
+        info = info or await self.probe(infile)
+
+        duration, optlist = self.converter._convert_multiple_options(outputs, info)
+        async for timecode, debug in self.ffmpeg.convert(outputs[-1][0], optlist, timeout=timeout, preopts=preopts):
+            yield int((100.0 * timecode) / duration), debug
+
+        for outfile, _ in outputs:
+            self.converter.invalidate(outfile)
+
+    async def tag(self, infile, metadata={}, coverpath=None, cues_to_front=False):
+        """
+        Tag media file with metadata dictionary and optional cover art. See
+        the documentation of Converter.tag() for details.
+        """
+        outfile, infile = self.converter._tag_paths(infile)
+
+        info = await self.probe(outfile)
+        os.rename(outfile, infile)
+        opts = self.converter._tag_options(infile, info, metadata, coverpath, cues_to_front)
+
+        duration = info.format.duration or 0.01
+        async for timecode, debug in self.ffmpeg.convert(outfile, opts, timeout=0):
+            yield int((100.0 * timecode) / duration), debug
+        self.converter.invalidate(outfile)
+        os.remove(infile)
+
+    async def thumbnail(self, fname, time, outfile, size=None, quality=FFMpeg.DEFAULT_JPEG_QUALITY):
+        return await self.ffmpeg.thumbnail(fname, time, outfile, size, quality)
+
+    async def thumbnails(self, fname, option_list):
+        return await self.ffmpeg.thumbnails(fname, option_list)
@@ -52,6 +52,8 @@ class BaseCodec(object):
     ffmpeg_codec_name = None
     ffprobe_codec_name = None
     max_depth = 9999
+    # Encodes on a GPU or other hardware device rather than the CPU
+    hardware = False
 
     def supportsBitDepth(self, depth):
         return depth <= self.max_depth
@@ -1116,6 +1118,7 @@ class NVEncH264Codec(H264Codec):
     """
     codec_name = 'h264_nvenc'
     ffmpeg_codec_name = 'h264_nvenc'
+    hardware = True
     scale_filter = 'scale_npp'
     max_depth = 8
     encoder_options = H264Codec.encoder_options.copy()
@@ -1182,6 +1185,7 @@ class VideotoolboxEncH264(H264Codec):
     """
     codec_name = 'h264_videotoolbox'
     ffmpeg_codec_name = 'h264_videotoolbox'
+    hardware = True
 
 
 class OMXH264Codec(H264Codec):
@@ -1190,6 +1194,7 @@ class OMXH264Codec(H264Codec):
     """
     codec_name = 'h264_omx'
     ffmpeg_codec_name = 'h264_omx'
+    hardware = True
 
 
 class H264VAAPICodec(H264Codec):
@@ -1198,6 +1203,7 @@ class H264VAAPICodec(H264Codec):
     """
     codec_name = 'h264vaapi'
     ffmpeg_codec_name = 'h264_vaapi'
+    hardware = True
     scale_filter = 'scale_vaapi'
     default_fmt = 'nv12'
     encoder_options = H264Codec.encoder_options.copy()
@@ -1267,6 +1273,7 @@ class H264QSVCodec(H264Codec):
     """
     codec_name = 'h264qsv'
     ffmpeg_codec_name = 'h264_qsv'
+    hardware = True
     scale_filter = 'scale_qsv'
 
     def _codec_specific_parse_options(self, safe, stream=0):
@@ -1333,6 +1340,7 @@ class H264V4l2m2mCodec(H264Codec):
     """
     codec_name = 'h264_v4l2m2m'
     ffmpeg_codec_name = 'h264_v4l2m2m'
+    hardware = True
 
     def _codec_specific_parse_options(self, safe, stream=0):
         safe['pix_fmt'] = "yuv420p"
@@ -1464,6 +1472,7 @@ class H265QSVCodec(H265Codec):
     """
     codec_name = 'h265qsv'
     ffmpeg_codec_name = 'hevc_qsv'
+    hardware = True
     scale_filter = 'scale_qsv'
 
     def _codec_specific_parse_options(self, safe, stream=0):
@@ -1582,6 +1591,7 @@ class H265VAAPICodec(H265Codec):
     """
     codec_name = 'h265vaapi'
     ffmpeg_codec_name = 'hevc_vaapi'
+    hardware = True
     scale_filter = 'scale_vaapi'
     default_fmt = 'nv12'
     encoder_options = H265Codec.encoder_options.copy()
@@ -1658,6 +1668,7 @@ class H265V4l2m2mCodec(H265Codec):
     """
     codec_name = 'hevc_v4l2m2m'
     ffmpeg_codec_name = 'hevc_v4l2m2m'
+    hardware = True
 
 
 class H265V4l2m2mDecoder(BaseDecoder):
@@ -1671,6 +1682,7 @@ class NVEncH265Codec(H265Codec):
     """
     codec_name = 'h265_nvenc'
     ffmpeg_codec_name = 'hevc_nvenc'
+    hardware = True
     scale_filter = 'scale_npp'
     default_fmt = 'nv12'
     max_depth = 10
@@ -1836,6 +1848,7 @@ class VideotoolboxEncH265(H265Codec):
     """
     codec_name = 'h265_videotoolbox'
     ffmpeg_codec_name = 'hevc_videotoolbox'
+    hardware = True
 
 
 class DivxCodec(VideoCodec):
@@ -1968,6 +1981,7 @@ class AV1QSVCodec(AV1Codec):
     """
     codec_name = 'av1qsv'
     ffmpeg_codec_name = 'av1_qsv'
+    hardware = True
 
 class AV1VAAPICodec(AV1Codec):
     """
@@ -1975,6 +1989,7 @@ class AV1VAAPICodec(AV1Codec):
     """
     codec_name = 'av1vaapi'
     ffmpeg_codec_name = 'av1_vaapi'
+    hardware = True
 
 class NVEncAV1Codec(AV1Codec):
     """
@@ -1982,6 +1997,7 @@ class NVEncAV1Codec(AV1Codec):
     """
     codec_name = 'av1nvenc'
     ffmpeg_codec_name = 'av1_nvenc'
+    hardware = True
 
 class Vp9QSVCodec(Vp9Codec):
     """
@@ -1989,6 +2005,7 @@ class Vp9QSVCodec(Vp9Codec):
     """
     codec_name = 'vp9qsv'
     ffmpeg_codec_name = 'vp9_qsv'
+    hardware = True
 
 
 class Vp9QSVAltCodec(Vp9QSVCodec):
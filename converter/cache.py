@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+import threading
+import time
+import json
+import logging
+
+
+class ProbeCache(object):
+    """
+    Persistent ffprobe result and ffmpeg capability cache backed by SQLite.
+
+    Entries are keyed by the real path of the probed file and are only
+    considered valid while the size, modification time and inode of the
+    file still match, so any rewrite of the file invalidates the result.
+    The least recently used entries are evicted once the cache grows past
+    max_entries.
+
+    Capabilities of the ffmpeg build (codecs, encoders, pixel formats...)
+    are stored per binary and validated the same way against the binary
+    itself.
+
+    >>> cache = ProbeCache('/tmp/sma-cache')
+    >>> c = Converter(cache=cache)
+    """
+    SCHEMA_VERSION = 3
+    DEFAULT_FILENAME = 'probe.db'
+    PRUNE_INTERVAL = 100
+
+    def __init__(self, path, max_entries=50000, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+
+        if os.path.isdir(path):
+            path = os.path.join(path, self.DEFAULT_FILENAME)
+
+        self.path = path
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._writes = 0
+
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._setup()
+
+    def _setup(self):
+        version = self._conn.execute('PRAGMA user_version').fetchone()[0]
+        if version != self.SCHEMA_VERSION:
+            # Stored probe output format changed, cached results are no longer usable
+            self._conn.execute('DROP TABLE IF EXISTS probe')
+            self._conn.execute('DROP TABLE IF EXISTS capability')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS probe (
+                              path TEXT PRIMARY KEY,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              inode INTEGER NOT NULL,
+                              output TEXT,
+                              framedata TEXT,
+                              last_access REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS probe_last_access ON probe (last_access)')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS capability (
+                              path TEXT NOT NULL,
+                              name TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              inode INTEGER NOT NULL,
+                              value TEXT,
+                              PRIMARY KEY (path, name))''')
+        self._conn.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
+    @staticmethod
+    def signature(fname):
+        """
+        Return the (realpath, size, mtime_ns, inode) key for a file, or None
+        if the file cannot be stat'ed.
+        """
+        try:
+            path = os.path.realpath(fname)
+            st = os.stat(path)
+            return (path, st.st_size, st.st_mtime_ns, st.st_ino)
+        except OSError:
+            return None
+
+    def get(self, signature):
+        """
+        Return the cached (output, framedata) tuple for a signature, or None
+        if there is no valid entry.
+        """
+        if not signature:
+            return None
+        path, size, mtime_ns, inode = signature
+        try:
+            with self._lock:
+                row = self._conn.execute('SELECT size, mtime_ns, inode, output, framedata FROM probe WHERE path = ?', (path,)).fetchone()
+                if not row:
+                    return None
+                if row[0] != size or row[1] != mtime_ns or row[2] != inode:
+                    self._conn.execute('DELETE FROM probe WHERE path = ?', (path,))
+                    return None
+                self._conn.execute('UPDATE probe SET last_access = ? WHERE path = ?', (time.time(), path))
+            return row[3], json.loads(row[4]) if row[4] else None
+        except (sqlite3.Error, ValueError):
+            self.log.debug("Unable to read probe cache entry for %s." % path)
+            return None
+
+    def put(self, signature, output, framedata=None):
+        """
+        Store the raw ffprobe output and framedata for a signature.
+        """
+        if not signature:
+            return
+        path, size, mtime_ns, inode = signature
+        try:
+            with self._lock:
+                self._conn.execute('INSERT OR REPLACE INTO probe (path, size, mtime_ns, inode, output, framedata, last_access) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                   (path, size, mtime_ns, inode, output, json.dumps(framedata) if framedata is not None else None, time.time()))
+                self._writes += 1
+                if self._writes % self.PRUNE_INTERVAL == 1:
+                    self._prune()
+        except (sqlite3.Error, TypeError, ValueError):
+            self.log.debug("Unable to write probe cache entry for %s." % path)
+
+    def get_capability(self, signature, name):
+        """
+        Return a cached capability value for an ffmpeg binary signature, or
+        None if the binary changed since it was stored.
+        """
+        if not signature:
+            return None
+        path, size, mtime_ns, inode = signature
+        try:
+            with self._lock:
+                row = self._conn.execute('SELECT size, mtime_ns, inode, value FROM capability WHERE path = ? AND name = ?', (path, name)).fetchone()
+            if not row or row[0] != size or row[1] != mtime_ns or row[2] != inode:
+                return None
+            return json.loads(row[3])
+        except (sqlite3.Error, ValueError):
+            self.log.debug("Unable to read capability %s for %s." % (name, path))
+            return None
+
+    def put_capability(self, signature, name, value):
+        """
+        Store a capability value for an ffmpeg binary signature.
+        """
+        if not signature:
+            return
+        path, size, mtime_ns, inode = signature
+        try:
+            with self._lock:
+                self._conn.execute('INSERT OR REPLACE INTO capability (path, name, size, mtime_ns, inode, value) VALUES (?, ?, ?, ?, ?, ?)',
+                                   (path, name, size, mtime_ns, inode, json.dumps(value)))
+        except (sqlite3.Error, TypeError, ValueError):
+            self.log.debug("Unable to write capability %s for %s." % (name, path))
+
+    def invalidate(self, fname):
+        """
+        Drop any cached entry for a file.
+        """
+        try:
+            with self._lock:
+                self._conn.execute('DELETE FROM probe WHERE path = ?', (os.path.realpath(fname),))
+        except sqlite3.Error:
+            pass
+
+    def _prune(self):
+        if self.max_entries and self.max_entries > 0:
+            self._conn.execute('DELETE FROM probe WHERE path IN (SELECT path FROM probe ORDER BY last_access DESC LIMIT -1 OFFSET ?)', (self.max_entries,))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -4,7 +4,10 @@ from multiprocessing.sharedctypes import Value
 import os.path
 import os
 import re
-import signal
+import time
+import threading
+import selectors
+from collections import deque
 from subprocess import Popen, PIPE
 import logging
 import locale
@@ -96,6 +99,17 @@ class MediaFormatInfo(object):
             value = val.lower().strip()
             self.metadata[key] = value
 
+    def parse_json(self, data):
+        """
+        Parse the format section of ffprobe JSON output.
+        """
+        for key, val in data.items():
+            if key == 'tags' and isinstance(val, dict):
+                for k, v in val.items():
+                    self.parse_ffprobe('TAG:' + k, str(v))
+            elif not isinstance(val, (dict, list)):
+                self.parse_ffprobe(key, str(val))
+
     def __repr__(self):
         if self.duration is None:
             return 'MediaFormatInfo(format=%s)' % self.format
@@ -307,6 +321,26 @@ class MediaStreamInfo(object):
             elif key == "color_primaries":
                 self.color['primaries'] = val.lower()
 
+    def parse_json(self, data):
+        """
+        Parse a single stream from ffprobe JSON output.
+        """
+        # Stream type and codec drive how the remaining keys are parsed so handle them first
+        for key in ['index', 'codec_type', 'codec_name']:
+            if key in data:
+                self.parse_ffprobe(key, str(data[key]))
+        for key, val in data.items():
+            if key in ['index', 'codec_type', 'codec_name']:
+                continue
+            elif key == 'tags' and isinstance(val, dict):
+                for k, v in val.items():
+                    self.parse_ffprobe('TAG:' + k, str(v))
+            elif key == 'disposition' and isinstance(val, dict):
+                for k, v in val.items():
+                    self.parse_ffprobe('DISPOSITION:' + k, str(v))
+            elif not isinstance(val, (dict, list)):
+                self.parse_ffprobe(key, str(val))
+
     def __repr__(self):
         d = ''
         metadata_str = ['%s=%s' % (key, value) for key, value
@@ -391,6 +425,17 @@ class MediaInfo(object):
                 elif in_format:
                     self.format.parse_ffprobe(k, v)
 
+    def parse_ffprobe_json(self, data):
+        """
+        Parse ffprobe JSON output (already decoded).
+        """
+        self.format.parse_json(data.get('format', {}))
+        for s in data.get('streams', []):
+            stream = MediaStreamInfo()
+            stream.parse_json(s)
+            if stream.type:
+                self.streams.append(stream)
+
     def __repr__(self):
         return 'MediaInfo(format=%s, streams=%s)' % (repr(self.format),
                                                      repr(self.streams))
@@ -460,11 +505,16 @@ class FFMpeg(object):
     DECODER_SYNONYMS = {
         'mpeg1video': 'mpeg1',
         'mpeg2video': 'mpeg2'}
+    FRAMEDATA_ENTRIES = 'color_space,color_primaries,color_transfer,side_data_list,pix_fmt'
+    PROBE_FRAME_PACKETS = 8
+    STDERR_TAIL = 200
+    PROGRESS_POLL = 1
 
-    def __init__(self, ffmpeg_path=None, ffprobe_path=None):
+    def __init__(self, ffmpeg_path=None, ffprobe_path=None, cache=None):
         """
         Initialize a new FFMpeg wrapper object. Optional parameters specify
-        the paths to ffmpeg and ffprobe utilities.
+        the paths to ffmpeg and ffprobe utilities and a ProbeCache used to
+        store probe results between runs.
         """
 
         def which(name):
@@ -488,6 +538,8 @@ class FFMpeg(object):
 
         self.ffmpeg_path = ffmpeg_path
         self.ffprobe_path = ffprobe_path
+        self.cache = cache
+        self._capabilities = {}
 
         if not os.path.exists(self.ffmpeg_path):
             raise FFMpegError("ffmpeg binary not found: " + self.ffmpeg_path)
@@ -495,8 +547,33 @@ class FFMpeg(object):
         if not os.path.exists(self.ffprobe_path):
             raise FFMpegError("ffprobe binary not found: " + self.ffprobe_path)
 
+    def _capability(self, name, binary, func):
+        """
+        Return a build capability, computing it at most once per ffmpeg
+        binary. Results are also stored in the persistent cache, keyed by
+        the binary path and validated against its size and mtime, so they
+        survive between runs until the binary is replaced. Empty results
+        are never kept since they usually come from a failed ffmpeg call.
+        """
+        if name in self._capabilities:
+            return self._capabilities[name]
+
+        signature = self.cache.signature(binary) if self.cache else None
+        value = self.cache.get_capability(signature, name) if signature else None
+        if not value:
+            value = func()
+            if not value:
+                return value
+            if signature:
+                self.cache.put_capability(signature, name, value)
+        self._capabilities[name] = value
+        return value
+
     @property
     def codecs(self):
+        return self._capability('codecs', self.ffprobe_path, self._get_codecs)
+
+    def _get_codecs(self):
         codecs = self._get_stdout([self.ffprobe_path, '-hide_banner', '-codecs'])
         codecs = {
             line_match.group(2): (line_match.group(1), line_match.group(3))
@@ -512,20 +589,21 @@ class FFMpeg(object):
 
     @property
     def hwaccels(self):
-        return [hwaccel.strip() for hwaccel in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-hwaccels']).split('\n')[1:] if hwaccel.strip()]
+        return self._capability('hwaccels', self.ffmpeg_path, lambda: [hwaccel.strip() for hwaccel in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-hwaccels']).split('\n')[1:] if hwaccel.strip()])
 
     @property
     def encoders(self):
-        encoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-encoders'])
-        return [line_match.group(2) for line_match in self.CODECS_LINE_RE.finditer(encoders)]
+        return self._capability('encoders', self.ffmpeg_path, lambda: [line_match.group(2) for line_match in self.CODECS_LINE_RE.finditer(self._get_stdout([self.ffmpeg_path, '-hide_banner', '-encoders']))])
 
     @property
     def decoders(self):
-        decoders = self._get_stdout([self.ffmpeg_path, '-hide_banner', '-decoders'])
-        return [line_match.group(2) for line_match in self.CODECS_LINE_RE.finditer(decoders)]
+        return self._capability('decoders', self.ffmpeg_path, lambda: [line_match.group(2) for line_match in self.CODECS_LINE_RE.finditer(self._get_stdout([self.ffmpeg_path, '-hide_banner', '-decoders']))])
 
     @property
     def pix_fmts(self):
+        return self._capability('pix_fmts', self.ffmpeg_path, self._get_pix_fmts)
+
+    def _get_pix_fmts(self):
         formats = {}
         formatlines = [f.strip() for f in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-pix_fmts']).split('\n')[8:] if f.strip()]
         for f in formatlines:
@@ -540,14 +618,14 @@ class FFMpeg(object):
         return '{0}_{1}'.format(source_codec, hwaccel)
 
     def encoder_formats(self, encoder):
-        prefix = "Supported pixel formats:"
-        formatline = next((line.strip() for line in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-h', 'encoder=%s' % encoder]).split('\n')[1:] if line and line.strip().startswith(prefix)), "")
-        formats = formatline.split(":")
-        return formats[1].strip().split(" ") if formats and len(formats) > 1 else []
+        return self._capability('encoder_formats:%s' % encoder, self.ffmpeg_path, lambda: self._get_coder_formats('encoder', encoder))
 
     def decoder_formats(self, decoder):
+        return self._capability('decoder_formats:%s' % decoder, self.ffmpeg_path, lambda: self._get_coder_formats('decoder', decoder))
+
+    def _get_coder_formats(self, kind, coder):
         prefix = "Supported pixel formats:"
-        formatline = next((line.strip() for line in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-h', 'decoder=%s' % decoder]).split('\n')[1:] if line and line.strip().startswith(prefix)), "")
+        formatline = next((line.strip() for line in self._get_stdout([self.ffmpeg_path, '-hide_banner', '-h', '%s=%s' % (kind, coder)]).split('\n')[1:] if line and line.strip().startswith(prefix)), "")
         formats = formatline.split(":")
         return formats[1].strip().split(" ") if formats and len(formats) > 1 else []
 
@@ -573,15 +651,17 @@ class FFMpeg(object):
         stdout_data, stderr = p.communicate()
         return stdout_data.decode(console_encoding, errors='ignore')
 
-    def framedata(self, fname):
-        try:
-            stdout_data = self._get_stdout([
-                self.ffprobe_path, '-hide_banner', '-loglevel', 'warning',
+    def _framedata_command(self, fname):
+        return [self.ffprobe_path, '-hide_banner', '-loglevel', 'warning',
                 '-select_streams', 'v:0', '-print_format', 'json',
                 '-show_frames', '-read_intervals', '%+#1',
-                '-show_entries', 'frame=color_space,color_primaries,color_transfer,side_data_list,pix_fmt',
+                '-show_entries', 'frame=' + self.FRAMEDATA_ENTRIES,
                 '-probesize', '50M', '-analyzeduration', '100M',
-                '-i', fname])
+                '-i', fname]
+
+    def framedata(self, fname):
+        try:
+            stdout_data = self._get_stdout(self._framedata_command(fname))
             return json.loads(stdout_data)['frames'][0]
         except KeyboardInterrupt:
             raise
@@ -616,25 +696,80 @@ class FFMpeg(object):
         if not os.path.exists(fname):
             return None
 
+        signature, cached = self._probe_cached(fname)
+
+        if cached:
+            stdout_data, framedata = cached
+        else:
+            stdout_data = self._get_stdout(self._probe_command(fname))
+            framedata = None
+
+        info, framedata = self._probe_parse(fname, posters_as_video, stdout_data, framedata)
+
+        if not cached:
+            if info and info.video and not framedata:
+                # First video frame wasn't among the packets read, fall back to a dedicated frame probe
+                try:
+                    framedata = self.framedata(fname)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    pass
+            if signature:
+                self.cache.put(signature, stdout_data, framedata if info else None)
+
+        return self._probe_result(info, framedata)
+
+    def _probe_cached(self, fname):
+        signature = self.cache.signature(fname) if self.cache else None
+        return signature, self.cache.get(signature) if signature else None
+
+    def _probe_command(self, fname):
+        # Streams, format and the first decoded frames in a single pass so the file is only opened and analyzed once
+        return [self.ffprobe_path, '-hide_banner', '-loglevel', 'warning',
+                '-print_format', 'json', '-show_format', '-show_streams', '-show_frames',
+                '-read_intervals', '%+#' + str(self.PROBE_FRAME_PACKETS),
+                '-show_entries', 'stream_tags:format_tags:frame=media_type,stream_index,' + self.FRAMEDATA_ENTRIES,
+                '-probesize', '50M', '-analyzeduration', '100M',
+                fname]
+
+    def _probe_parse(self, fname, posters_as_video, stdout_data, framedata=None):
+        """
+        Parse ffprobe output into a (MediaInfo, framedata) tuple. MediaInfo
+        is None if the file isn't a media file.
+        """
         info = MediaInfo(posters_as_video)
         info.path = fname
 
-        stdout_data = self._get_stdout([
-            self.ffprobe_path, '-show_format', '-show_streams', '-show_entries', 'stream_tags:format_tags', fname])
-        info.parse_ffprobe(stdout_data)
+        try:
+            data = json.loads(stdout_data)
+        except ValueError:
+            data = {}
+        info.parse_ffprobe_json(data)
 
         if not info.format.format and len(info.streams) == 0:
-            return None
+            return None, None
 
-        try:
-            info.video.framedata = self.framedata(fname)
-        except KeyboardInterrupt:
-            raise
-        except:
-            pass
+        if info.video and not framedata:
+            framedata = self._first_video_frame(data.get('frames', []), info.video.index)
+        return info, framedata
 
+    @staticmethod
+    def _probe_result(info, framedata):
+        if info and framedata and info.video:
+            info.video.framedata = framedata
         return info
 
+    @staticmethod
+    def _first_video_frame(frames, index):
+        for frame in frames:
+            if frame.get('media_type') == 'video' and frame.get('stream_index') == index:
+                frame = dict(frame)
+                frame.pop('media_type', None)
+                frame.pop('stream_index', None)
+                return frame
+        return None
+
     def generateCommands(self, outfile, opts, preopts=None, postopts=None):
         print()
         cmds = [self.ffmpeg_path]
@@ -686,6 +821,10 @@ class FFMpeg(object):
         of currently processed part of the file (ie. at which second in the
         content is the conversion process currently).
 
+        Progress is read from the key=value blocks ffmpeg writes with
+        -progress pipe:1 while stderr is drained by a background thread
+        that keeps only the last STDERR_TAIL lines for error reporting.
+
         The optional timeout argument specifies how long should the operation
         be blocked in case ffmpeg gets stuck and doesn't report back. See
         the documentation in Converter.convert() for more details about this
@@ -698,106 +837,175 @@ class FFMpeg(object):
 
         """
         if os.name == 'nt':
+            # Pipes can't be used with selectors on Windows
             timeout = 0
-            if outfile and len(outfile) > 260:
-                outfile = '\\\\?\\' + outfile
 
-        infile = opts[opts.index("-i") + 1]
-
-        if not os.path.exists(infile):
-            raise FFMpegError("Input file doesn't exist: " + infile)
-
-        cmds = self.generateCommands(outfile, opts, preopts, postopts)
+        infile, cmds = self._convert_commands(outfile, opts, preopts, postopts)
 
         yield 0, cmds
 
-        if timeout:
-            def on_sigalrm(*_):
-                signal.signal(signal.SIGALRM, signal.SIG_DFL)
-                raise Exception('timed out while waiting for ffmpeg')
-
-            signal.signal(signal.SIGALRM, on_sigalrm)
-
         try:
-            p = self._spawn(cmds)
+            p = self._spawn(self._progress_commands(cmds))
         except OSError:
             raise FFMpegError('Error while calling ffmpeg binary')
 
+        tail = deque(maxlen=self.STDERR_TAIL)
+        activity = [time.monotonic()]
+        reader = threading.Thread(target=self._drain, args=(p.stderr, tail, activity), daemon=True)
+        reader.start()
+
         yielded = False
-        buf = ''
-        total_output = ''
-        pat = re.compile(r'time=([0-9.:]+) ')
-        while True:
-            if timeout:
-                signal.alarm(timeout)
+        block = {}
+        try:
+            for line in self._lines(p, timeout, activity):
+                event = self._progress_event(block, line)
+                if event:
+                    yielded = True
+                    yield event
 
-            ret = p.stderr.read(10)
+            if not yielded:
+                # For small or very fast jobs, ffmpeg may never report a usable timecode. When EOF is reached, yield if we haven't yet.
+                yielded = True
+                yield 10, ""
+        except:
+            if p.poll() is None:
+                p.kill()
+            raise
+        finally:
+            p.wait()
+            # stderr reaches EOF once ffmpeg exits, wait for it so the reported tail is complete
+            reader.join()
 
-            if timeout:
-                signal.alarm(0)
+        self._check_convert(cmds, infile, tail, p.returncode, p.pid)
 
-            if not ret:
-                # For small or very fast jobs, ffmpeg may never output a '\r'.  When EOF is reached, yield if we haven't yet.
-                if not yielded:
-                    yielded = True
-                    yield 10, ""
-                break
+    def _convert_commands(self, outfile, opts, preopts=None, postopts=None):
+        """
+        Return the input file and the full ffmpeg command for a conversion.
+        """
+        if os.name == 'nt' and outfile and len(outfile) > 260:
+            outfile = '\\\\?\\' + outfile
 
-            try:
-                ret = ret.decode(console_encoding)
-            except UnicodeDecodeError:
-                try:
-                    ret = ret.decode(console_encoding, errors="ignore")
-                except:
-                    pass
+        infile = opts[opts.index("-i") + 1]
 
-            total_output += ret
-            buf += ret
-            if '\r' in buf:
-                line, buf = buf.split('\r', 1)
-
-                tmp = pat.findall(line)
-                if len(tmp) == 1:
-                    timespec = tmp[0]
-                    if ':' in timespec:
-                        timecode = 0
-                        for part in timespec.split(':'):
-                            timecode = 60 * timecode + float(part)
-                    else:
-                        timecode = float(tmp[0])
-                    yielded = True
-                    debug = line.strip()
-                    debug = debug if debug.startswith("frame") else ""
-                    yield timecode, debug
+        if not os.path.exists(infile):
+            raise FFMpegError("Input file doesn't exist: " + infile)
 
-        if timeout:
-            signal.signal(signal.SIGALRM, signal.SIG_DFL)
+        return infile, self.generateCommands(outfile, opts, preopts, postopts)
 
-        p.communicate()  # wait for process to exit
+    @staticmethod
+    def _progress_commands(cmds):
+        return cmds[:1] + ['-progress', 'pipe:1', '-nostats'] + cmds[1:]
 
-        if total_output == '':
-            raise FFMpegError('Error while calling ffmpeg binary')
+    @staticmethod
+    def _check_convert(cmds, infile, tail, returncode, pid):
+        """
+        Raise the appropriate error for a failed conversion. Whether it
+        failed is decided by the exit code since stderr may be empty with a
+        quiet loglevel, the tail of stderr only describes the error.
+        """
+        if returncode == 0:
+            return
 
         cmd = ' '.join(cmds)
-        if '\n' in total_output:
-            line = total_output.split('\n')[-2]
-
-            if line.startswith('Received signal'):
-                # Received signal 15: terminating.
-                raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=p.pid)
-            if line.startswith(infile + ': '):
-                err = line[len(infile) + 2:]
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         err, pid=p.pid)
-            if line.startswith('Error while '):
-                raise FFMpegConvertError('Encoding error', cmd, total_output,
-                                         line, pid=p.pid)
-            if not yielded:
-                raise FFMpegConvertError('Unknown ffmpeg error', cmd,
-                                         total_output, line, pid=p.pid)
-        if p.returncode != 0:
-            raise FFMpegConvertError('Exited with code %d' % p.returncode, cmd,
-                                     total_output, pid=p.pid)
+        total_output = '\n'.join(tail)
+        line = next((x for x in reversed(tail) if x.strip()), '')
+
+        if line.startswith('Received signal'):
+            # Received signal 15: terminating.
+            raise FFMpegConvertError(line.split(':')[0], cmd, total_output, pid=pid)
+        if line.startswith(infile + ': '):
+            err = line[len(infile) + 2:]
+            raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                     err, pid=pid)
+        if line.startswith('Error while '):
+            raise FFMpegConvertError('Encoding error', cmd, total_output,
+                                     line, pid=pid)
+        raise FFMpegConvertError('Exited with code %d' % returncode, cmd,
+                                 total_output, pid=pid)
+
+    @staticmethod
+    def _decode(data):
+        try:
+            return data.decode(console_encoding)
+        except UnicodeDecodeError:
+            return data.decode(console_encoding, errors="ignore")
+
+    @classmethod
+    def _drain(cls, stream, tail, activity):
+        """
+        Keep the last lines written to stream in the tail deque until EOF.
+        """
+        try:
+            for line in iter(stream.readline, b''):
+                tail.append(cls._decode(line).rstrip())
+                activity[0] = time.monotonic()
+        except (OSError, ValueError):
+            pass
+
+    @classmethod
+    def _lines(cls, p, timeout, activity):
+        """
+        Yield the lines ffmpeg writes to stdout. With a timeout, raises an
+        exception when neither stdout nor stderr received anything for
+        timeout seconds. Works from any thread since no signals are used.
+        """
+        if not timeout:
+            for line in iter(p.stdout.readline, b''):
+                activity[0] = time.monotonic()
+                yield cls._decode(line).strip()
+            return
+
+        fd = p.stdout.fileno()
+        buf = b''
+        with selectors.DefaultSelector() as selector:
+            selector.register(fd, selectors.EVENT_READ)
+            while True:
+                if not selector.select(min(timeout, cls.PROGRESS_POLL)):
+                    if time.monotonic() - activity[0] > timeout:
+                        raise Exception('timed out while waiting for ffmpeg')
+                    continue
+                data = os.read(fd, 65536)
+                if not data:
+                    break
+                activity[0] = time.monotonic()
+                buf += data
+                lines = buf.split(b'\n')
+                buf = lines.pop()
+                for line in lines:
+                    yield cls._decode(line).strip()
+        if buf:
+            yield cls._decode(buf).strip()
+
+    @classmethod
+    def _progress_event(cls, block, line):
+        """
+        Add a line of -progress output to block and return a (timecode,
+        debug) tuple once the block is complete and has a timecode.
+        """
+        key, _, value = line.partition('=')
+        block[key] = value
+        if key != 'progress':
+            return None
+        timecode = cls._progress_timecode(block)
+        event = (timecode, cls._progress_debug(block)) if timecode is not None else None
+        block.clear()
+        return event
+
+    @staticmethod
+    def _progress_timecode(block):
+        for key, scale in [('out_time_us', 1000000.0), ('out_time_ms', 1000000.0)]:
+            try:
+                return max(0, int(block[key])) / scale
+            except (KeyError, ValueError):
+                pass
+        return None
+
+    @staticmethod
+    def _progress_debug(block):
+        # Mirror the stats line ffmpeg would have printed so detailed progress output doesn't change
+        keys = ['frame', 'fps', 'total_size', 'out_time', 'bitrate', 'speed'] if 'frame' in block else ['total_size', 'out_time', 'bitrate', 'speed']
+        labels = {'total_size': 'size', 'out_time': 'time'}
+        return ' '.join('%s=%s' % (labels.get(k, k), block[k].strip()) for k in keys if k in block)
 
     def thumbnail(self, fname, time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY):
         """
@@ -812,16 +1020,7 @@ class FFMpeg(object):
         """
         return self.thumbnails(fname, [(time, outfile, size, quality)])
 
-    def thumbnails(self, fname, option_list):
-        """
-        Create one or more thumbnails of video.
-        @param option_list: a list of tuples like:
-            (time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY)
-            see documentation of `converter.FFMpeg.thumbnail()` for details.
-
-        >>> FFMpeg().thumbnails('test1.ogg', [(5, '/tmp/shot.png', '320x240'),
-        >>>                                   (10, '/tmp/shot2.png', None, 5)])
-        """
+    def _thumbnails_command(self, fname, option_list):
         if not os.path.exists(fname):
             raise IOError('No such file: ' + fname)
 
@@ -835,8 +1034,19 @@ class FFMpeg(object):
                 '-ss', str(thumb[0]), thumb[1],
                 '-q:v', str(FFMpeg.DEFAULT_JPEG_QUALITY if len(thumb) < 4 else str(thumb[3])),
             ])
+        return cmds
 
-        p = self._spawn(cmds)
+    def thumbnails(self, fname, option_list):
+        """
+        Create one or more thumbnails of video.
+        @param option_list: a list of tuples like:
+            (time, outfile, size=None, quality=DEFAULT_JPEG_QUALITY)
+            see documentation of `converter.FFMpeg.thumbnail()` for details.
+
+        >>> FFMpeg().thumbnails('test1.ogg', [(5, '/tmp/shot.png', '320x240'),
+        >>>                                   (10, '/tmp/shot2.png', None, 5)])
+        """
+        p = self._spawn(self._thumbnails_command(fname, option_list))
         _, stderr_data = p.communicate()
         if stderr_data == '':
             raise FFMpegError('Error while calling ffmpeg binary')
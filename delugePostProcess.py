@@ -5,7 +5,7 @@ import sys
 import re
 from autoprocess import autoProcessTV, autoProcessTVSR, sonarr, radarr
 from resources.readsettings import ReadSettings
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
 from resources.log import getLogger
 from deluge_client import DelugeRPCClient
 import shutil
@@ -129,7 +129,7 @@ try:
                 except:
                     log.exception("Unable to make output directory %s." % settings.output_dir)
 
-            mp = MediaProcessor(settings)
+            mp = getMediaProcessor(settings)
 
             if len(files) < 1:
                 log.error("No files provided by torrent")
@@ -10,13 +10,15 @@ import struct
 import enum
 import json
 import logging
-import tmdbsimple as tmdb
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
 from resources.mediaprocessor import MediaProcessor
+from resources.batch import BatchProcessor
+from resources.archive import ProcessedArchive, ArchiveVerify
+from resources.manifest import ScanManifest, ScanDecision
 from resources.metadata import Metadata, MediaType
+from resources.guess import guessFile, searchTMDB
 from resources.postprocess import PostProcessor
-from resources.extensions import tmdb_api_key
 from converter.avcodecs import audio_codec_list, video_codec_list, subtitle_codec_list, attachment_codec_list
 
 if sys.version[0] == "3":
@@ -172,7 +174,7 @@ def getInfo(fileName, settings, silent=False, tag=True, tvdbid=None, tmdbid=None
 def guessInfo(fileName, settings, tmdbid=None, tvdbid=None, imdbid=None, season=None, episode=None, language=None, original=None):
     if not settings.fullpathguess:
         fileName = os.path.basename(fileName)
-    guess = guessit.guessit(original or fileName)
+    guess = guessFile(original or fileName)
     try:
         if guess['type'] == 'movie':
             return movieInfo(guess, tmdbid=tmdbid, imdbid=imdbid, language=language, original=original)
@@ -189,20 +191,9 @@ def guessInfo(fileName, settings, tmdbid=None, tvdbid=None, imdbid=None, season=
 
 def movieInfo(guessData, tmdbid=None, imdbid=None, language=None, original=None):
     if not tmdbid and not imdbid:
-        tmdb.API_KEY = tmdb_api_key
-        search = tmdb.Search()
-        title = guessData['title']
-        if 'year' in guessData:
-            _ = search.movie(query=title, year=guessData["year"])
-            if len(search.results) < 1:
-                _ = search.movie(query=title, year=guessData["year"])
-        else:
-            _ = search.movie(query=title)
-        if len(search.results) < 1:
+        tmdbid = searchTMDB('movie', guessData['title'], guessData.get('year'))
+        if not tmdbid:
             return None
-        result = search.results[0]
-        # release = result['release_date']
-        tmdbid = result['id']
         log.debug("Guessed filename resulted in TMDB ID %s" % tmdbid)
 
     metadata = Metadata(MediaType.Movie, tmdbid=tmdbid, imdbid=imdbid, language=language, logger=log, original=original)
@@ -217,51 +208,58 @@ def tvInfo(guessData, tmdbid=None, tvdbid=None, imdbid=None, season=None, episod
         episode = episode[0]
 
     if not tmdbid and not tvdbid and not imdbid:
-        tmdb.API_KEY = tmdb_api_key
-        search = tmdb.Search()
-        series = guessData["title"]
-        if 'year' in guessData:
-            _ = search.tv(query=series, first_air_date_year=guessData["year"])
-            if len(search.results) < 1:
-                _ = search.tv(query=series)
-        else:
-            _ = search.tv(query=series)
-        if search and len(search.results) < 1:
+        tmdbid = searchTMDB('tv', guessData['title'], guessData.get('year'))
+        if not tmdbid:
             return None
-        result = search.results[0]
-        tmdbid = result['id']
 
     metadata = Metadata(MediaType.TV, tmdbid=tmdbid, imdbid=imdbid, tvdbid=tvdbid, season=season, episode=episode, language=language, logger=log, original=original)
     log.info("Matched TV episode as %s (TMDB ID: %d) S%02dE%02d" % (metadata.showname, int(metadata.tmdbid), int(season), int(episode)))
     return metadata
 
 
-def checkAlreadyProcessed(inputfile, processedList):
-    if processedList is None:
+def checkAlreadyProcessed(inputfile, processedArchive):
+    if processedArchive is None:
         return False
 
-    return inputfile in processedList
+    return inputfile in processedArchive
+
+
+# A .json archive is kept in the .db of the same name once imported
+def archiveExists(path):
+    return os.path.exists(path) or (os.path.splitext(path)[1].lower() == '.json' and os.path.exists(os.path.splitext(path)[0] + '.db'))
 
 
-def addtoProcessedArchive(files, processedList, processedArchive):
-    if processedList is None or processedArchive is None:
+def addtoProcessedArchive(files, processedArchive):
+    if processedArchive is None:
         return
 
-    processedList.extend(files)
-    with open(processedArchive, 'w', encoding="utf8") as pa:
-        json.dump(list(set(processedList)), pa, indent=4)
-    log.debug("Adding %s to processed archive %s" % (files, processedArchive))
+    processedArchive.add(files)
+    log.debug("Adding %s to processed archive %s" % (files, processedArchive.path))
 
 
-def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=True, tagOnly=False, optionsOnly=False, tmdbid=None, tvdbid=None, imdbid=None, season=None, episode=None, original=None, processedList=None, processedArchive=None):
-    if checkAlreadyProcessed(inputfile, processedList):
-        log.debug("%s is already processed and will be skipped based on archive %s." % (inputfile, processedArchive))
+def recordScanDecision(files, decision, reason, scanManifest):
+    if scanManifest is None:
+        return
+
+    scanManifest.record(files, decision, reason)
+    log.debug("Recorded scan decision %s for %s [%s]" % (decision, files, reason))
+
+
+# Only rejections that will be the same next time are kept as invalid, anything else is checked again by the next scan
+def invalidDecision(mp):
+    return ScanDecision.INVALID if mp.invalid_final else ScanDecision.ERROR
+
+
+def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=True, tagOnly=False, optionsOnly=False, tmdbid=None, tvdbid=None, imdbid=None, season=None, episode=None, original=None, processedArchive=None, scanManifest=None, progressOutput=None):
+    if checkAlreadyProcessed(inputfile, processedArchive):
+        log.debug("%s is already processed and will be skipped based on archive %s." % (inputfile, processedArchive.path))
         return
 
     # Process
     info = info or mp.isValidSource(inputfile)
     if not info:
         log.debug("Invalid file %s." % inputfile)
+        recordScanDecision(inputfile, invalidDecision(mp), mp.invalid_reason, scanManifest)
         return
 
     language = mp.settings.taglanguage or None
@@ -290,15 +288,16 @@ def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=T
                 log.exception("There was an error tagging the file")
         return
 
-    output = mp.process(inputfile, True, info=info, original=original, tagdata=tagdata)
+    destination = (os.path.join(mp.settings.moveto, relativePath) if relativePath else mp.settings.moveto) if mp.settings.moveto else os.path.dirname(inputfile)
+    output = mp.process(inputfile, True, info=info, original=original, tagdata=tagdata, progressOutput=progressOutput, destination=destination)
     if output:
-        if not language:
+        if not language and not output['tagged']:
             language = mp.getDefaultAudioLanguage(output["options"]) or None
             if language and tagdata:
-                tagdata = Metadata(tagdata.mediatype, tmdbid=tagdata.tmdbid, imdbid=tagdata.imdbid, tvdbid=tagdata.tvdbid, season=tagdata.season, episode=tagdata.episode, original=original, language=language, logger=log)
+                tagdata = tagdata.withLanguage(language)
         log.debug("Tag language setting is %s, using language %s for tagging." % (mp.settings.taglanguage or None, language))
         tagfailed = False
-        if tagdata:
+        if tagdata and not output['tagged']:
             try:
                 tagdata.writeTags(output['output'], inputfile, mp.converter, mp.settings.artwork, mp.settings.thumbnail, width=output['x'], height=output['y'], cues_to_front=output['cues_to_front'])
             except KeyboardInterrupt:
@@ -306,7 +305,8 @@ def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=T
             except:
                 log.exception("There was an error tagging the file")
                 tagfailed = True
-        if mp.settings.relocate_moov and not tagfailed:
+            mp.converter.invalidate(output['output'])
+        if mp.settings.relocate_moov and not tagfailed and not output['tagged']:
             mp.QTFS(output['output'])
 
         # Reverse Ouput
@@ -315,6 +315,8 @@ def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=T
             output['external_subs'][i] = mp.restoreFromOutput(inputfile, sub)
 
         output_files = mp.replicate(output['output'], relativePath=relativePath)
+        if not output['bypassed']:
+            mp.recordContent(output['content'], output_files[0])
         print(json.dumps(output, indent=4))
         for sub in [x for x in output['external_subs'] if os.path.exists(x)]:
             output_files.extend(mp.replicate(sub, relativePath=relativePath))
@@ -325,35 +327,67 @@ def processFile(inputfile, mp, info=None, relativePath=None, silent=False, tag=T
                 mp.post(output_files, tagdata.mediatype, tmdbid=tagdata.tmdbid, season=tagdata.season, episode=tagdata.episode)
             else:
                 mp.post(output_files, mediatype, tmdbid=tmdbid, season=season, episode=episode)
-        addtoProcessedArchive(output_files + [output['input']] if not output['input_deleted'] else output_files, processedList, processedArchive)
+        addtoProcessedArchive(output_files + [output['input']] if not output['input_deleted'] else output_files, processedArchive)
+        if output['bypassed']:
+            recordScanDecision(output_files, ScanDecision.BYPASSED, mp.bypass_reason, scanManifest)
+        else:
+            recordScanDecision(output_files + [output['input']] if not output['input_deleted'] else output_files, ScanDecision.PROCESSED, None, scanManifest)
     else:
         log.error("There was an error processing file %s, no output data received" % inputfile)
+        recordScanDecision(inputfile, ScanDecision.ERROR, "no output data received", scanManifest)
 
 
-def walkDir(dir, settings, silent=False, preserveRelative=False, tmdbid=None, imdbid=None, tvdbid=None, tag=True, tagOnly=False, optionsOnly=False, processedList=None, processedArchive=None):
+def walkDir(dir, settings, silent=False, preserveRelative=False, tmdbid=None, imdbid=None, tvdbid=None, tag=True, tagOnly=False, optionsOnly=False, processedArchive=None, scanManifest=None, jobs=None, probeWorkers=None):
     files = []
-    error = []
-    mp = MediaProcessor(settings, logger=log)
+    unchanged = 0
+    # Tagging and displaying options don't decide anything about a file
+    recordManifest = scanManifest if not tagOnly and not optionsOnly else None
     for r, _, f in os.walk(dir):
+        entries = scanManifest.load(r) if scanManifest else {}
         for file in f:
-            files.append(os.path.join(r, file))
-    for filepath in files:
-        info = mp.isValidSource(filepath)
-        if info:
-            log.info("Processing file %s" % (filepath))
-            relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
-            if optionsOnly:
-                displayOptions(filepath, settings)
+            filepath = os.path.join(r, file)
+            if checkAlreadyProcessed(filepath, processedArchive):
+                log.debug("%s is already processed and will be skipped based on archive %s." % (filepath, processedArchive.path))
                 continue
-            try:
-                processFile(filepath, mp, info=info, relativePath=relative, silent=silent, tag=tag, tagOnly=tagOnly, optionsOnly=optionsOnly, tmdbid=tmdbid, tvdbid=tvdbid, imdbid=imdbid, processedList=processedList, processedArchive=processedArchive)
-            except SkipFileException:
-                log.debug("Skipping file %s." % filepath)
-            except KeyboardInterrupt:
-                break
-            except:
-                log.exception("Error processing file %s." % filepath)
-                error.append(filepath)
+            if entries:
+                previous = scanManifest.unchanged(entries.get(file), filepath)
+                if previous:
+                    log.debug("%s is unchanged since the last scan and will be skipped [%s: %s]." % (filepath, previous[0], previous[1]))
+                    unchanged += 1
+                    continue
+            files.append(filepath)
+    if scanManifest:
+        log.info("Incremental scan skipped %d unchanged file(s), %d file(s) to check." % (unchanged, len(files)))
+
+    remuxJobs = None
+    deviceJobs = None
+    jobs = jobs or settings.batch_jobs
+    if (jobs > 1 or settings.batch_remux_jobs > 0 or settings.batch_device_jobs > 0) and not silent and not optionsOnly:
+        log.warning("Running multiple jobs requires auto mode, processing one file at a time.")
+        jobs = 1
+        remuxJobs = 0
+        deviceJobs = 0
+
+    def handler(filepath, mp, info, progressOutput):
+        log.info("Processing file %s" % (filepath))
+        relative = os.path.split(os.path.relpath(filepath, dir))[0] if preserveRelative else None
+        if optionsOnly:
+            displayOptions(filepath, settings)
+            return
+        try:
+            processFile(filepath, mp, info=info, relativePath=relative, silent=silent, tag=tag, tagOnly=tagOnly, optionsOnly=optionsOnly, tmdbid=tmdbid, tvdbid=tvdbid, imdbid=imdbid, processedArchive=processedArchive, scanManifest=recordManifest, progressOutput=progressOutput)
+        except SkipFileException:
+            log.debug("Skipping file %s." % filepath)
+
+    batch = BatchProcessor(settings, jobs=jobs, probe_workers=probeWorkers, remux_jobs=remuxJobs, device_jobs=deviceJobs, logger=log)
+
+    def rejected(filepath, mp):
+        recordScanDecision(filepath, invalidDecision(mp), mp.invalid_reason, recordManifest)
+
+    try:
+        error = batch.run(files, handler, rejected if recordManifest else None)
+    except KeyboardInterrupt:
+        return
     if error:
         log.error("Script failed to process the following files:")
         for e in error:
@@ -407,7 +441,11 @@ def main():
     parser.add_argument('-cl', '--codeclist', action="store_true", help="Print a list of supported codecs and their paired FFMPEG encoders")
     parser.add_argument('-o', '--original', help="Specify the original source/release filename")
     parser.add_argument('-ms', '--minsize', help="Specify the minimum file size")
-    parser.add_argument('-pa', '--processedarchive', help="Specify a processed list/archive so already processed files are skipped", nargs='?', const="archive.json")
+    parser.add_argument('-pa', '--processedarchive', help="Specify a processed list/archive so already processed files are skipped, legacy .json archives are imported into a .db archive of the same name", nargs='?', const="archive.json")
+    parser.add_argument('-pav', '--processedarchiveverify', choices=ArchiveVerify.choices(), default=ArchiveVerify.PATH, help="How files are matched against the processed archive. path matches by path only, stat also reprocesses files that were replaced and recognizes renamed files, hash also recognizes moved or copied files")
+    parser.add_argument('-inc', '--incremental', action='store_true', help="Skip files in a directory that haven't changed since they were last scanned, results are kept in a scan manifest in the cache directory or next to the config file")
+    parser.add_argument('-j', '--jobs', type=int, help="Overrides the number of software encodes run concurrently when processing a directory, requires auto mode")
+    parser.add_argument('-pw', '--probeworkers', type=int, help="Overrides the number of workers validating files ahead of processing when processing a directory")
 
     args = vars(parser.parse_args())
 
@@ -430,22 +468,19 @@ def main():
         settings = ReadSettings(logger=log)
 
     processedArchive = None
-    processedList = None
-    if args['processedarchive'] and os.path.exists(args['processedarchive']):
-        processedArchive = args['processedarchive']
-        log.info("Processed archived specified at %s" % (processedArchive))
-    elif args['processedarchive'] and os.path.exists(os.path.join(os.path.dirname(sys.argv[0]), args['processedarchive'])):
-        processedArchive = os.path.join(os.path.dirname(sys.argv[0]), args['processedarchive'])
-        log.info("Processed archived specified at %s" % (processedArchive))
+    archivePath = None
+    if args['processedarchive'] and archiveExists(args['processedarchive']):
+        archivePath = args['processedarchive']
+        log.info("Processed archived specified at %s" % (archivePath))
+    elif args['processedarchive'] and archiveExists(os.path.join(os.path.dirname(sys.argv[0]), args['processedarchive'])):
+        archivePath = os.path.join(os.path.dirname(sys.argv[0]), args['processedarchive'])
+        log.info("Processed archived specified at %s" % (archivePath))
     elif args['processedarchive']:
-        processedArchive = os.path.normpath(args['processedarchive'])
-        with open(processedArchive, 'w', encoding="utf8") as pa:
-            json.dump([], pa)
-        log.info("Processed archived specified at %s but file does not exist, creating" % (processedArchive))
-    if processedArchive:
-        pa = open(processedArchive, encoding="utf8")
-        processedList = json.load(pa)
-        log.info("Loaded archive list containing %d files" % (len(processedList)))
+        archivePath = os.path.normpath(args['processedarchive'])
+        log.info("Processed archived specified at %s but file does not exist, creating" % (archivePath))
+    if archivePath:
+        processedArchive = ProcessedArchive(archivePath, verify=args['processedarchiveverify'], logger=log)
+        log.info("Loaded archive %s containing %d files" % (processedArchive.path, len(processedArchive)))
 
     if (args['nomove']):
         settings.output_dir = None
@@ -485,6 +520,11 @@ def main():
         except TypeError:
             log.error("Invalid minsize")
 
+    scanManifest = None
+    if args['incremental']:
+        scanManifest = ScanManifest(settings.cache_dir or os.path.dirname(settings._configFile), settings, logger=log)
+        log.info("Incremental scan enabled using manifest %s" % (scanManifest.path))
+
     # Establish the path we will be working with
     if (args['input']):
         path = (str(args['input']))
@@ -496,13 +536,13 @@ def main():
         path = getValue("Enter path to file")
 
     if os.path.isdir(path):
-        walkDir(path, settings, silent=silent, tmdbid=args.get('tmdbid'), tvdbid=args.get('tvdbid'), imdbid=args.get('imdbid'), preserveRelative=args['preserverelative'], tag=settings.tagfile, tagOnly=args.get('tagonly', False), optionsOnly=args['optionsonly'], processedList=processedList, processedArchive=processedArchive)
+        walkDir(path, settings, silent=silent, tmdbid=args.get('tmdbid'), tvdbid=args.get('tvdbid'), imdbid=args.get('imdbid'), preserveRelative=args['preserverelative'], tag=settings.tagfile, tagOnly=args.get('tagonly', False), optionsOnly=args['optionsonly'], processedArchive=processedArchive, scanManifest=scanManifest, jobs=args['jobs'], probeWorkers=args['probeworkers'])
     elif (os.path.isfile(path)):
         mp = MediaProcessor(settings, logger=log)
         info = mp.isValidSource(path)
         if info:
             try:
-                processFile(path, mp, info=info, silent=silent, tag=settings.tagfile, tagOnly=args.get('tagonly', False), optionsOnly=args.get('optionsonly', False), tmdbid=args.get('tmdbid'), tvdbid=args.get('tvdbid'), imdbid=args.get('imdbid'), season=args.get('season'), episode=args.get('episode'), original=args.get('original'), processedList=processedList, processedArchive=processedArchive)
+                processFile(path, mp, info=info, silent=silent, tag=settings.tagfile, tagOnly=args.get('tagonly', False), optionsOnly=args.get('optionsonly', False), tmdbid=args.get('tmdbid'), tvdbid=args.get('tvdbid'), imdbid=args.get('imdbid'), season=args.get('season'), episode=args.get('episode'), original=args.get('original'), processedArchive=processedArchive)
             except SkipFileException:
                 log.debug("Skipping file %s" % path)
 
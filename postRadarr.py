@@ -7,7 +7,8 @@ import shutil
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
 from resources.metadata import MediaType
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
+from resources.sidecar import SidecarIndex
 
 
 # Radarr API functions
@@ -140,20 +141,14 @@ def renameFile(inputfile, log):
 
 
 def backupSubs(inputpath, mp, log, extension=".backup"):
-    dirname, filename = os.path.split(inputpath)
-    files = []
     output = {}
-    for r, _, f in os.walk(dirname):
-        for file in f:
-            files.append(os.path.join(r, file))
-    for filepath in files:
-        if filepath.startswith(os.path.splitext(filename)[0]):
-            info = mp.isValidSubtitleSource(filepath)
-            if info:
-                newpath = filepath + extension
-                shutil.copy2(filepath, newpath)
-                output[newpath] = filepath
-                log.info("Copying %s to %s." % (filepath, newpath))
+    for filepath in SidecarIndex(logger=log).sidecars(inputpath):
+        info = mp.isValidSubtitleSource(filepath)
+        if info:
+            newpath = filepath + extension
+            shutil.copy2(filepath, newpath)
+            output[newpath] = filepath
+            log.info("Copying %s to %s." % (filepath, newpath))
     return output
 
 
@@ -197,7 +192,7 @@ except:
     log.exception("Error reading environment variables")
     sys.exit(1)
 
-mp = MediaProcessor(settings)
+mp = getMediaProcessor(settings)
 
 if settings.Radarr.get('blockreprocess'):
     log.debug("Block reprocess enabled for Radarr")
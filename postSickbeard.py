@@ -10,7 +10,7 @@ import struct
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
 from resources.metadata import MediaType
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
 
 log = getLogger("SickbeardPostProcess")
 
@@ -31,7 +31,7 @@ try:
         log.debug("TVDB ID: %s." % tvdb_id)
         log.debug("Season: %s episode: %s." % (season, episode))
 
-        mp = MediaProcessor(settings)
+        mp = getMediaProcessor(settings)
 
         success = mp.fullprocess(inputfile, MediaType.TV, tvdbid=tvdb_id, season=season, episode=episode, original=original)
         if success:
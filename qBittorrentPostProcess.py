@@ -7,7 +7,7 @@ import shutil
 from autoprocess import autoProcessTV, autoProcessTVSR, sonarr, radarr
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
 
 
 def getHost(host='localhost', port=8080, ssl=False):
@@ -103,7 +103,7 @@ try:
             except:
                 log.exception("Unable to make output directory %s." % settings.output_dir)
 
-        mp = MediaProcessor(settings)
+        mp = getMediaProcessor(settings)
 
         if single_file:
             # single file
@@ -0,0 +1,148 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+import logging
+
+
+class ArchiveVerify:
+    PATH = 'path'
+    STAT = 'stat'
+    HASH = 'hash'
+
+    @classmethod
+    def choices(cls):
+        return [cls.PATH, cls.STAT, cls.HASH]
+
+
+class ProcessedArchive:
+    """
+    Indexed record of files that have already been processed so they can
+    be skipped by later runs. Lookups and additions are single indexed
+    queries regardless of how large the archive grows.
+
+    Each entry also stores the size, modification time, inode and a
+    partial content hash of the file. With verify set to stat a file that
+    was replaced since it was archived is processed again and a file that
+    was renamed on the same filesystem is still recognized. With verify
+    set to hash files are also recognized after being moved or copied.
+
+    Legacy JSON archives are imported into a sibling .db file the first
+    time they are opened.
+    """
+    HASH_BLOCK = 1024 * 1024
+
+    def __init__(self, path, verify=ArchiveVerify.PATH, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.verify = verify if verify in ArchiveVerify.choices() else ArchiveVerify.PATH
+        self._lock = threading.Lock()
+
+        legacy = None
+        if os.path.splitext(path)[1].lower() == '.json':
+            legacy = path
+            path = os.path.splitext(path)[0] + '.db'
+        migrate = legacy and os.path.isfile(legacy) and not os.path.exists(path)
+
+        self.path = path
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS processed (
+                              path TEXT PRIMARY KEY,
+                              size INTEGER,
+                              mtime_ns INTEGER,
+                              inode INTEGER,
+                              hash TEXT,
+                              added REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS processed_inode ON processed (inode, size)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS processed_hash ON processed (hash)')
+
+        if migrate:
+            self.importJSON(legacy)
+
+    def importJSON(self, path):
+        try:
+            with open(path, encoding="utf8") as pa:
+                entries = json.load(pa)
+        except (OSError, ValueError):
+            self.log.exception("Unable to read legacy processed archive %s." % path)
+            return
+        now = time.time()
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR IGNORE INTO processed (path, added) VALUES (?, ?)', ((x, now) for x in set(entries) if isinstance(x, str)))
+            self._conn.execute('COMMIT')
+        self.log.info("Imported %d entries from legacy processed archive %s into %s." % (len(entries), path, self.path))
+
+    @classmethod
+    def fileHash(cls, path, size):
+        # Size plus the first and last block is enough to tell media files apart without reading them whole
+        h = hashlib.sha1(str(size).encode())
+        with open(path, 'rb') as f:
+            h.update(f.read(cls.HASH_BLOCK))
+            if size > cls.HASH_BLOCK * 2:
+                f.seek(-cls.HASH_BLOCK, os.SEEK_END)
+                h.update(f.read(cls.HASH_BLOCK))
+        return h.hexdigest()
+
+    def contains(self, path):
+        with self._lock:
+            row = self._conn.execute('SELECT size, mtime_ns, inode, hash FROM processed WHERE path = ?', (path,)).fetchone()
+        if self.verify == ArchiveVerify.PATH:
+            return row is not None
+
+        try:
+            st = os.stat(path)
+        except OSError:
+            return row is not None
+
+        if row and (row[0] is None or (row[0] == st.st_size and row[1] == st.st_mtime_ns)):
+            return True
+
+        with self._lock:
+            moved = self._conn.execute('SELECT path FROM processed WHERE inode = ? AND size = ? AND mtime_ns = ?', (st.st_ino, st.st_size, st.st_mtime_ns)).fetchone()
+        if not moved and self.verify == ArchiveVerify.HASH:
+            try:
+                digest = self.fileHash(path, st.st_size)
+            except OSError:
+                return False
+            with self._lock:
+                moved = self._conn.execute('SELECT path FROM processed WHERE hash = ?', (digest,)).fetchone()
+        if moved:
+            self.log.debug("%s matches previously processed file %s." % (path, moved[0]))
+            self.add([path])
+            return True
+        if row:
+            self.log.debug("%s has changed since it was processed." % path)
+        return False
+
+    def __contains__(self, path):
+        return self.contains(path)
+
+    def add(self, files):
+        now = time.time()
+        rows = []
+        for path in files:
+            size = mtime_ns = inode = digest = None
+            try:
+                st = os.stat(path)
+                size, mtime_ns, inode = st.st_size, st.st_mtime_ns, st.st_ino
+                if self.verify == ArchiveVerify.HASH:
+                    digest = self.fileHash(path, size)
+            except OSError:
+                pass
+            rows.append((path, size, mtime_ns, inode, digest, now))
+        with self._lock:
+            self._conn.execute('BEGIN')
+            self._conn.executemany('INSERT OR REPLACE INTO processed (path, size, mtime_ns, inode, hash, added) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self._conn.execute('COMMIT')
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM processed').fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,161 @@
+import os
+import time
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import logging
+import requests
+
+
+class ArtworkCache:
+    """
+    Persistent cache of TMDB artwork so every episode of a season doesn't
+    download the same poster again.
+
+    Images are downloaded in the configured TMDB size and streamed to disk
+    under the SHA-1 of their content, so an image reached through several
+    poster paths is only stored once. An SQLite index maps poster path and
+    size to the stored file. Once the stored files grow past max_bytes the
+    least recently used ones are removed, except for those used in the last
+    EVICT_GRACE seconds which may still be read by a running job.
+
+    >>> ArtworkCache.install('/tmp/sma-cache/artwork', image_size='w780')
+    >>> ArtworkCache.default().get('/poster.jpg')
+    """
+    DEFAULT_FILENAME = 'artwork.db'
+    BASE_URL = 'https://image.tmdb.org/t/p/'
+    SIZES = ['w92', 'w154', 'w185', 'w300', 'w342', 'w500', 'w780', 'w1280', 'original']
+    EVICT_GRACE = 600
+    CHUNK = 64 * 1024
+
+    _default = None
+    _default_lock = threading.Lock()
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024, image_size='original', logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.image_size = image_size if image_size in self.SIZES else 'original'
+        self.session = requests.Session()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = os.path.join(directory, self.DEFAULT_FILENAME)
+        self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS artwork (
+                              poster_path TEXT NOT NULL,
+                              size TEXT NOT NULL,
+                              filename TEXT NOT NULL,
+                              bytes INTEGER NOT NULL,
+                              last_access REAL NOT NULL,
+                              PRIMARY KEY (poster_path, size))''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS artwork_last_access ON artwork (last_access)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS artwork_filename ON artwork (filename)')
+
+    @classmethod
+    def install(cls, directory, max_bytes=200 * 1024 * 1024, image_size='original', logger=None):
+        """
+        Set the cache used by Metadata.getArtwork. The installed cache is
+        kept if it has the same directory and image size.
+        """
+        with cls._default_lock:
+            cache = cls._default
+            if not cache or cache.directory != directory or cache.image_size != image_size:
+                cache = cls._default = cls(directory, max_bytes, image_size, logger=logger)
+            cache.max_bytes = max_bytes
+            return cache
+
+    @staticmethod
+    def defaultDirectory():
+        return os.path.join(tempfile.gettempdir(), 'sma-artwork')
+
+    @classmethod
+    def default(cls):
+        with cls._default_lock:
+            if not cls._default:
+                cls._default = cls(cls.defaultDirectory())
+            return cls._default
+
+    def get(self, poster_path):
+        """
+        Return the local path of the image for a TMDB poster path,
+        downloading it if it isn't cached.
+        """
+        filename = self.lookup(poster_path)
+        if filename:
+            return filename
+
+        # Only one thread downloads an image, the others use its result
+        with self._lock:
+            downloading = self._inflight.setdefault(poster_path, threading.Lock())
+        with downloading:
+            try:
+                return self.lookup(poster_path) or self.download(poster_path)
+            finally:
+                with self._lock:
+                    self._inflight.pop(poster_path, None)
+
+    def lookup(self, poster_path):
+        with self._lock:
+            row = self._conn.execute('SELECT filename FROM artwork WHERE poster_path = ? AND size = ?', (poster_path, self.image_size)).fetchone()
+            if not row:
+                return None
+            filename = os.path.join(self.directory, row[0])
+            if not os.path.isfile(filename):
+                self._conn.execute('DELETE FROM artwork WHERE filename = ?', (row[0],))
+                return None
+            self._conn.execute('UPDATE artwork SET last_access = ? WHERE poster_path = ? AND size = ?', (time.time(), poster_path, self.image_size))
+        self.log.debug("Using cached artwork %s for %s." % (filename, poster_path))
+        return filename
+
+    def download(self, poster_path):
+        url = self.BASE_URL + self.image_size + poster_path
+        extension = os.path.splitext(poster_path)[1].lower() or '.jpg'
+        fd, temp = tempfile.mkstemp(suffix='.part', dir=self.directory)
+        digest = hashlib.sha1()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f, self.session.get(url, stream=True, allow_redirects=True, timeout=30) as response:
+                response.raise_for_status()
+                for chunk in response.iter_content(chunk_size=self.CHUNK):
+                    f.write(chunk)
+                    digest.update(chunk)
+                    size += len(chunk)
+            name = digest.hexdigest() + extension
+            os.replace(temp, os.path.join(self.directory, name))
+        except:
+            if os.path.exists(temp):
+                os.remove(temp)
+            raise
+
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO artwork (poster_path, size, filename, bytes, last_access) VALUES (?, ?, ?, ?, ?)', (poster_path, self.image_size, name, size, time.time()))
+        self.log.debug("Downloaded artwork %s (%d bytes) to cache." % (url, size))
+        self.evict()
+        return os.path.join(self.directory, name)
+
+    def evict(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT filename, MAX(bytes), MAX(last_access) FROM artwork GROUP BY filename ORDER BY MAX(last_access)').fetchall()
+            total = sum(x[1] for x in rows)
+            cutoff = time.time() - self.EVICT_GRACE
+            for filename, size, last_access in rows:
+                if total <= self.max_bytes or last_access > cutoff:
+                    break
+                self._conn.execute('DELETE FROM artwork WHERE filename = ?', (filename,))
+                try:
+                    os.remove(os.path.join(self.directory, filename))
+                except OSError:
+                    pass
+                total -= size
+                self.log.debug("Evicted artwork %s from cache." % filename)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
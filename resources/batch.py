@@ -0,0 +1,165 @@
+import os
+import copy
+import threading
+import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from resources.mediaprocessor import MediaProcessor, JobClass
+
+
+class JobScheduler:
+    """
+    Limits how many conversions of each JobClass run at once. Classes
+    with a limit of 0 share the slots and the queue of CPU bound jobs.
+    """
+    def __init__(self, jobs=1, remux_jobs=0, device_jobs=0, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.limits = {
+            JobClass.CPU: max(1, jobs),
+            JobClass.IO: max(0, remux_jobs),
+            JobClass.DEVICE: max(0, device_jobs),
+        }
+        shared = threading.BoundedSemaphore(self.limits[JobClass.CPU])
+        self.slots = {k: threading.BoundedSemaphore(v) if v and k != JobClass.CPU else shared for k, v in self.limits.items()}
+        self.capacity = sum(self.limits.values())
+
+    def queue(self, jobclass):
+        return jobclass if self.limits.get(jobclass) else JobClass.CPU
+
+    # One worker pool per queue sized to its limit, a job waits only behind jobs of its own class
+    def executors(self, prefix='sma-job'):
+        return {k: ThreadPoolExecutor(max_workers=v, thread_name_prefix='%s-%s' % (prefix, k)) for k, v in self.limits.items() if v}
+
+    @contextmanager
+    def slot(self, jobclass):
+        semaphore = self.slots.get(jobclass, self.slots[JobClass.CPU])
+        self.log.debug("Waiting for a %s job slot." % jobclass)
+        semaphore.acquire()
+        try:
+            yield
+        finally:
+            semaphore.release()
+
+
+class BatchProcessor:
+    """
+    Runs a batch of files through a two stage pipeline. A pool of probe
+    workers validates sources ahead of time and hands valid files to a
+    bounded pool of job workers, so several ffmpeg jobs can run at once
+    while the next files are already being examined.
+
+    The probe workers also predict whether each file will be a remux, a
+    software encode or a hardware encode. When remux or device jobs have
+    their own limits the file is queued with the workers of its class, so
+    a remux starts while long software encodes hold every CPU slot.
+    """
+    PROGRESS_STEP = 10
+
+    def __init__(self, settings, jobs=None, probe_workers=None, remux_jobs=None, device_jobs=None, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.settings = settings
+        self.probe_workers = max(1, probe_workers or settings.batch_probe_workers)
+        self.scheduler = JobScheduler(jobs or settings.batch_jobs,
+                                      settings.batch_remux_jobs if remux_jobs is None else remux_jobs,
+                                      settings.batch_device_jobs if device_jobs is None else device_jobs,
+                                      logger=self.log)
+        self.jobs = self.scheduler.capacity
+        self._local = threading.local()
+
+    # Each worker thread gets its own MediaProcessor since processing keeps per file state
+    def getMediaProcessor(self):
+        mp = getattr(self._local, 'mp', None)
+        if not mp:
+            mp = MediaProcessor(copy.copy(self.settings), logger=self.log)
+            mp.scheduler = self.scheduler
+            self._local.mp = mp
+        return mp
+
+    def validate(self, path, rejected=None):
+        mp = self.getMediaProcessor()
+        try:
+            info = mp.isValidSource(path)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to validate %s." % path)
+            return None, None
+        if not info:
+            if rejected:
+                try:
+                    rejected(path, mp)
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    self.log.exception("Error handling invalid file %s." % path)
+            return None, None
+        try:
+            jobclass = mp.predictJobClass(info)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to classify %s, queueing as CPU bound." % path)
+            jobclass = JobClass.CPU
+        return info, jobclass
+
+    # Progress is logged per job in coarse steps since concurrent jobs can't share a progress bar
+    def progressOutput(self, number, path):
+        last = [-1]
+        name = os.path.basename(path)
+
+        def output(timecode, debug):
+            step = min(int(timecode), 100) // self.PROGRESS_STEP * self.PROGRESS_STEP
+            if step > last[0]:
+                last[0] = step
+                self.log.info("[Job %d] %s: %d%%." % (number, name, step))
+        return output
+
+    def runJob(self, handler, number, path, info):
+        self.log.info("[Job %d] Starting %s." % (number, path))
+        progressOutput = self.progressOutput(number, path) if self.jobs > 1 else None
+        handler(path, self.getMediaProcessor(), info, progressOutput)
+        self.log.info("[Job %d] Finished %s." % (number, path))
+
+    def run(self, paths, handler, rejected=None):
+        """
+        Validate each path and call handler(path, mp, info, progressOutput)
+        for every valid source on a job worker. If given, rejected(path, mp)
+        is called on the probe worker for every invalid source. Returns the
+        list of paths whose handler raised an exception.
+        """
+        self.log.info("Batch processing %d files with %d job worker(s) and %d probe worker(s)." % (len(paths), self.jobs, self.probe_workers))
+        errors = []
+        validations = []
+        jobs = []
+
+        probes = ThreadPoolExecutor(max_workers=self.probe_workers)
+        workers = self.scheduler.executors()
+        try:
+            validations = [(path, probes.submit(self.validate, path, rejected)) for path in paths]
+            for path, validation in validations:
+                info, jobclass = validation.result()
+                if not info:
+                    self.log.debug("Skipping invalid file %s." % path)
+                    continue
+                queue = self.scheduler.queue(jobclass)
+                self.log.debug("Queueing %s with %s jobs." % (path, queue))
+                jobs.append((path, workers[queue].submit(self.runJob, handler, len(jobs) + 1, path, info)))
+
+            for path, job in jobs:
+                try:
+                    job.result()
+                except KeyboardInterrupt:
+                    raise
+                except:
+                    self.log.exception("Error processing file %s." % path)
+                    errors.append(path)
+        except KeyboardInterrupt:
+            self.log.info("Batch interrupted, cancelling queued jobs.")
+            for _, future in validations + jobs:
+                future.cancel()
+            raise
+        finally:
+            probes.shutdown(wait=True)
+            for executor in workers.values():
+                executor.shutdown(wait=True)
+        return errors
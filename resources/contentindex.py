@@ -0,0 +1,81 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+from resources.archive import ProcessedArchive
+
+
+class ContentIndex:
+    """
+    Maps the content of source files to the outputs they were converted
+    to so the same content handed over again, through a hardlink or a copy
+    at another path, doesn't have to be converted twice.
+
+    A source is identified by its device and inode, which matches hardlinks
+    without reading the file, and by its size plus a hash of its first and
+    last block, which matches copies. Outputs are only reused for sources
+    converted with the same output settings (ReadSettings.OUTPUT_SETTINGS),
+    so settings that only decide where files end up don't matter.
+    """
+    DEFAULT_FILENAME = 'content.db'
+
+    def __init__(self, path, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+
+        if os.path.isdir(path):
+            path = os.path.join(path, self.DEFAULT_FILENAME)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS content (
+                              source TEXT PRIMARY KEY,
+                              device INTEGER NOT NULL,
+                              inode INTEGER NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              hash TEXT NOT NULL,
+                              fingerprint TEXT NOT NULL,
+                              output TEXT NOT NULL,
+                              added REAL NOT NULL)''')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS content_inode ON content (device, inode)')
+        self._conn.execute('CREATE INDEX IF NOT EXISTS content_hash ON content (size, hash)')
+
+    def identity(self, path, fingerprint):
+        """
+        Return the identity of a source file, used to look up and later
+        record its output. Taken before processing since the source may be
+        deleted by the time the output is known.
+        """
+        path = os.path.realpath(path)
+        st = os.stat(path)
+        return {'source': path, 'device': st.st_dev, 'inode': st.st_ino, 'size': st.st_size, 'mtime_ns': st.st_mtime_ns, 'hash': ProcessedArchive.fileHash(path, st.st_size), 'fingerprint': fingerprint}
+
+    def find(self, identity):
+        """
+        Return an existing output converted from the same content with the
+        same settings, or None.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT source, output FROM content WHERE fingerprint = ? AND ((device = ? AND inode = ? AND size = ? AND mtime_ns = ?) OR (size = ? AND hash = ?)) ORDER BY added DESC',
+                                      (identity['fingerprint'], identity['device'], identity['inode'], identity['size'], identity['mtime_ns'], identity['size'], identity['hash'])).fetchall()
+        for source, output in rows:
+            if os.path.isfile(output) and os.path.realpath(output) != identity['source']:
+                self.log.debug("%s has the same content as %s which was converted to %s." % (identity['source'], source, output))
+                return output
+        return None
+
+    def record(self, identity, output):
+        try:
+            with self._lock:
+                self._conn.execute('INSERT OR REPLACE INTO content (source, device, inode, size, mtime_ns, hash, fingerprint, output, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                                   (identity['source'], identity['device'], identity['inode'], identity['size'], identity['mtime_ns'], identity['hash'], identity['fingerprint'], os.path.realpath(output), time.time()))
+        except sqlite3.Error:
+            self.log.exception("Unable to update content index %s." % self.path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
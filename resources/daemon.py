@@ -0,0 +1,141 @@
+import json
+import enum
+import logging
+try:
+    from urllib.request import Request, urlopen
+    from urllib.error import URLError, HTTPError
+except ImportError:
+    from urllib2 import Request, urlopen, URLError, HTTPError
+
+
+class DaemonError(Exception):
+    pass
+
+
+# MediaProcessor methods that can be run by the daemon on behalf of a hook
+REMOTE_METHODS = ['fullprocess', 'process', 'isValidSource', 'isValidSubtitleSource', 'post']
+
+
+# Settings the hooks change before processing that the daemon accepts with a job, everything else comes from the daemon's own configuration
+OVERRIDABLE_SETTINGS = ['output_dir', 'delete', 'process_same_extensions', 'force_convert', 'tagfile', 'waitpostprocess', 'minimum_size']
+
+
+# Settings are sent with each job so the daemon processes with the same overrides as the hook
+def settingsSnapshot(settings, keys=None):
+    snapshot = {}
+    for k, v in vars(settings).items():
+        if k.startswith('_') or k == 'log':
+            continue
+        if keys is not None and k not in keys:
+            continue
+        try:
+            json.dumps(v)
+            snapshot[k] = v
+        except (TypeError, ValueError):
+            pass
+    return snapshot
+
+
+def encodeValue(value):
+    if isinstance(value, enum.Enum):
+        return {'__enum__': type(value).__name__, 'value': value.value}
+    return value
+
+
+class DaemonClient:
+    """
+    Minimal client for the SMA daemon job API. Only uses the standard
+    library so hooks don't pay for importing the processing stack.
+    """
+    POLL_INTERVAL = 5
+
+    def __init__(self, host='127.0.0.1', port=8585, apikey='', logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.baseURL = "http://%s:%d" % (host, int(port))
+        self.apikey = apikey
+
+    def request(self, path, payload=None, timeout=30):
+        headers = {'Content-Type': 'application/json', 'User-Agent': 'SMA - Daemon Client'}
+        if self.apikey:
+            headers['X-Api-Key'] = self.apikey
+        data = json.dumps(payload).encode('utf-8') if payload is not None else None
+        r = urlopen(Request(self.baseURL + path, data=data, headers=headers), timeout=timeout)
+        return json.loads(r.read().decode('utf-8'))
+
+    def available(self):
+        try:
+            self.request('/status', timeout=2)
+            return True
+        except (URLError, OSError, ValueError):
+            return False
+
+    def submit(self, method, args=[], kwargs={}, settings=None):
+        payload = {
+            'method': method,
+            'args': [encodeValue(x) for x in args],
+            'kwargs': {k: encodeValue(v) for k, v in kwargs.items()},
+            'settings': settingsSnapshot(settings, OVERRIDABLE_SETTINGS) if settings else None
+        }
+        try:
+            job = self.request('/jobs', payload)
+        except HTTPError as e:
+            try:
+                error = json.loads(e.read().decode('utf-8')).get('error')
+            except ValueError:
+                error = str(e)
+            raise DaemonError("Daemon refused %s job: %s" % (method, error))
+        self.log.debug("Submitted %s job %s to SMA daemon." % (method, job['id']))
+        return job
+
+    def wait(self, jobid, progressOutput=None):
+        while True:
+            job = self.request('/jobs/%s?wait=%d' % (jobid, self.POLL_INTERVAL), timeout=self.POLL_INTERVAL + 30)
+            if job['state'] == 'done':
+                return job
+            elif job['state'] == 'failed':
+                raise DaemonError("Daemon job %s failed: %s" % (jobid, job.get('error')))
+            elif progressOutput and job['state'] == 'running' and job.get('progress') is not None:
+                progressOutput(job['progress'], job.get('debug') or "")
+
+
+class RemoteMediaProcessor:
+    """
+    Stand-in for MediaProcessor that runs the processing methods in the
+    SMA daemon. Settings modified locally before a call are sent along
+    with the job and the output directory the daemon used is copied back.
+    """
+    def __init__(self, settings, client, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.settings = settings
+        self.client = client
+
+    def call(self, method, *args, **kwargs):
+        kwargs.pop('info', None)
+        progressOutput = kwargs.pop('progressOutput', None)
+        job = self.client.submit(method, args, kwargs, self.settings)
+        job = self.client.wait(job['id'], progressOutput if kwargs.get('reportProgress') else None)
+        # The hooks read the output directory after processing, same as with a local MediaProcessor
+        if job.get('output_dir'):
+            self.settings.output_dir = job['output_dir']
+        return job.get('result')
+
+    def __getattr__(self, name):
+        if name in REMOTE_METHODS:
+            return lambda *args, **kwargs: self.call(name, *args, **kwargs)
+        raise AttributeError(name)
+
+
+def getMediaProcessor(settings, logger=None):
+    """
+    Return a RemoteMediaProcessor when the daemon is enabled and running,
+    otherwise a local MediaProcessor.
+    """
+    log = logger or logging.getLogger(__name__)
+    if settings.Daemon.get('enabled'):
+        client = DaemonClient(settings.Daemon['host'], settings.Daemon['port'], settings.Daemon['apikey'], logger=log)
+        if client.available():
+            log.info("Using SMA daemon at %s." % client.baseURL)
+            return RemoteMediaProcessor(settings, client, logger=log)
+        log.warning("SMA daemon is enabled but not reachable at %s, processing locally." % client.baseURL)
+    from resources.mediaprocessor import MediaProcessor
+    return MediaProcessor(settings, logger=logger)
@@ -8,6 +8,8 @@ subtitle_codec_extensions = {'srt': 'srt',
                              'dvdsub': 'mks',
                              'dvb_subtitle': 'mks',
                              'dvd_subtitle': 'mks'}
+bitmap_subtitle_codecs = ['hdmv_pgs_subtitle', 'pgssub', 'pgs', 'dvd_subtitle', 'dvdsub', 'dvb_subtitle', 'dvbsub', 'xsub']
+text_subtitle_codecs = ['subrip', 'srt', 'ass', 'ssa', 'webvtt', 'mov_text', 'text', 'microdvd', 'subviewer', 'subviewer1', 'sami', 'realtext', 'mpl2', 'pjs', 'jacosub', 'stl', 'vplayer', 'eia_608', 'ttml', 'hdmv_text_subtitle']
 bad_post_files = ['resources', '.DS_Store']
 bad_post_extensions = ['.txt', '.log', '.pyc', '.md']
 bad_sub_extensions = ['txt', 'html', 'nfo', 'url', 'exe', 'md', 'py', 'pyc']
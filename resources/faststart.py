@@ -0,0 +1,139 @@
+import os
+import sys
+import mmap
+import struct
+import ctypes
+import logging
+
+# Boxes that lead from moov down to the chunk offset tables
+CONTAINERS = [b'moov', b'trak', b'mdia', b'minf', b'stbl']
+FALLOC_FL_INSERT_RANGE = 0x20
+
+
+class FastStartError(Exception):
+    pass
+
+
+def _boxes(buf, start, end):
+    pos = start
+    while pos + 8 <= end:
+        size, kind = struct.unpack_from('>I4s', buf, pos)
+        header = 8
+        if size == 1:
+            if pos + 16 > end:
+                raise FastStartError("Truncated %s box at %d" % (kind, pos))
+            size = struct.unpack_from('>Q', buf, pos + 8)[0]
+            header = 16
+        elif size == 0:
+            size = end - pos
+        if size < header or pos + size > end:
+            raise FastStartError("Invalid %s box size at %d" % (kind, pos))
+        yield kind, pos, size, header
+        pos += size
+
+
+def _patch(data, start, end, shift, after):
+    # Move every chunk offset that points at or beyond after by shift
+    for kind, pos, size, header in _boxes(data, start, end):
+        if kind in CONTAINERS:
+            _patch(data, pos + header, pos + size, shift, after)
+        elif kind == b'cmov':
+            raise FastStartError("Compressed moov boxes are not supported")
+        elif kind in [b'stco', b'co64']:
+            fmt = '>I' if kind == b'stco' else '>Q'
+            width = struct.calcsize(fmt)
+            count = struct.unpack_from('>I', data, pos + header + 4)[0]
+            table = pos + header + 8
+            if table + count * width > pos + size:
+                raise FastStartError("Invalid %s box at %d" % (kind, pos))
+            offsets = struct.unpack_from('>%d%s' % (count, fmt[1]), data, table)
+            offsets = [x + shift if x >= after else x for x in offsets]
+            if kind == b'stco' and offsets and max(offsets) > 0xFFFFFFFF:
+                raise FastStartError("Chunk offsets no longer fit in stco")
+            struct.pack_into('>%d%s' % (count, fmt[1]), data, table, *offsets)
+    return data
+
+
+def _free(size):
+    return struct.pack('>I4s', size, b'free') + bytes(size - 8)
+
+
+def _insertRange(fd, offset, length):
+    # fallocate(FALLOC_FL_INSERT_RANGE) shifts the tail of the file by remapping extents, no data is copied
+    if not sys.platform.startswith('linux'):
+        return False
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fallocate = getattr(libc, 'fallocate64', None) or libc.fallocate
+        fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        fallocate.restype = ctypes.c_int
+    except (OSError, AttributeError):
+        return False
+    return fallocate(fd, FALLOC_FL_INSERT_RANGE, offset, length) == 0
+
+
+def relocateMoov(path, logger=None):
+    """
+    Move the moov box of an MP4 file in front of its media data without
+    writing a second copy of the file. Returns True if the file was
+    changed and False if the moov box was already in front.
+
+    The chunk offsets in stco/co64 are patched in memory and the media data
+    is shifted in place. Where the filesystem supports it the shift is done
+    by inserting a block aligned range with fallocate, padded with a free
+    box, so only the first and last few blocks are written. Otherwise the
+    media data is moved through a memory map. Both are done in place, so
+    an interruption leaves a damaged file.
+
+    Raises FastStartError if the file can't be relocated this way, in which
+    case it hasn't been modified.
+    """
+    log = logger or logging.getLogger(__name__)
+
+    with open(path, 'r+b') as f:
+        fd = f.fileno()
+        st = os.fstat(fd)
+        if st.st_size < 16:
+            raise FastStartError("File is too small")
+
+        with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+            boxes = list(_boxes(mm, 0, st.st_size))
+            kinds = [x[0] for x in boxes]
+            if b'moov' not in kinds or b'mdat' not in kinds:
+                raise FastStartError("No moov or mdat box")
+            if b'moof' in kinds:
+                raise FastStartError("Fragmented files are not supported")
+            moov = boxes[kinds.index(b'moov')]
+            start = boxes[kinds.index(b'mdat')][1]
+            if moov[1] < start:
+                return False
+            _, position, length, header = moov
+            data = mm[position:position + length]
+            head = mm[start - start % (st.st_blksize or 4096):start]
+
+        last = position + length == st.st_size
+
+        # Block aligned insert, the padding becomes a free box behind moov
+        block = st.st_blksize or 4096
+        padding = -length % block
+        if 0 < padding < 8:
+            padding += block
+        patched = _patch(bytearray(data), header, length, length + padding, start)
+
+        if _insertRange(fd, start - len(head), length + padding):
+            log.debug("Inserted %d bytes at %d with fallocate." % (length + padding, start - len(head)))
+            os.pwrite(fd, bytes(head) + bytes(patched) + (_free(padding) if padding else b''), start - len(head))
+            if last:
+                os.ftruncate(fd, position + length + padding)
+            else:
+                os.pwrite(fd, b'free', position + length + padding + 4)
+            os.fsync(fd)
+            return True
+
+        patched = _patch(bytearray(data), header, length, length, start)
+        with mmap.mmap(fd, 0) as mm:
+            mm.move(start + length, start, position - start)
+            mm[start:start + length] = bytes(patched)
+            mm.flush()
+        log.debug("Moved %d bytes of media data in place." % (position - start))
+        return True
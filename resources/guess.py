@@ -0,0 +1,106 @@
+import copy
+import time
+import threading
+import logging
+import tmdbsimple as tmdb
+from collections import OrderedDict
+from resources.extensions import tmdb_api_key
+try:
+    from guessit import guessit
+except ImportError:
+    guessit = None
+
+log = logging.getLogger(__name__)
+
+GUESS_ENTRIES = 2048
+# Same as the TTL of /search/ responses in TMDBSession
+SEARCH_TTL = 24 * 3600
+
+_guesses = OrderedDict()
+_guessLock = threading.Lock()
+_searches = {}
+_searchLocks = {}
+_searchLock = threading.Lock()
+
+
+def guessFile(path, options=None):
+    """
+    guessit with an LRU memo. The same path is parsed for metadata,
+    subtitle downloads and the original release info, each parse costing
+    tens of milliseconds of regex work. Callers get a copy they are free
+    to modify.
+    """
+    key = (path, tuple(sorted((options or {}).items())))
+    with _guessLock:
+        guess = _guesses.get(key)
+        if guess is not None:
+            _guesses.move_to_end(key)
+    if guess is None:
+        guess = guessit(path, options)
+        with _guessLock:
+            _guesses[key] = guess
+            while len(_guesses) > GUESS_ENTRIES:
+                _guesses.popitem(last=False)
+    return copy.copy(guess)
+
+
+def _search(kind, title, year):
+    tmdb.API_KEY = tmdb_api_key
+    search = tmdb.Search()
+    if kind == 'movie':
+        if year:
+            search.movie(query=title, year=year)
+        if not year or len(search.results) < 1:
+            search.movie(query=title)
+    else:
+        if year:
+            search.tv(query=title, first_air_date_year=year)
+        if not year or len(search.results) < 1:
+            search.tv(query=title)
+    return search.results[0]['id'] if search.results else None
+
+
+def _cachedSearch(key):
+    with _searchLock:
+        entry = _searches.get(key)
+        if entry and entry[1] > time.time():
+            return entry[0]
+        _searches.pop(key, None)
+    return None
+
+
+def searchTMDB(kind, title, year=None):
+    """
+    Return the TMDB id of the first search result for a movie or tv title,
+    or None. Matches are kept for SEARCH_TTL so every file of a show in a
+    batch resolves the show once. Concurrent searches for the same title
+    wait for the first one. Searches that fail or find nothing aren't kept
+    so a title added to TMDB later is found by the next search.
+    """
+    key = (kind, title.lower(), year)
+    tmdbid = _cachedSearch(key)
+    if tmdbid:
+        return tmdbid
+    with _searchLock:
+        lock = _searchLocks.setdefault(key, threading.Lock())
+    with lock:
+        tmdbid = _cachedSearch(key)
+        if tmdbid:
+            return tmdbid
+        try:
+            tmdbid = _search(kind, title, year)
+            if tmdbid:
+                with _searchLock:
+                    _searches[key] = (tmdbid, time.time() + SEARCH_TTL)
+        finally:
+            with _searchLock:
+                _searchLocks.pop(key, None)
+        log.debug("TMDB %s search for %s (%s) resulted in TMDB ID %s." % (kind, title, year, tmdbid))
+        return tmdbid
+
+
+def clearCaches():
+    with _guessLock:
+        _guesses.clear()
+    with _searchLock:
+        _searches.clear()
@@ -0,0 +1,236 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+import logging
+
+
+class JobState:
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+
+class JobQueue:
+    """
+    Durable job table backed by SQLite. Jobs keep their arguments, the
+    settings they were submitted with, the ffmpeg command and the paths
+    touched while converting so an interrupted job can be rolled back and
+    retried after a restart.
+    """
+    RETRY_DELAY = 60
+    MAX_RETRY_DELAY = 3600
+    MEDIA_IDS = ['tmdbid', 'tvdbid', 'imdbid', 'season', 'episode']
+    JOURNAL_FIELDS = ['cmd', 'original', 'temp']
+    # Columns added after the first release, created on databases that don't have them yet
+    ADDED_COLUMNS = ['jobclass', 'output_dir']
+
+    def __init__(self, path, max_attempts=3, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.path = path
+        self.max_attempts = max(1, max_attempts)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                              id INTEGER PRIMARY KEY AUTOINCREMENT,
+                              method TEXT NOT NULL,
+                              input TEXT,
+                              mediatype TEXT,
+                              tmdbid TEXT,
+                              tvdbid TEXT,
+                              imdbid TEXT,
+                              season TEXT,
+                              episode TEXT,
+                              args TEXT,
+                              kwargs TEXT,
+                              settings TEXT,
+                              state TEXT NOT NULL,
+                              attempts INTEGER NOT NULL DEFAULT 0,
+                              cmd TEXT,
+                              original TEXT,
+                              temp TEXT,
+                              result TEXT,
+                              error TEXT,
+                              created REAL NOT NULL,
+                              updated REAL NOT NULL,
+                              started REAL,
+                              finished REAL,
+                              next_attempt REAL NOT NULL DEFAULT 0,
+                              jobclass TEXT,
+                              output_dir TEXT)''')
+        columns = [r['name'] for r in self._conn.execute('PRAGMA table_info(jobs)').fetchall()]
+        for column in self.ADDED_COLUMNS:
+            if column not in columns:
+                self._conn.execute('ALTER TABLE jobs ADD COLUMN %s TEXT' % column)
+        self._conn.execute('CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, next_attempt)')
+
+    def add(self, method, args=[], kwargs={}, settings=None, jobclass=None):
+        """
+        Queue a job and return its id. Arguments must already be JSON
+        serializable. The job class decides which worker slots it waits for.
+        """
+        now = time.time()
+        mediatype = args[1] if method == 'fullprocess' and len(args) > 1 else kwargs.get('mediatype')
+        if isinstance(mediatype, dict):
+            mediatype = mediatype.get('value')
+        row = {
+            'method': method,
+            'input': args[0] if args else kwargs.get('inputfile'),
+            'mediatype': mediatype,
+            'args': json.dumps(args),
+            'kwargs': json.dumps(kwargs),
+            'settings': json.dumps(settings) if settings else None,
+            'state': JobState.QUEUED,
+            'jobclass': jobclass,
+            'created': now,
+            'updated': now,
+        }
+        for key in self.MEDIA_IDS:
+            row[key] = str(kwargs[key]) if kwargs.get(key) is not None else None
+        with self._lock:
+            cursor = self._conn.execute('INSERT INTO jobs (%s) VALUES (%s)' % (', '.join(row.keys()), ', '.join('?' * len(row))), list(row.values()))
+            return cursor.lastrowid
+
+    def get(self, jobid):
+        with self._lock:
+            row = self._conn.execute('SELECT * FROM jobs WHERE id = ?', (jobid,)).fetchone()
+        return self.decode(row) if row else None
+
+    @staticmethod
+    def decode(row):
+        job = dict(row)
+        for key in ['args', 'kwargs', 'settings', 'result']:
+            job[key] = json.loads(job[key]) if job[key] else None
+        return job
+
+    @staticmethod
+    def _classFilter(classes, default):
+        if classes is None:
+            return '', []
+        return ' AND COALESCE(jobclass, ?) IN (%s)' % ', '.join('?' * len(classes)), [default] + list(classes)
+
+    def claim(self, classes=None, default=None):
+        """
+        Mark the oldest due job of one of the given classes as running and
+        return it, or None. Jobs without a class count as default. The
+        attempt is only counted once the job is started.
+        """
+        now = time.time()
+        where, params = self._classFilter(classes, default)
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                row = self._conn.execute('SELECT * FROM jobs WHERE state = ? AND next_attempt <= ?%s ORDER BY id LIMIT 1' % where, [JobState.QUEUED, now] + params).fetchone()
+                if row:
+                    self._conn.execute('UPDATE jobs SET state = ?, started = NULL, updated = ? WHERE id = ?', (JobState.RUNNING, now, row['id']))
+                self._conn.execute('COMMIT')
+            except:
+                self._conn.execute('ROLLBACK')
+                raise
+        if not row:
+            return None
+        job = self.decode(row)
+        job['state'] = JobState.RUNNING
+        job['started'] = None
+        return job
+
+    def start(self, jobid):
+        """
+        Count an attempt for a claimed job that a worker is starting and
+        return the attempt number.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET attempts = attempts + 1, started = ?, updated = ? WHERE id = ?', (now, now, jobid))
+            return self._conn.execute('SELECT attempts FROM jobs WHERE id = ?', (jobid,)).fetchone()[0]
+
+    def nextDue(self, classes=None, default=None):
+        """
+        Seconds until the next queued job of the given classes is due, or
+        None if nothing is queued.
+        """
+        where, params = self._classFilter(classes, default)
+        with self._lock:
+            row = self._conn.execute('SELECT MIN(next_attempt) FROM jobs WHERE state = ?%s' % where, [JobState.QUEUED] + params).fetchone()
+        if row[0] is None:
+            return None
+        return max(0, row[0] - time.time())
+
+    def journal(self, jobid, **fields):
+        """
+        Record the ffmpeg command and the paths being written or renamed by
+        a running job.
+        """
+        fields = {k: v for k, v in fields.items() if k in self.JOURNAL_FIELDS}
+        if not fields:
+            return
+        fields['updated'] = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET %s WHERE id = ?' % ', '.join('%s = ?' % k for k in fields), list(fields.values()) + [jobid])
+
+    def complete(self, jobid, result, output_dir=None):
+        """
+        Mark a job as done with its result and the output directory it was
+        processed to.
+        """
+        now = time.time()
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET state = ?, result = ?, output_dir = ?, error = NULL, temp = NULL, finished = ?, updated = ? WHERE id = ?', (JobState.DONE, json.dumps(result), output_dir, now, now, jobid))
+
+    def fail(self, jobid, error):
+        """
+        Record a failed attempt, requeueing the job with an exponential
+        backoff until it runs out of attempts. Returns the new state.
+        """
+        job = self.get(jobid)
+        now = time.time()
+        if job and job['attempts'] < self.max_attempts:
+            delay = min(self.RETRY_DELAY * 2 ** (job['attempts'] - 1), self.MAX_RETRY_DELAY)
+            self.log.info("Job %d failed attempt %d of %d, retrying in %d seconds." % (jobid, job['attempts'], self.max_attempts, delay))
+            with self._lock:
+                self._conn.execute('UPDATE jobs SET state = ?, error = ?, next_attempt = ?, updated = ? WHERE id = ?', (JobState.QUEUED, error, now + delay, now, jobid))
+            return JobState.QUEUED
+        with self._lock:
+            self._conn.execute('UPDATE jobs SET state = ?, error = ?, finished = ?, updated = ? WHERE id = ?', (JobState.FAILED, error, now, now, jobid))
+        return JobState.FAILED
+
+    def recover(self):
+        """
+        Roll back jobs left running by a previous process. Partial temp
+        output is removed, a renamed original is moved back to its input
+        path and the job is queued again. Jobs that were claimed but never
+        started are queued again without counting an attempt.
+        """
+        with self._lock:
+            rows = self._conn.execute('SELECT * FROM jobs WHERE state = ?', (JobState.RUNNING,)).fetchall()
+        for row in rows:
+            if not row['started']:
+                with self._lock:
+                    self._conn.execute('UPDATE jobs SET state = ?, updated = ? WHERE id = ?', (JobState.QUEUED, time.time(), row['id']))
+                continue
+            self.log.info("Recovering interrupted job %d for %s." % (row['id'], row['input']))
+            if row['temp'] and os.path.isfile(row['temp']):
+                try:
+                    os.remove(row['temp'])
+                    self.log.info("Removed partial output %s." % row['temp'])
+                except OSError:
+                    self.log.exception("Unable to remove partial output %s." % row['temp'])
+            if row['original'] and row['input'] and os.path.isfile(row['original']) and not os.path.exists(row['input']):
+                try:
+                    os.rename(row['original'], row['input'])
+                    self.log.info("Restored %s to %s." % (row['original'], row['input']))
+                except OSError:
+                    self.log.exception("Unable to restore %s to %s." % (row['original'], row['input']))
+            with self._lock:
+                self._conn.execute('UPDATE jobs SET cmd = NULL, original = NULL, temp = NULL WHERE id = ?', (row['id'],))
+            self.fail(row['id'], "Interrupted")
+        return len(rows)
+
+    def counts(self):
+        with self._lock:
+            rows = self._conn.execute('SELECT state, COUNT(*) FROM jobs GROUP BY state').fetchall()
+        return {r[0]: r[1] for r in rows}
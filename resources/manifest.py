@@ -0,0 +1,110 @@
+import os
+import time
+import sqlite3
+import threading
+import logging
+
+
+class ScanDecision:
+    PROCESSED = 'processed'
+    BYPASSED = 'bypassed'
+    INVALID = 'invalid'
+    ERROR = 'error'
+
+    # Decisions that will be the same next time as long as neither the file nor the settings change
+    FINAL = [PROCESSED, BYPASSED, INVALID]
+
+
+class ScanManifest:
+    """
+    Remembers the outcome of the last scan for every file in a library so
+    incremental scans can skip files that haven't changed before they are
+    probed. Entries are grouped by directory and loaded one directory at a
+    time while walking the tree.
+
+    An entry is only reused while the size, modification time and inode of
+    the file and the fingerprint of the settings it was scanned with still
+    match.
+    """
+    DEFAULT_FILENAME = 'scan.db'
+
+    def __init__(self, path, settings, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+
+        if os.path.isdir(path):
+            path = os.path.join(path, self.DEFAULT_FILENAME)
+
+        self.path = path
+        self.fingerprint = settings.fingerprint(settings.SCAN_SETTINGS)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('''CREATE TABLE IF NOT EXISTS manifest (
+                              directory TEXT NOT NULL,
+                              name TEXT NOT NULL,
+                              size INTEGER NOT NULL,
+                              mtime_ns INTEGER NOT NULL,
+                              inode INTEGER NOT NULL,
+                              fingerprint TEXT NOT NULL,
+                              decision TEXT NOT NULL,
+                              reason TEXT,
+                              updated REAL NOT NULL,
+                              PRIMARY KEY (directory, name))''')
+
+    def load(self, directory):
+        """
+        Return the manifest entries for a directory as a dict of file name
+        to (size, mtime_ns, inode, fingerprint, decision, reason).
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            rows = self._conn.execute('SELECT name, size, mtime_ns, inode, fingerprint, decision, reason FROM manifest WHERE directory = ?', (directory,)).fetchall()
+        return {r[0]: r[1:] for r in rows}
+
+    def unchanged(self, entry, path):
+        """
+        Return the (decision, reason) of the previous scan if the file hasn't
+        changed since and the decision still holds, otherwise None.
+        """
+        if not entry:
+            return None
+        size, mtime_ns, inode, fingerprint, decision, reason = entry
+        if decision not in ScanDecision.FINAL or fingerprint != self.fingerprint:
+            return None
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        if st.st_size != size or st.st_mtime_ns != mtime_ns or st.st_ino != inode:
+            return None
+        return decision, reason
+
+    def record(self, files, decision, reason=None):
+        """
+        Store the decision made for one or more files.
+        """
+        if isinstance(files, str):
+            files = [files]
+        now = time.time()
+        rows = []
+        for path in files:
+            # Keyed by the path as walked, a symlink is stored under its own name and compared by the stat of its target
+            try:
+                path = os.path.abspath(path)
+                st = os.stat(path)
+            except OSError:
+                continue
+            directory, name = os.path.split(path)
+            rows.append((directory, name, st.st_size, st.st_mtime_ns, st.st_ino, self.fingerprint, decision, reason, now))
+        if not rows:
+            return
+        try:
+            with self._lock:
+                self._conn.executemany('INSERT OR REPLACE INTO manifest (directory, name, size, mtime_ns, inode, fingerprint, decision, reason, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+        except sqlite3.Error:
+            self.log.exception("Unable to update scan manifest %s." % self.path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -6,9 +6,19 @@ import sys
 import shutil
 import logging
 import re
-from converter import Converter, FFMpegConvertError, ConverterError
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from converter import Converter, FFMpegConvertError, ConverterError, ProbeCache
 from converter.avcodecs import BaseCodec
-from resources.extensions import subtitle_codec_extensions, bad_sub_extensions
+from resources.sidecar import SidecarIndex
+from resources import faststart
+from resources.replicate import Replicator
+from resources.contentindex import ContentIndex
+from resources.readsettings import DuplicateAction
+from resources.tmdbcache import TMDBSession
+from resources.artworkcache import ArtworkCache
+from resources.guess import guessFile
+from resources.extensions import subtitle_codec_extensions, bad_sub_extensions, bitmap_subtitle_codecs, text_subtitle_codecs
 from resources.metadata import Metadata, MediaType
 from resources.postprocess import PostProcessor
 from resources.lang import getAlpha3TCode
@@ -34,14 +44,159 @@ except ImportError:
 from resources.custom import *
 
 
+class JobClass:
+    IO = 'io'
+    CPU = 'cpu'
+    DEVICE = 'device'
+
+
 class MediaProcessor:
     default_channel_bitrate = 128
 
     def __init__(self, settings, logger=None):
         self.log = logger or logging.getLogger(__name__)
         self.settings = settings
-        self.converter = Converter(settings.ffmpeg, settings.ffprobe)
+        self.converter = Converter(settings.ffmpeg, settings.ffprobe, cache=self.getProbeCache())
         self.deletesubs = set()
+        self.output_dir = settings.output_dir
+        self.partial_output = False
+        self.scheduler = None
+        self.journal = None
+        self.invalid_reason = None
+        self.invalid_final = False
+        self.bypass_reason = None
+        self.image_subtitles = {}
+        self.sidecars = SidecarIndex(logger=self.log)
+        self.contentindex = None
+        self.executor = None
+        self.getTMDBSession()
+        self.getArtworkCache()
+
+    def getProbeCache(self):
+        if not self.settings.cache_dir:
+            return None
+        try:
+            return ProbeCache(self.settings.cache_dir, self.settings.cache_probe_entries, logger=self.log)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to open probe cache in %s, continuing without it." % self.settings.cache_dir)
+            return None
+
+    def metadataExecutor(self):
+        if not self.executor:
+            self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='sma-metadata')
+        return self.executor
+
+    # Build metadata and download artwork, run in the background while the file is converted
+    def fetchMetadata(self, mediatype, inputfile, **kwargs):
+        tagdata = Metadata(mediatype, **kwargs)
+        if self.settings.tagfile and self.settings.artwork:
+            try:
+                tagdata.getArtwork(inputfile, inputfile, thumbnail=self.settings.thumbnail)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.log.exception("Unable to prefetch artwork.")
+        return tagdata
+
+    def joinMetadata(self, future):
+        try:
+            return future.result()
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to get metadata.")
+            return None
+
+    # Metadata has to be resolved before generating options when settings or custom functions use it, otherwise it can wait for the encode
+    def metadataNeededForOptions(self):
+        # The original language only changes options when languages are restricted
+        if (self.settings.audio_original_language and self.settings.awl) or (self.settings.subtitle_original_language and self.settings.swl) or self.settings.downloadsubs:
+            return True
+        if self.settings.single_pass_tagging and self.settings.tagfile:
+            return True
+        if any(k.startswith('original-language') for k in self.settings.audio_sorting + self.settings.audio_sorting_default + self.settings.sub_sorting + self.settings.burn_sorting):
+            return True
+        return any([validation, skipStream, skipUA, streamTitle])
+
+    # Share one pooled and cached session between all TMDB requests made in this process [tmdb-cache]
+    def getTMDBSession(self):
+        if not self.settings.tmdb_cache:
+            return None
+        try:
+            return TMDBSession.install(self.settings.cache_dir or None, logger=self.log)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to open TMDB cache in %s, continuing without it [tmdb-cache]." % self.settings.cache_dir)
+            return None
+
+    # Keep downloaded artwork between files and runs, in the cache directory when one is set [artwork-max-size]
+    def getArtworkCache(self):
+        directory = os.path.join(self.settings.cache_dir, 'artwork') if self.settings.cache_dir else ArtworkCache.defaultDirectory()
+        try:
+            return ArtworkCache.install(directory, self.settings.artwork_max_size * 1024 * 1024, self.settings.artwork_size, logger=self.log)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to open artwork cache in %s [artwork-max-size]." % directory)
+            return None
+
+    def getContentIndex(self):
+        if self.settings.duplicate_content not in DuplicateAction.choices():
+            return None
+        if not self.contentindex:
+            path = self.settings.cache_dir or os.path.dirname(self.settings._configFile)
+            try:
+                self.contentindex = ContentIndex(path, logger=self.log)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.log.exception("Unable to open content index in %s, continuing without it [duplicate-content]." % path)
+                return None
+        return self.contentindex
+
+    # Identify the content of a source and look for an output already converted from it, the identity is kept to record this job's output [duplicate-content]
+    def findDuplicateContent(self, inputfile):
+        index = self.getContentIndex()
+        if not index:
+            return None, None
+        try:
+            identity = index.identity(inputfile, self.settings.fingerprint())
+            return identity, index.find(identity)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to check content index for %s [duplicate-content]." % inputfile)
+            return None, None
+
+    def recordContent(self, identity, outputfile):
+        index = self.getContentIndex()
+        if index and identity and outputfile:
+            index.record(identity, outputfile)
+
+    # Bypass or place a copy of an output previously converted from the same content, returns outputfile, bypassed and tagged [duplicate-content]
+    def reuseDuplicate(self, inputfile, duplicate):
+        if self.settings.duplicate_content == DuplicateAction.SKIP:
+            self.log.info("Content of %s was already converted to %s, bypassing conversion [duplicate-content: skip]." % (inputfile, duplicate))
+            self.bypass_reason = "content already converted [duplicate-content]"
+            return inputfile, True, False
+
+        input_dir, filename, input_extension = self.parseFile(inputfile)
+        outputfile, _ = self.getOutputFile(input_dir, filename, input_extension)
+        if os.path.abspath(outputfile) == os.path.abspath(inputfile):
+            self.log.debug("Output file would replace the input file, converting instead of reusing %s [duplicate-content]." % duplicate)
+            return None, False, False
+        try:
+            method = Replicator(hardlink=self.settings.copy_hardlink, logger=self.log).copy(duplicate, outputfile)
+            self.log.info("Content of %s was already converted, reusing %s as %s using %s [duplicate-content: reuse]." % (inputfile, duplicate, outputfile, method))
+            return outputfile, False, True
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to reuse %s, converting instead [duplicate-content]." % duplicate)
+            return None, False, False
 
     def fullprocess(self, inputfile, mediatype, reportProgress=False, original=None, info=None, tmdbid=None, tvdbid=None, imdbid=None, season=None, episode=None, language=None, tagdata=None, post=True):
         try:
@@ -49,24 +204,29 @@ class MediaProcessor:
             if info:
                 self.log.info("Processing %s." % inputfile)
 
-                try:
-                    tagdata = tagdata or Metadata(mediatype, tvdbid=tvdbid, tmdbid=tmdbid, imdbid=imdbid, season=season, episode=episode, original=original, language=language)
-                    tmdbid = tagdata.tmdbid
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    self.log.exception("Unable to get metadata.")
-                    tagdata = None
+                deferred = None
+                if not tagdata:
+                    deferred = self.metadataExecutor().submit(self.fetchMetadata, mediatype, inputfile, tvdbid=tvdbid, tmdbid=tmdbid, imdbid=imdbid, season=season, episode=episode, original=original, language=language)
+                    if self.metadataNeededForOptions():
+                        tagdata = self.joinMetadata(deferred)
+                        deferred = None
+                    else:
+                        self.log.debug("Resolving metadata in the background during conversion.")
+                tmdbid = tagdata.tmdbid if tagdata else tmdbid
+
+                output = self.process(inputfile, original=original, info=info, tagdata=tagdata, reportProgress=reportProgress, destination=self.settings.moveto or os.path.dirname(inputfile))
 
-                output = self.process(inputfile, original=original, info=info, tagdata=tagdata, reportProgress=reportProgress)
+                if deferred:
+                    tagdata = self.joinMetadata(deferred)
+                    tmdbid = tagdata.tmdbid if tagdata else tmdbid
 
                 if output:
                     if not language:
-                        language = self.settings.taglanguage or self.getDefaultAudioLanguage(output["options"]) or None
+                        language = self.settings.taglanguage or (output["options"] and self.getDefaultAudioLanguage(output["options"])) or None
                     self.log.debug("Tag language setting is %s, using language %s for tagging." % (self.settings.taglanguage or None, language))
                     # Tag with metadata
                     tagfailed = False
-                    if self.settings.tagfile and tagdata:
+                    if self.settings.tagfile and tagdata and not output['tagged']:
                         try:
                             self.log.info("Tagging %s with TMDB ID %s." % (inputfile, tagdata.tmdbid))
                             tagdata.writeTags(output['output'], inputfile, self.converter, self.settings.artwork, self.settings.thumbnail, output['x'], output['y'], cues_to_front=output['cues_to_front'])
@@ -75,9 +235,10 @@ class MediaProcessor:
                         except:
                             self.log.exception("Unable to tag file")
                             tagfailed = True
+                        self.converter.invalidate(output['output'])
 
                     # QTFS
-                    if self.settings.relocate_moov and not tagfailed:
+                    if self.settings.relocate_moov and not tagfailed and not output['tagged']:
                         self.QTFS(output['output'])
 
                     # Reverse Ouput
@@ -87,6 +248,8 @@ class MediaProcessor:
 
                     # Copy to additional locations
                     output_files = self.replicate(output['output'])
+                    if not output['bypassed']:
+                        self.recordContent(output['content'], output_files[0])
                     for sub in [x for x in output['external_subs'] if os.path.exists(x)]:
                         output_files.extend(self.replicate(sub))
 
@@ -132,7 +295,7 @@ class MediaProcessor:
                 self.log.exception("Error refreshing Plex.")
 
     # Process a file from start to finish, with checking to make sure formats are compatible with selected settings
-    def process(self, inputfile, reportProgress=False, original=None, info=None, progressOutput=None, tagdata=None):
+    def process(self, inputfile, reportProgress=False, original=None, info=None, progressOutput=None, tagdata=None, destination=None):
         self.log.debug("Process started.")
 
         delete = self.settings.delete
@@ -143,55 +306,73 @@ class MediaProcessor:
         outputfile = None
         ripped_subs = []
         downloaded_subs = []
+        bypassed = False
+        tagged = False
+        content = None
 
         info = info or self.isValidSource(inputfile, tagdata=tagdata)
 
-        self.settings.output_dir = self.settings.output_dir if self.outputDirHasFreeSpace(inputfile) else None
+        self.output_dir = self.planOutputDirectory(inputfile, destination)
+        # Output written straight into the destination gets a hidden name until it is complete
+        self.partial_output = bool(destination and self.output_dir and os.path.abspath(self.output_dir) == os.path.abspath(destination))
+        if not destination:
+            # Downloader scripts read settings.output_dir after processing to find the output, it is cleared when the output directory lacks free space
+            self.settings.output_dir = self.output_dir
 
         if info:
-            try:
-                options, preopts, postopts, ripsubopts, downloaded_subs = self.generateOptions(inputfile, info=info, original=original, tagdata=tagdata)
-            except KeyboardInterrupt:
-                raise
-            except:
-                self.log.exception("Unable to generate options, unexpected exception occurred.")
-                return None
-            if self.canBypassConvert(inputfile, info, options):
-                outputfile = inputfile
-                self.log.info("Bypassing conversion and setting outputfile to inputfile.")
-            else:
-                if not options:
-                    self.log.error("Error converting, inputfile %s had a valid extension but returned no data. Either the file does not exist, was unreadable, or was an incorrect format." % inputfile)
-                    return None
-
-                try:
-                    self.log.info("Output Data")
-                    self.log.info(json.dumps(options, sort_keys=False, indent=4))
-                    self.log.info("Preopts")
-                    self.log.info(json.dumps(preopts, sort_keys=False, indent=4))
-                    self.log.info("Postopts")
-                    self.log.info(json.dumps(postopts, sort_keys=False, indent=4))
-                    if not self.settings.embedsubs:
-                        self.log.info("Subtitle Extracts")
-                        self.log.info(json.dumps(ripsubopts, sort_keys=False, indent=4))
-                    if self.settings.downloadsubs:
-                        self.log.info("Downloaded Subtitles")
-                        self.log.info(json.dumps(downloaded_subs, sort_keys=False, indent=4))
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    self.log.exception("Unable to log options.")
+            content, duplicate = self.findDuplicateContent(inputfile)
+            if duplicate:
+                outputfile, bypassed, tagged = self.reuseDuplicate(inputfile, duplicate)
 
-                ripped_subs = self.ripSubs(inputfile, ripsubopts)
-                for rs in ripped_subs:
-                    self.cleanExternalSub(rs)
+            if not outputfile:
                 try:
-                    outputfile, inputfile = self.convert(options, preopts, postopts, reportProgress, progressOutput)
+                    options, preopts, postopts, ripsubopts, downloaded_subs = self.generateOptions(inputfile, info=info, original=original, tagdata=tagdata)
                 except KeyboardInterrupt:
                     raise
                 except:
-                    self.log.exception("Unexpected exception encountered during conversion")
+                    self.log.exception("Unable to generate options, unexpected exception occurred.")
                     return None
+                if self.canBypassConvert(inputfile, info, options):
+                    outputfile = inputfile
+                    bypassed = True
+                    self.log.info("Bypassing conversion and setting outputfile to inputfile.")
+                else:
+                    if not options:
+                        self.log.error("Error converting, inputfile %s had a valid extension but returned no data. Either the file does not exist, was unreadable, or was an incorrect format." % inputfile)
+                        return None
+
+                    if self.settings.single_pass_tagging and self.settings.tagfile and tagdata:
+                        tagged = self.singlePassTags(inputfile, info, options, postopts, tagdata)
+
+                    try:
+                        self.log.info("Output Data")
+                        self.log.info(json.dumps(options, sort_keys=False, indent=4))
+                        self.log.info("Preopts")
+                        self.log.info(json.dumps(preopts, sort_keys=False, indent=4))
+                        self.log.info("Postopts")
+                        self.log.info(json.dumps(postopts, sort_keys=False, indent=4))
+                        if not self.settings.embedsubs:
+                            self.log.info("Subtitle Extracts")
+                            self.log.info(json.dumps(ripsubopts, sort_keys=False, indent=4))
+                        if self.settings.downloadsubs:
+                            self.log.info("Downloaded Subtitles")
+                            self.log.info(json.dumps(downloaded_subs, sort_keys=False, indent=4))
+                    except KeyboardInterrupt:
+                        raise
+                    except:
+                        self.log.exception("Unable to log options.")
+
+                    with self.jobSlot(options):
+                        ripped_subs = self.ripSubs(inputfile, ripsubopts)
+                        for rs in ripped_subs:
+                            self.cleanExternalSub(rs)
+                        try:
+                            outputfile, inputfile = self.convert(options, preopts, postopts, reportProgress, progressOutput, info=info)
+                        except KeyboardInterrupt:
+                            raise
+                        except:
+                            self.log.exception("Unexpected exception encountered during conversion")
+                            return None
 
             if not outputfile:
                 self.log.debug("Error converting, no outputfile generated for inputfile %s." % inputfile)
@@ -200,11 +381,11 @@ class MediaProcessor:
             self.log.debug("%s created from %s successfully." % (outputfile, inputfile))
 
             if outputfile == inputfile:
-                if self.settings.output_dir:
+                if self.output_dir:
                     try:
-                        outputfile = os.path.join(self.settings.output_dir, os.path.split(inputfile)[1])
+                        outputfile = os.path.join(self.output_dir, os.path.split(inputfile)[1])
                         self.log.debug("Outputfile set to %s." % outputfile)
-                        shutil.copy(inputfile, outputfile)
+                        Replicator(logger=self.log).copy(inputfile, outputfile)
                     except KeyboardInterrupt:
                         raise
                     except:
@@ -238,6 +419,7 @@ class MediaProcessor:
             return {'input': inputfile,
                     'input_extension': input_extension,
                     'input_deleted': deleted,
+                    'bypassed': bypassed,
                     'output': outputfile,
                     'output_extension': output_extension,
                     'options': options,
@@ -247,9 +429,111 @@ class MediaProcessor:
                     'x': dim['x'],
                     'y': dim['y'],
                     'cues_to_front': cues_to_front,
+                    'tagged': tagged,
+                    'content': content,
                     }
         return None
 
+    # Write tags, cover art and moov/cues relocation as part of the main encode so the output isn't rewritten after conversion [single-pass-tagging]
+    def singlePassTags(self, inputfile, info, options, postopts, tagdata):
+        output_format = options.get('format')
+        if output_format not in ['mp4', 'mov', 'mkv']:
+            self.log.debug("Single pass tagging is not supported for format %s, tagging after conversion [single-pass-tagging]." % output_format)
+            return False
+        mp4 = output_format in ['mp4', 'mov']
+
+        try:
+            width = options['video'].get('width') or info.video.video_width
+            height = info.video.video_height
+            if width != info.video.video_width and info.video.video_width:
+                height = int(height * width / info.video.video_width)
+            tagdata.setHD(width, height)
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to set HD tag.")
+
+        try:
+            metadata = tagdata.getFFMpegTags(mp4, inputfile)
+            coverpath = tagdata.getArtwork(inputfile, inputfile, thumbnail=self.settings.thumbnail) if self.settings.artwork else None
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to resolve metadata for single pass tagging, tagging after conversion [single-pass-tagging].")
+            return False
+
+        for k in metadata:
+            if metadata[k] is not None:
+                postopts.extend(['-metadata', "%s=%s" % (k, metadata[k])])
+
+        if coverpath:
+            if mp4:
+                # MP4 has no attachments, the cover is muxed as an attached picture video stream
+                options['source'].append(coverpath)
+                v = 1 if options.get('video') else 0
+                postopts.extend(['-map', '%d:0' % (len(options['source']) - 1), '-c:v:%d' % v, 'copy', '-disposition:v:%d' % v, 'attached_pic'])
+            else:
+                i = len(options.get('attachment', []))
+                postopts.extend(['-attach', coverpath])
+                if coverpath.endswith('png'):
+                    postopts.extend(["-metadata:s:t:" + str(i), "mimetype=image/png", "-metadata:s:t:" + str(i), "filename=cover.png"])
+                else:
+                    postopts.extend(["-metadata:s:t:" + str(i), "mimetype=image/jpeg", "-metadata:s:t:" + str(i), "filename=cover.jpg"])
+
+        if self.settings.relocate_moov:
+            if mp4:
+                postopts.extend(['-movflags', '+faststart'])
+            else:
+                postopts.extend(['-cues_to_front', 'true'])
+
+        self.log.info("Tags will be written during conversion [single-pass-tagging].")
+        return True
+
+    # Determine which resource a conversion will be bound by, all copy remuxes by disk I/O, hardware encodes by the device and everything else by the CPU
+    def classifyJob(self, options):
+        vcodec = options.get('video', {}).get('codec')
+        if vcodec == 'copy':
+            if all(a.get('codec') == 'copy' for a in options.get('audio', [])):
+                return JobClass.IO
+            return JobClass.CPU
+        return self.encoderJobClass(vcodec)
+
+    def encoderJobClass(self, vcodec):
+        encoder = Converter.encoder(vcodec)
+        return JobClass.DEVICE if encoder and encoder.hardware else JobClass.CPU
+
+    # Predict the class of a conversion from the probe and codec settings alone so a batch can queue it before options are generated, jobSlot still uses the actual options
+    def predictJobClass(self, info):
+        if not info or not info.video:
+            return JobClass.CPU
+        hdr = self.settings.hdr.get('codec', [])
+        vcodecs = self.ffprobeSafeCodecs(list(hdr if self.isHDRInput(info.video) and len(hdr) > 0 else self.settings.vcodec))
+        if not vcodecs:
+            return JobClass.CPU
+        vcopy = info.video.codec in vcodecs
+        if self.settings.vwidth and self.settings.vwidth < info.video.video_width:
+            vcopy = False
+        if self.settings.video_level and info.video.video_level and info.video.video_level > self.settings.video_level:
+            vcopy = False
+        if self.settings.vmaxbitrate:
+            ratio = self.settings.vbitrateratio.get(info.video.codec, self.settings.vbitrateratio.get("*", 1.0))
+            if self.estimateVideoBitrate(info) * ratio > self.settings.vmaxbitrate:
+                vcopy = False
+        if not vcopy:
+            return self.encoderJobClass(vcodecs[0])
+        acodecs = self.ffprobeSafeCodecs(list(self.settings.acodec))
+        if any(self.settings.ua) or any(a.codec not in acodecs for a in info.audio):
+            return JobClass.CPU
+        return JobClass.IO
+
+    # Hold a slot from the batch scheduler, if there is one, for the duration of the ffmpeg work
+    def jobSlot(self, options):
+        if not self.scheduler:
+            return contextlib.nullcontext()
+        jobclass = self.classifyJob(options)
+        self.log.debug("Conversion classified as %s bound." % jobclass)
+        return self.scheduler.slot(jobclass)
+
     # Wipe disposition data based on settings
     def cleanDispositions(self, info):
         for stream in info.streams:
@@ -347,28 +631,26 @@ class MediaProcessor:
 
     # Determine if a file can be read by FFPROBE
     def isValidSource(self, inputfile, tagdata=None):
+        self.invalid_reason = None
+        self.invalid_final = False
         try:
             extension = self.parseFile(inputfile)[2]
             if extension in self.settings.ignored_extensions:
-                self.log.debug("Invalid source, extension is blacklisted [ignored-extensions].")
-                return None
+                return self.invalidSource("extension is blacklisted [ignored-extensions]")
             if self.settings.minimum_size > 0 and os.path.getsize(inputfile) < (self.settings.minimum_size * 1000000):
-                self.log.debug("Invalid source, below minimum size threshold [minimum-size].")
-                return None
+                return self.invalidSource("below minimum size threshold [minimum-size]")
             info = self.converter.probe(inputfile)
             if not info:
-                self.log.debug("Invalid source, no data returned.")
-                return None
+                return self.invalidSource("no data returned", final=False)
             if not info.video:
-                self.log.debug("Invalid source, no video stream detected.")
-                return None
+                return self.invalidSource("no video stream detected")
             if not info.audio or len(info.audio) < 1:
-                self.log.debug("Invalid source, no audio stream detected.")
-                return None
+                return self.invalidSource("no audio stream detected")
             if validation:
                 try:
                     if not validation(self, info, inputfile, tagdata):
                         self.log.debug("Failed custom validation check, file is not valid.")
+                        self.invalid_reason = "failed custom validation check"
                         return None
                 except KeyboardInterrupt:
                     raise
@@ -379,8 +661,16 @@ class MediaProcessor:
             raise
         except:
             self.log.exception("isValidSource unexpectedly threw an exception, returning None.")
+            self.invalid_reason = "exception during validation"
             return None
 
+    # Log and remember why a source was rejected so batch scans can record it, final rejections don't change until the file or settings do
+    def invalidSource(self, reason, final=True):
+        self.log.debug("Invalid source, %s." % reason)
+        self.invalid_reason = reason
+        self.invalid_final = final
+        return None
+
     # Determine if a sub is an Atmos track
     def isAudioStreamAtmos(self, stream):
         return stream.profile and "atmos" in stream.profile.lower()
@@ -1218,7 +1508,7 @@ class MediaProcessor:
                         continue
 
                 try:
-                    image_based = self.isImageBasedSubtitle(inputfile, s.index)
+                    image_based = self.isImageBasedSubtitle(inputfile, s.index, s)
                     self.log.info("Stream %s is %s-based subtitle for codec %s." % (s.index, "image" if image_based else "text", s.codec))
                 except KeyboardInterrupt:
                     raise
@@ -1288,7 +1578,7 @@ class MediaProcessor:
 
         for external_sub in valid_external_subs:
             try:
-                image_based = self.isImageBasedSubtitle(external_sub.path, 0)
+                image_based = self.isImageBasedSubtitle(external_sub.path, 0, external_sub.subtitle[0] if external_sub.subtitle else None)
             except KeyboardInterrupt:
                 raise
             except:
@@ -1736,7 +2026,7 @@ class MediaProcessor:
                 # Filter out image based subtitles (until we can find a method to get this to work)
                 for x in sub_candidates[:]:
                     try:
-                        if self.isImageBasedSubtitle(inputfile, x.index):
+                        if self.isImageBasedSubtitle(inputfile, x.index, x):
                             sub_candidates.remove(x)
                     except KeyboardInterrupt:
                         raise
@@ -1769,7 +2059,7 @@ class MediaProcessor:
                 # Filter out image based subtitles (until we can find a method to get this to work)
                 for x in sub_candidates[:]:
                     try:
-                        if self.isImageBasedSubtitle(x.path, 0):
+                        if self.isImageBasedSubtitle(x.path, 0, x.subtitle[0] if x.subtitle else None):
                             sub_candidates.remove(x)
                     except KeyboardInterrupt:
                         raise
@@ -1794,26 +2084,23 @@ class MediaProcessor:
     # Scan for external subtitle files
     def scanForExternalSubs(self, inputfile, swl, valid_external_subs=None):
         valid_external_subs = valid_external_subs or []
-        input_dir, filename, _ = self.parseFile(inputfile)
-        for dirName, _, fileList in os.walk(input_dir):
-            for fname in fileList:
-                if any(os.path.join(dirName, fname) == x.path for x in valid_external_subs):
-                    self.log.debug("Already loaded %s, skipping." % (fname))
-                    continue
-                if fname.startswith(filename):  # filename in fname:
-                    _, _, extension = self.parseFile(filename)
-                    valid_external_sub = self.isValidSubtitleSource(os.path.join(dirName, fname))
-                    if valid_external_sub:
-                        self.log.debug("Potential subtitle candidate identified %s." % (fname))
-                        valid_external_sub = self.processExternalSub(valid_external_sub, inputfile)
-                        lang = valid_external_sub.subtitle[0].metadata['language']
-                        default = valid_external_sub.subtitle[0].disposition['default']
-                        if (self.validLanguage(lang, swl) or (self.settings.force_subtitle_defaults and default)) and valid_external_sub:
-                            self.log.debug("Valid external %s subtitle file detected %s." % (lang, fname))
-                            valid_external_subs.append(valid_external_sub)
-                        else:
-                            self.log.debug("Ignoring %s external subtitle stream due to language %s." % (fname, lang))
-            break
+        loaded = set(x.path for x in valid_external_subs)
+        for path in self.sidecars.sidecars(inputfile):
+            fname = os.path.basename(path)
+            if path in loaded:
+                self.log.debug("Already loaded %s, skipping." % (fname))
+                continue
+            valid_external_sub = self.isValidSubtitleSource(path)
+            if valid_external_sub:
+                self.log.debug("Potential subtitle candidate identified %s." % (fname))
+                valid_external_sub = self.processExternalSub(valid_external_sub, inputfile)
+                lang = valid_external_sub.subtitle[0].metadata['language']
+                default = valid_external_sub.subtitle[0].disposition['default']
+                if (self.validLanguage(lang, swl) or (self.settings.force_subtitle_defaults and default)) and valid_external_sub:
+                    self.log.debug("Valid external %s subtitle file detected %s." % (lang, fname))
+                    valid_external_subs.append(valid_external_sub)
+                else:
+                    self.log.debug("Ignoring %s external subtitle stream due to language %s." % (fname, lang))
         self.log.info("Scanned for external subtitles and found %d results in your approved languages." % (len(valid_external_subs)))
         valid_external_subs.sort(key= lambda x: x.path, reverse=True)
         valid_external_subs.sort(key=lambda x: swl.index(x.subtitle[0].metadata['language']) if x.subtitle[0].metadata['language'] in swl else 999)
@@ -1866,7 +2153,7 @@ class MediaProcessor:
         elif tagdata and tagdata.mediatype == MediaType.Movie:
             options = {'type': 'movie'}
 
-        guess = guessit(path, options)
+        guess = guessFile(path, options)
 
         if tagdata and tagdata.mediatype == MediaType.TV:
             guess['episode'] = tagdata.episode
@@ -1942,7 +2229,7 @@ class MediaProcessor:
                 if original:
                     try:
                         self.log.debug("Found original filename, adding data from %s." % original)
-                        og = guessit(original)
+                        og = guessFile(original)
                         self.log.debug("Source %s, release group %s, resolution %s, streaming service %s." % (og.get('source'), og.get('release_group'), og.get('screen_size'), og.get('streaming_service')))
                         video.source = og.get('source') or video.source
                         video.release_group = og.get('release_group') or video.release_group
@@ -1980,12 +2267,9 @@ class MediaProcessor:
 
     # Scan for external chapters file
     def scanForExternalMetadata(self, inputfile, suffix="metadata.txt"):
-        input_dir, filename, _ = self.parseFile(inputfile)
-        for dirName, _, fileList in os.walk(input_dir):
-            for fname in fileList:
-                if fname.startswith(filename) and fname.endswith(suffix):
-                    self.log.debug("Found valid external metadata file %s." % (fname))
-                    return os.path.join(dirName, fname)
+        for path in self.sidecars.sidecars(inputfile, suffix):
+            self.log.debug("Found valid external metadata file %s." % (os.path.basename(path)))
+            return path
         return None
 
     # Generic permission setter
@@ -2002,14 +2286,14 @@ class MediaProcessor:
 
     # Undo output dir
     def restoreFromOutput(self, inputfile, outputfile):
-        if self.settings.output_dir and not self.settings.moveto and os.path.commonpath([self.settings.output_dir, outputfile]) == self.settings.output_dir:
+        if self.output_dir and not self.settings.moveto and os.path.commonpath([self.output_dir, outputfile]) == self.output_dir:
             input_dir, _, _ = self.parseFile(inputfile)
             outputfilename = os.path.split(outputfile)[1]
             try:
                 newoutputfile = os.path.join(input_dir.decode(sys.getfilesystemencoding()), outputfilename.decode(sys.getfilesystemencoding()))
             except:
                 newoutputfile = os.path.join(input_dir, outputfilename)
-            self.log.info("Output file is in output_dir %s, moving back to original directory %s." % (self.settings.output_dir, input_dir))
+            self.log.info("Output file is in output_dir %s, moving back to original directory %s." % (self.output_dir, input_dir))
             self.log.debug("New outputfile %s." % (newoutputfile))
             try:
                 shutil.move(outputfile, newoutputfile)
@@ -2046,12 +2330,12 @@ class MediaProcessor:
             return codec
 
     # Get subtitle file name based on options
-    def getSubOutputFileFromOptions(self, inputfile, options, extension, include_all=False):
+    def getSubOutputFileFromOptions(self, inputfile, options, extension, include_all=False, reserved=[]):
         language = options["language"]
-        return self.getSubOutputFile(inputfile, language, options['disposition'], extension, include_all)
+        return self.getSubOutputFile(inputfile, language, options['disposition'], extension, include_all, reserved)
 
     # Get subtitle file name based on language, disposition, and extension
-    def getSubOutputFile(self, inputfile, language, disposition, extension, include_all):
+    def getSubOutputFile(self, inputfile, language, disposition, extension, include_all, reserved=[]):
         disposition = self.dispoStringToDict(disposition)
         dispo = ""
         potentials = BaseCodec.DISPOSITIONS if include_all else self.settings.filename_dispositions
@@ -2059,7 +2343,7 @@ class MediaProcessor:
             if disposition[k] and k in potentials:
                 dispo += "." + k
         input_dir, filename, input_extension = self.parseFile(inputfile)
-        output_dir = self.settings.output_dir or input_dir
+        output_dir = self.output_dir or input_dir
         if not os.path.exists(output_dir):
             try:
                 os.makedirs(output_dir)
@@ -2068,7 +2352,7 @@ class MediaProcessor:
         outputfile = os.path.join(output_dir, filename + "." + language + dispo + "." + extension)
 
         i = 2
-        while os.path.isfile(outputfile):
+        while os.path.isfile(outputfile) or outputfile in reserved:
             self.log.debug("%s exists, appending %s to filename." % (outputfile, i))
             outputfile = os.path.join(output_dir, filename + "." + language + dispo + "." + str(i) + "." + extension)
             i += 1
@@ -2092,41 +2376,69 @@ class MediaProcessor:
         }
         return options
 
-    # Rip subtitle from container
+    # Rip subtitles from container, all streams are extracted in a single ffmpeg pass so the source is only read once
     def ripSubs(self, inputfile, ripsubopts, include_all=False):
-        rips = []
         ripsubopts = ripsubopts if isinstance(ripsubopts, list) else [ripsubopts]
+        outputs = []
         for options in ripsubopts:
             extension = self.getSubExtensionFromCodec(options['format'])
-            outputfile = self.getSubOutputFileFromOptions(inputfile, options, extension, include_all)
+            outputs.append((self.getSubOutputFileFromOptions(inputfile, options, extension, include_all, [x[0] for x in outputs]), options))
 
+        if len(outputs) > 1:
             try:
-                self.log.info("Ripping %s subtitle from source stream %s into external file." % (options["language"], options['index']))
-                conv = self.converter.convert(outputfile, options, timeout=None, fix_sub_duration=False)
+                self.log.info("Ripping %d subtitle streams %s into external files." % (len(outputs), ", ".join(str(x[1]['index']) for x in outputs)))
+                conv = self.converter.convert_multiple(outputs, timeout=None)
                 _, cmds = next(conv)
                 self.log.debug("Subtitle extraction FFmpeg command:")
                 self.log.debug(self.printableFFMPEGCommand(cmds))
                 for _, debug in conv:
                     self.log.debug(debug)
-                self.log.info("%s created." % outputfile)
-                rips.append(outputfile)
-            except (FFMpegConvertError, ConverterError):
-                self.log.error("Unable to create external %s subtitle file for stream %s, may be an incompatible format." % (extension, options['index']))
-                self.removeFile(outputfile)
-                continue
+                for outputfile, _ in outputs:
+                    self.log.info("%s created." % outputfile)
+                    self.setPermissions(outputfile)
+                return [x[0] for x in outputs]
             except KeyboardInterrupt:
                 raise
             except:
-                self.log.exception("Unable to create external subtitle file for stream %s." % (options['index']))
-            self.setPermissions(outputfile)
+                self.log.warning("Unable to rip all subtitle streams in a single pass, ripping streams individually.", exc_info=True)
+                for outputfile, _ in outputs:
+                    self.removeFile(outputfile)
+
+        rips = []
+        for outputfile, options in outputs:
+            if self.ripSub(outputfile, options):
+                rips.append(outputfile)
         return rips
 
+    # Rip a single subtitle stream from container
+    def ripSub(self, outputfile, options):
+        extension = self.getSubExtensionFromCodec(options['format'])
+        try:
+            self.log.info("Ripping %s subtitle from source stream %s into external file." % (options["language"], options['index']))
+            conv = self.converter.convert(outputfile, options, timeout=None, fix_sub_duration=False)
+            _, cmds = next(conv)
+            self.log.debug("Subtitle extraction FFmpeg command:")
+            self.log.debug(self.printableFFMPEGCommand(cmds))
+            for _, debug in conv:
+                self.log.debug(debug)
+            self.log.info("%s created." % outputfile)
+        except (FFMpegConvertError, ConverterError):
+            self.log.error("Unable to create external %s subtitle file for stream %s, may be an incompatible format." % (extension, options['index']))
+            self.removeFile(outputfile)
+            return False
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to create external subtitle file for stream %s." % (options['index']))
+        self.setPermissions(outputfile)
+        return True
+
     # Get output file name
-    def getOutputFile(self, input_dir, filename, input_extension, temp_extension=None, ignore_output_dir=False, number=0):
+    def getOutputFile(self, input_dir, filename, input_extension, temp_extension=None, ignore_output_dir=False, number=0, partial=False):
         if ignore_output_dir:
             output_dir = input_dir
         else:
-            output_dir = self.settings.output_dir or input_dir
+            output_dir = self.output_dir or input_dir
         if not os.path.exists(output_dir):
             try:
                 os.makedirs(output_dir)
@@ -2147,6 +2459,9 @@ class MediaProcessor:
         except:
             outputfile = os.path.join(output_dir, filename + counter + "." + output_extension)
 
+        if partial and self.partial_output:
+            outputfile = os.path.join(output_dir, "." + os.path.basename(outputfile) + ".part")
+
         self.log.debug("Output file: %s." % outputfile)
         return outputfile, output_dir
 
@@ -2232,8 +2547,30 @@ class MediaProcessor:
         else:
             return bit_depth >= 10
 
-    # Run test conversion of subtitle to see if its image based, does not appear to be any other way to tell dynamically
-    def isImageBasedSubtitle(self, inputfile, map):
+    # Determine if a subtitle stream is image based, results are remembered per file and stream
+    def isImageBasedSubtitle(self, inputfile, map, stream=None):
+        key = (os.path.abspath(inputfile), map, Converter._signature(inputfile))
+        if key not in self.image_subtitles:
+            self.image_subtitles[key] = self.classifySubtitle(inputfile, map, stream)
+        return self.image_subtitles[key]
+
+    # Classify a subtitle stream by its codec, then by whether it has picture dimensions, and only then with a test transcode
+    def classifySubtitle(self, inputfile, map, stream=None):
+        if not stream:
+            info = self.converter.probe(inputfile)
+            stream = next((x for x in info.streams if x.index == map), None) if info else None
+        if stream:
+            if stream.codec in bitmap_subtitle_codecs:
+                return True
+            if stream.codec in text_subtitle_codecs:
+                return False
+            if stream.video_width and stream.video_height:
+                self.log.debug("Subtitle codec %s is unknown but stream %s has dimensions, treating as image-based." % (stream.codec, map))
+                return True
+        return self.testImageBasedSubtitle(inputfile, map)
+
+    # Determine if a subtitle stream is image based by attempting a short conversion to srt
+    def testImageBasedSubtitle(self, inputfile, map):
         ripsub = [{'map': map, 'codec': 'srt'}]
         options = {'source': [inputfile], 'format': 'srt', 'subtitle': ripsub}
         postopts = ['-t', '00:00:01']
@@ -2251,16 +2588,20 @@ class MediaProcessor:
 
     # Check if video file meets criteria to just bypass conversion
     def canBypassConvert(self, inputfile, info, options=None):
+        self.bypass_reason = None
         # Process same extensions
         if self.settings.output_extension == self.parseFile(inputfile)[2]:
             if not self.settings.force_convert and not self.settings.process_same_extensions:
                 self.log.info("Input and output extensions are the same so passing back the original file [process-same-extensions: %s]." % self.settings.process_same_extensions)
+                self.bypass_reason = "process-same-extensions"
                 return True
             elif info.format.metadata.get('encoder', '').startswith('sma') and not self.settings.force_convert:
                 self.log.info("Input and output extensions match and the file appears to have already been processed by SMA, enable force-convert to override [force-convert: %s]." % self.settings.force_convert)
+                self.bypass_reason = "already processed by SMA"
                 return True
             elif self.settings.bypass_copy_all and options and len([x for x in [options['video']] + [x for x in options['audio']] + [x for x in options['subtitle']] if x['codec'] != 'copy']) == 0 and len(options['audio']) == len(info.audio) and len(options['subtitle']) == len(info.subtitle) and not self.settings.force_convert:
                 self.log.info("Input and output extensions match, the file appears to copying all streams, and is not reducing the number of streams, enable force-convert to override [bypass-if-copying-all] [force-convert: %s]." % self.settings.force_convert)
+                self.bypass_reason = "bypass-if-copying-all"
                 return True
         self.log.debug("canBypassConvert returned False.")
         return False
@@ -2270,12 +2611,12 @@ class MediaProcessor:
         return " ".join("\"%s\"" % item if (" " in item or "|" in item) and "\"" not in item else item for item in cmds)
 
     # Encode a new file based on selected options, built in naming conflict resolution
-    def convert(self, options, preopts, postopts, reportProgress=False, progressOutput=None):
+    def convert(self, options, preopts, postopts, reportProgress=False, progressOutput=None, info=None):
         self.log.info("Starting conversion.")
         inputfile = options['source'][0]
         input_dir, filename, input_extension = self.parseFile(inputfile)
         originalinputfile = inputfile
-        outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension)
+        outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension, partial=True)
         finaloutputfile, _ = self.getOutputFile(input_dir, filename, input_extension)
 
         self.log.debug("Final output file: %s." % finaloutputfile)
@@ -2304,11 +2645,12 @@ class MediaProcessor:
                 inputfile = og
                 options['source'][0] = og
                 self.log.debug("Renamed original file to %s." % inputfile)
+                self.journalJob(original=og)
 
             except:
                 i = 2
                 while os.path.isfile(finaloutputfile):
-                    outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension, number=i)
+                    outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension, number=i, partial=True)
                     finaloutputfile, _ = self.getOutputFile(input_dir, filename, input_extension, number=i)
                     i += 1
                 self.log.debug("Unable to rename inputfile. Alternatively renaming output file to %s." % outputfile)
@@ -2317,15 +2659,15 @@ class MediaProcessor:
         if os.path.exists(outputfile) and self.settings.delete:
             self.removeFile(outputfile)
 
-        # Final sweep to make sure outputfile does not exist, renaming as the final solution
+        # Final sweep to make sure outputfile does not exist, renaming as the final solution. Partial output replaces an existing final file only when deleting is enabled
         i = 2
-        while os.path.isfile(outputfile):
-            outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension, number=i)
+        while os.path.isfile(outputfile) or (self.partial_output and not self.settings.delete and os.path.isfile(finaloutputfile)):
+            outputfile, output_dir = self.getOutputFile(input_dir, filename, input_extension, self.settings.temp_extension, number=i, partial=True)
             finaloutputfile, _ = self.getOutputFile(input_dir, filename, input_extension, number=i)
             i += 1
 
         try:
-            conv = self.converter.convert(outputfile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=self.settings.strip_metadata, fix_sub_duration=self.settings.fix_sub_duration)
+            conv = self.converter.convert(outputfile, options, timeout=None, preopts=preopts, postopts=postopts, strip_metadata=self.settings.strip_metadata, fix_sub_duration=self.settings.fix_sub_duration, info=info)
         except KeyboardInterrupt:
             raise
         except:
@@ -2337,6 +2679,7 @@ class MediaProcessor:
         self.log.info("======================")
         self.log.info(self.printableFFMPEGCommand(cmds))
         self.log.info("======================")
+        self.journalJob(cmd=self.printableFFMPEGCommand(cmds), temp=outputfile)
 
         try:
             timecode = 0
@@ -2354,6 +2697,7 @@ class MediaProcessor:
                     self.displayProgressBar(100, newline=True)
 
             self.log.info("%s created." % outputfile)
+            self.journalJob(temp=None)
             self.setPermissions(outputfile)
 
         except FFMpegConvertError as e:
@@ -2383,19 +2727,29 @@ class MediaProcessor:
                 self.log.exception("Error restoring original inputfile after FFMPEG error.")
                 return None, inputfile
 
-        # Check if the finaloutputfile differs from the outputfile. This can happen during above renaming or from temporary extension option
+        # Check if the finaloutputfile differs from the outputfile. This can happen during above renaming, from temporary extension option or from partial output in the destination
         if outputfile != finaloutputfile:
             self.log.debug("Outputfile and finaloutputfile are different attempting to rename to final extension [temp_extension].")
             try:
-                os.rename(outputfile, finaloutputfile)
+                os.replace(outputfile, finaloutputfile)
             except KeyboardInterrupt:
                 raise
             except:
-                self.log.exception("Unable to rename output file to its final destination file extension [temp_extension].")
+                self.log.exception("Unable to rename output file to its final destination file name.")
                 finaloutputfile = outputfile
 
         return finaloutputfile, inputfile
 
+    # Record paths touched by a conversion with the job queue so an interrupted job can be rolled back
+    def journalJob(self, **fields):
+        if self.journal:
+            try:
+                self.journal(**fields)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.log.exception("Unable to journal job state.")
+
     # Generate progress bar
     def displayProgressBar(self, complete, debug="", width=20, newline=False):
         try:
@@ -2432,10 +2786,24 @@ class MediaProcessor:
         TEMP_EXT = '.QTFS'
         # Relocate MOOV atom to the very beginning. Can double the time it takes to convert a file but makes streaming faster
         if os.path.isfile(inputfile) and self.settings.relocate_moov and self.settings.output_format not in ['mkv']:
-            from qtfaststart import processor, exceptions
-
             self.log.info("Relocating MOOV atom to start of file.")
 
+            # Shift the media data in place first, rewriting the whole file to a temp copy needs as much free space again
+            try:
+                if faststart.relocateMoov(inputfile, logger=self.log):
+                    self.converter.invalidate(inputfile)
+                else:
+                    self.log.debug("MOOV atom is already at the start of the file.")
+                return inputfile
+            except faststart.FastStartError as e:
+                self.log.debug("Unable to relocate MOOV atom in place (%s), falling back to QT FastStart." % e)
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.log.exception("Unable to relocate MOOV atom in place, falling back to QT FastStart.")
+
+            from qtfaststart import processor, exceptions
+
             try:
                 outputfile = inputfile.decode(sys.getfilesystemencoding()) + TEMP_EXT
             except:
@@ -2448,6 +2816,7 @@ class MediaProcessor:
             try:
                 processor.process(inputfile, outputfile)
                 self.setPermissions(outputfile)
+                self.converter.invalidate(inputfile)
 
                 # Cleanup
                 if self.removeFile(inputfile, replacement=outputfile):
@@ -2463,37 +2832,21 @@ class MediaProcessor:
     # Makes additional copies of the input file in each directory specified in the copy_to option
     def replicate(self, inputfile, relativePath=None):
         files = [inputfile]
+        replicator = Replicator(hardlink=self.settings.copy_hardlink, verify=self.settings.copy_verify, logger=self.log)
 
         if self.settings.copyto:
             self.log.debug("Copyto option is enabled.")
+            directories = []
             for d in self.settings.copyto:
                 if (relativePath):
                     d = os.path.join(d, relativePath)
                 if not os.path.exists(d):
                     os.makedirs(d)
-                try:
-                    shutil.copy(inputfile, d)
+                directories.append(d)
+            for d, copy in replicator.replicate(inputfile, directories):
+                if copy:
                     self.log.info("%s copied to %s." % (inputfile, d))
-                    files.append(os.path.join(d, os.path.split(inputfile)[1]))
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    self.log.exception("First attempt to copy the file has failed.")
-                    try:
-                        if os.path.exists(os.path.join(d, os.path.split(inputfile)[1])):
-                            self.removeFile(os.path.join(d, os.path.split(inputfile)[1]), 0, 0)
-                        try:
-                            shutil.copy(inputfile.decode(sys.getfilesystemencoding()), d)
-                        except KeyboardInterrupt:
-                            raise
-                        except:
-                            shutil.copy(inputfile, d)
-                        self.log.info("%s copied to %s." % (inputfile, d))
-                        files.append(os.path.join(d, os.path.split(inputfile)[1]))
-                    except KeyboardInterrupt:
-                        raise
-                    except:
-                        self.log.exception("Unable to create additional copy of file in %s." % (d))
+                    files.append(copy)
 
         if self.settings.moveto:
             self.log.debug("Moveto option is enabled.")
@@ -2501,27 +2854,44 @@ class MediaProcessor:
             if not os.path.exists(moveto):
                 os.makedirs(moveto)
             try:
-                shutil.move(inputfile, moveto)
+                files[0] = replicator.move(inputfile, moveto)
                 self.log.info("%s moved to %s." % (inputfile, moveto))
-                files[0] = os.path.join(moveto, os.path.basename(inputfile))
             except KeyboardInterrupt:
                 raise
             except:
-                self.log.exception("First attempt to move the file has failed.")
-                try:
-                    if os.path.exists(os.path.join(moveto, os.path.basename(inputfile))):
-                        self.removeFile(os.path.join(moveto, os.path.basename(inputfile)), 0, 0)
-                    shutil.move(inputfile.decode(sys.getfilesystemencoding()), moveto)
-                    self.log.info("%s moved to %s." % (inputfile, moveto))
-                    files[0] = os.path.join(moveto, os.path.basename(inputfile))
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    self.log.exception("Unable to move %s to %s" % (inputfile, moveto))
+                self.log.exception("Unable to move %s to %s" % (inputfile, moveto))
         for filename in files:
             self.log.debug("Final output file: %s." % filename)
         return files
 
+    # Pick the directory this job writes its output to, on the same filesystem as the final destination so finishing the job is a rename instead of a copy
+    def planOutputDirectory(self, inputfile, destination=None):
+        output_dir = self.settings.output_dir if self.outputDirHasFreeSpace(inputfile) else None
+        if not destination or not self.settings.output_dir_same_fs:
+            return output_dir
+
+        input_dir = os.path.dirname(os.path.abspath(inputfile))
+        working_dir = output_dir or input_dir
+        if self.sameFilesystem(working_dir, destination):
+            return output_dir
+
+        planned = None if self.sameFilesystem(input_dir, destination) else destination
+        self.log.info("Output directory %s is not on the same filesystem as the destination %s, writing output to %s instead [output-directory-same-filesystem]." % (working_dir, destination, planned or input_dir))
+        return planned
+
+    def sameFilesystem(self, a, b):
+        # Directories that don't exist yet are compared by their closest existing parent
+        devices = []
+        for path in [a, b]:
+            path = os.path.abspath(path)
+            while not os.path.exists(path) and os.path.dirname(path) != path:
+                path = os.path.dirname(path)
+            try:
+                devices.append(os.stat(path).st_dev)
+            except OSError:
+                return True
+        return devices[0] == devices[1]
+
     def outputDirHasFreeSpace(self, inputfile):
         if self.settings.output_dir and self.settings.output_dir_ratio:
             try:
@@ -1,15 +1,15 @@
 import os
 import sys
-import requests
 import enum
-import tempfile
 import time
 import logging
 import tmdbsimple as tmdb
 from io import StringIO
+from concurrent.futures import ThreadPoolExecutor, wait
 from mutagen.mp4 import MP4, MP4Cover, MP4StreamInfoError
 from resources.extensions import valid_poster_extensions, tmdb_api_key
 from resources.lang import getAlpha2BCode, getAlpha3TCode
+from resources.artworkcache import ArtworkCache
 from converter.ffmpeg import FFMpegConvertError
 
 
@@ -41,6 +41,7 @@ class Metadata:
         MediaType.TV: 'us-tv|Not Rated|000'
     }
     HD = None
+    FETCH_DEADLINE = 60
 
     def __init__(self, mediatype, tmdbid=None, imdbid=None, tvdbid=None, season=None, episode=None, original=None, language=None, logger=None):
         self.tmdbid = None
@@ -72,12 +73,17 @@ class Metadata:
         self.original = original
 
         if self.mediatype == MediaType.Movie:
-            query = tmdb.Movies(self.tmdbid)
-            self.moviedata = query.info(language=self.language)
-            self.externalids = query.external_ids(language=self.language)
-            self.credit = query.credits()
+            fetched = self.fetch({
+                'info': lambda: tmdb.Movies(self.tmdbid).info(language=self.language),
+                'external_ids': lambda: tmdb.Movies(self.tmdbid).external_ids(language=self.language),
+                'credits': lambda: tmdb.Movies(self.tmdbid).credits(),
+                'release_dates': lambda: tmdb.Movies(self.tmdbid).release_dates(),
+            })
+            self.moviedata = fetched['info'].result(timeout=0)
+            self.externalids = fetched['external_ids'].result(timeout=0)
+            self.credit = fetched['credits'].result(timeout=0)
             try:
-                releases = query.release_dates()
+                releases = fetched['release_dates'].result(timeout=0)
                 release = next(x for x in releases['results'] if x['iso_3166_1'] == 'US')
                 rating = release['release_dates'][0]['certification']
                 self.rating = self.getRating(rating)
@@ -98,17 +104,21 @@ class Metadata:
             self.season = int(season)
             self.episode = int(episode)
 
-            seriesquery = tmdb.TV(self.tmdbid)
-            seasonquery = tmdb.TV_Seasons(self.tmdbid, season)
-            episodequery = tmdb.TV_Episodes(self.tmdbid, season, episode)
-
-            self.showdata = seriesquery.info(language=self.language)
-            self.seasondata = seasonquery.info(language=self.language)
-            self.episodedata = episodequery.info(language=self.language)
-            self.credit = episodequery.credits()
-            self.externalids = seriesquery.external_ids(language=self.language)
+            fetched = self.fetch({
+                'series': lambda: tmdb.TV(self.tmdbid).info(language=self.language),
+                'season': lambda: tmdb.TV_Seasons(self.tmdbid, season).info(language=self.language),
+                'episode': lambda: tmdb.TV_Episodes(self.tmdbid, season, episode).info(language=self.language),
+                'credits': lambda: tmdb.TV_Episodes(self.tmdbid, season, episode).credits(),
+                'external_ids': lambda: tmdb.TV(self.tmdbid).external_ids(language=self.language),
+                'content_ratings': lambda: tmdb.TV(self.tmdbid).content_ratings(),
+            })
+            self.showdata = fetched['series'].result(timeout=0)
+            self.seasondata = fetched['season'].result(timeout=0)
+            self.episodedata = fetched['episode'].result(timeout=0)
+            self.credit = fetched['credits'].result(timeout=0)
+            self.externalids = fetched['external_ids'].result(timeout=0)
             try:
-                content_ratings = seriesquery.content_ratings()
+                content_ratings = fetched['content_ratings'].result(timeout=0)
                 rating = next(x for x in content_ratings['results'] if x['iso_3166_1'] == 'US')['rating']
                 self.rating = self.getRating(rating)
             except KeyboardInterrupt:
@@ -127,6 +137,28 @@ class Metadata:
             self.imdbid = self.externalids.get('imdb_id') or imdbid
             self.tvdbid = self.externalids.get('tvdb_id') or tvdbid
 
+    def withLanguage(self, language):
+        # Metadata for another tagging language, reusing this instance when the language is the same
+        if getAlpha2BCode(language, default='en') == self.language:
+            return self
+        return Metadata(self.mediatype, tmdbid=self.tmdbid, imdbid=self.imdbid, tvdbid=self.tvdbid, season=self.season, episode=self.episode, original=self.original, language=language, logger=self.log)
+
+    def fetch(self, calls):
+        """
+        Run independent TMDB requests concurrently and return a dict of
+        futures by name. All requests share FETCH_DEADLINE, the result of a
+        request that didn't finish in time raises a TimeoutError.
+        """
+        executor = ThreadPoolExecutor(max_workers=len(calls))
+        try:
+            futures = {name: executor.submit(call) for name, call in calls.items()}
+            _, pending = wait(futures.values(), timeout=self.FETCH_DEADLINE)
+            if pending:
+                self.log.error("%d TMDB requests did not finish within %d seconds." % (len(pending), self.FETCH_DEADLINE))
+            return futures
+        finally:
+            executor.shutdown(wait=False)
+
     @staticmethod
     def resolveTmdbID(mediatype, log, tmdbid=None, tvdbid=None, imdbid=None):
         find = None
@@ -191,23 +223,7 @@ class Metadata:
         except (MP4StreamInfoError, KeyError):
             self.log.debug('File is not a valid MP4 file and cannot be tagged using mutagen, falling back to FFMPEG limited tagging.')
             try:
-                metadata = {}
-                if self.mediatype == MediaType.Movie:
-                    metadata['TITLE'] = self.title  # Movie title
-                    metadata["COMMENT"] = self.description  # Long description
-                    metadata["DATE_RELEASE"] = self.date  # Year
-                    metadata["DATE"] = self.date  # Year
-                elif self.mediatype == MediaType.TV:
-                    metadata['TITLE'] = self.title  # Video title
-                    metadata["COMMENT"] = self.description  # Long description
-                    metadata["DATE_RELEASE"] = self.date  # Air Date
-                    metadata["DATE"] = self.date  # Air Date
-                    metadata["ALBUM"] = self.showname + ", Season " + str(self.season)  # Album as Season
-
-                if self.genre and len(self.genre) > 0:
-                    metadata["GENRE"] = self.genre[0].get('name')
-
-                metadata["ENCODER"] = "SMA"
+                metadata = self.getFFMpegTags()
 
                 coverpath = None
                 if artwork:
@@ -299,6 +315,57 @@ class Metadata:
             self.log.exception("There was an error writing the tags.")
         return False
 
+    def getFFMpegTags(self, mp4=False, filename=None):
+        # Tags as ffmpeg -metadata key/value pairs, MP4 keys are the ones the mov muxer writes as iTunes atoms
+        metadata = {}
+        if not mp4:
+            if self.mediatype == MediaType.Movie:
+                metadata['TITLE'] = self.title  # Movie title
+                metadata["COMMENT"] = self.description  # Long description
+                metadata["DATE_RELEASE"] = self.date  # Year
+                metadata["DATE"] = self.date  # Year
+            elif self.mediatype == MediaType.TV:
+                metadata['TITLE'] = self.title  # Video title
+                metadata["COMMENT"] = self.description  # Long description
+                metadata["DATE_RELEASE"] = self.date  # Air Date
+                metadata["DATE"] = self.date  # Air Date
+                metadata["ALBUM"] = self.showname + ", Season " + str(self.season)  # Album as Season
+
+            if self.genre and len(self.genre) > 0:
+                metadata["GENRE"] = self.genre[0].get('name')
+
+            metadata["ENCODER"] = "SMA"
+            return metadata
+
+        if self.mediatype == MediaType.Movie:
+            metadata["title"] = self.title  # Movie title
+            metadata["description"] = self.tagline  # Short description
+            metadata["synopsis"] = self.description  # Long description
+            metadata["date"] = self.date  # Year
+            metadata["media_type"] = 9  # Movie iTunes category
+        elif self.mediatype == MediaType.TV:
+            metadata["show"] = self.showname  # TV show title
+            metadata["title"] = self.title  # Video title
+            metadata["episode_id"] = self.title  # Episode title
+            metadata["description"] = self.shortDescription  # Short description
+            metadata["synopsis"] = self.description  # Long description
+            metadata["network"] = ", ".join(x['name'] for x in self.network)  # Network
+            metadata["date"] = self.date  # Air Date
+            metadata["season_number"] = self.season  # Season number
+            metadata["disc"] = self.season  # Season number as disk
+            metadata["album"] = self.showname + ", Season " + str(self.season)  # iTunes Album as Season
+            metadata["episode_sort"] = self.episode  # Episode number
+            metadata["track"] = "%d/%d" % (self.episode, len(self.seasondata.get('episodes', [])))  # Episode number iTunes
+            metadata["media_type"] = 10  # TV show iTunes category
+
+        if self.HD:
+            metadata["hd_video"] = self.HD[0]
+        if self.genre and len(self.genre) > 0:
+            metadata["genre"] = self.genre[0].get('name')
+
+        metadata["encoding_tool"] = "SMA:" + os.path.basename(self.original or filename or "")
+        return metadata
+
     def setHD(self, width, height):
         if width >= 3800 or height >= 2100:
             self.HD = [3]
@@ -368,11 +435,6 @@ class Metadata:
         output.write(footer)
         return output.getvalue()
 
-    def urlretrieve(self, url, fn):
-        with open(fn, 'wb') as f:
-            f.write(requests.get(url, allow_redirects=True, timeout=30).content)
-        return (fn, f)
-
     def getArtwork(self, path, inputfile, thumbnail=False):
         # Check for artwork in the same directory as the source
         poster = None
@@ -415,22 +477,8 @@ class Metadata:
                 self.log.debug("No artwork found for media file.")
                 return None
 
-            savepath = os.path.join(tempfile.gettempdir(), "poster-%s.jpg" % (self.tmdbid))
-
-            # Ensure the save path is clear
-            if os.path.exists(savepath):
-                try:
-                    os.remove(savepath)
-                except KeyboardInterrupt:
-                    raise
-                except:
-                    i = 2
-                    while os.path.exists(savepath):
-                        savepath = os.path.join(tempfile.gettempdir(), "poster-%s.%d.jpg" % (self.tmdbid, i))
-                        i += 1
-
             try:
-                poster = self.urlretrieve("https://image.tmdb.org/t/p/original" + poster_path, savepath)[0]
+                poster = ArtworkCache.default().get(poster_path)
             except Exception:
-                self.log.exception("Exception while retrieving poster" % poster_path)
+                self.log.exception("Exception while retrieving poster %s." % poster_path)
         return poster
@@ -10,8 +10,11 @@ try:
     from importlib import reload
 except ImportError:
     pass
+import json
+import hashlib
 import logging
 from resources.extensions import *
+from resources.artworkcache import ArtworkCache
 
 
 class SMAConfigParser(ConfigParser, object):
@@ -92,7 +95,38 @@ class SMAConfigParser(ConfigParser, object):
         return super(SMAConfigParser, self).getboolean(section, option, vars=vars, fallback=fallback)
 
 
+class DuplicateAction:
+    REUSE = 'reuse'
+    SKIP = 'skip'
+
+    @classmethod
+    def choices(cls):
+        return [cls.REUSE, cls.SKIP]
+
+
 class ReadSettings:
+    # Settings that change what an output contains, earlier results are only reused while these match
+    OUTPUT_SETTINGS = [
+        'output_extension', 'output_format', 'relocate_moov', 'preopts', 'postopts', 'threads', 'hwaccels', 'hwaccel_decoders', 'hwdevices', 'hwoutputfmt',
+        'bypass_copy_all', 'process_same_extensions', 'force_convert', 'stream_codec_combinations',
+        'vcodec', 'vcrf', 'vcrf_profiles', 'vbitrateratio', 'vmaxbitrate', 'vwidth', 'video_level', 'vprofile', 'pix_fmt', 'keep_source_pix_fmt',
+        'vfilter', 'vforcefilter', 'preset', 'codec_params', 'dynamic_params', 'hdr',
+        'acodec', 'abitrate', 'amaxbitrate', 'aprofile', 'afilter', 'afilterchannels', 'aforcefilter', 'avbr', 'awl', 'adl', 'maxchannels',
+        'audio_samplerates', 'audio_sampleformat', 'audio_copyoriginal', 'audio_first_language_stream', 'audio_original_language', 'audio_sorting',
+        'audio_sorting_default', 'audio_sorting_codecs', 'audio_atmos_force_copy', 'force_audio_defaults', 'ignored_audio_dispositions',
+        'unique_audio_dispositions', 'aac_adtstoasc',
+        'ua', 'ua_bitrate', 'ua_filter', 'ua_first_only', 'ua_forcefilter', 'ua_profile', 'ua_vbr',
+        'scodec', 'scodec_image', 'swl', 'sdl', 'sforcedefault', 'embedsubs', 'embedimgsubs', 'embedonlyinternalsubs', 'burn_subtitles',
+        'burn_dispositions', 'burn_sorting', 'sub_sorting', 'sub_sorting_codecs', 'sub_first_language_stream', 'subtitle_original_language',
+        'subencoding', 'ignore_embedded_subs', 'ignored_subtitle_dispositions', 'unique_subtitle_dispositions', 'force_subtitle_defaults',
+        'fix_sub_duration', 'hearing_impaired', 'removebvs', 'cleanit', 'cleanit_config', 'cleanit_tags', 'ffsubsync', 'downloadsubs',
+        'downloadforcedsubs', 'subproviders', 'filename_dispositions', 'attachmentcodec',
+        'tagfile', 'taglanguage', 'artwork', 'thumbnail', 'artwork_size', 'sanitize_disposition', 'strip_metadata', 'keep_titles',
+        'single_pass_tagging', 'fullpathguess',
+    ]
+    # Settings that also decide whether a file is processed at all
+    SCAN_SETTINGS = OUTPUT_SETTINGS + ['minimum_size', 'ignored_extensions']
+
     DEFAULTS = {
         'Converter': {
             'ffmpeg': 'ffmpeg' if os.name != 'nt' else 'ffmpeg.exe',
@@ -104,6 +138,7 @@ class ReadSettings:
             'hwaccel-output-format': '',
             'output-directory': '',
             'output-directory-space-ratio': 0.0,
+            'output-directory-same-filesystem': True,
             'output-format': 'mp4',
             'output-extension': 'mp4',
             'temp-extension': '',
@@ -111,6 +146,8 @@ class ReadSettings:
             'ignored-extensions': 'nfo, ds_store',
             'copy-to': '',
             'move-to': '',
+            'copy-hardlink': False,
+            'copy-verify': False,
             'delete-original': True,
             'process-same-extensions': False,
             'bypass-if-copying-all': False,
@@ -134,9 +171,33 @@ class ReadSettings:
             'tag': True,
             'tag-language': 'eng',
             'download-artwork': 'poster',
+            'artwork-size': 'original',
             'sanitize-disposition': '',
             'strip-metadata': False,
             'keep-titles': False,
+            'single-pass-tagging': False,
+        },
+        'Cache': {
+            'directory': '',
+            'probe-entries': 50000,
+            'duplicate-content': '',
+            'tmdb-cache': True,
+            'artwork-max-size': 200,
+        },
+        'Batch': {
+            'jobs': 1,
+            'remux-jobs': 0,
+            'device-jobs': 0,
+            'probe-workers': 4,
+        },
+        'Daemon': {
+            'enabled': False,
+            'host': '127.0.0.1',
+            'port': 8585,
+            'apikey': '',
+            'database': '',
+            'max-attempts': 3,
+            'output-directories': '',
         },
         'Video': {
             'codec': 'h264, x264',
@@ -491,6 +552,7 @@ class ReadSettings:
         self.hwoutputfmt = config.getdict(section, "hwaccel-output-format")
         self.output_dir = config.getdirectory(section, "output-directory")
         self.output_dir_ratio = config.getfloat(section, "output-directory-space-ratio")
+        self.output_dir_same_fs = config.getboolean(section, "output-directory-same-filesystem")
         self.output_format = config.get(section, "output-format")
         self.output_extension = config.getextension(section, "output-extension")
         self.temp_extension = config.getextension(section, "temp-extension")
@@ -498,6 +560,8 @@ class ReadSettings:
         self.ignored_extensions = config.getextensions(section, 'ignored-extensions')
         self.copyto = config.getdirectories(section, "copy-to", separator='|')
         self.moveto = config.getdirectory(section, "move-to")
+        self.copy_hardlink = config.getboolean(section, "copy-hardlink")
+        self.copy_verify = config.getboolean(section, "copy-verify")
         self.delete = config.getboolean(section, "delete-original")
         self.process_same_extensions = config.getboolean(section, "process-same-extensions")
         self.bypass_copy_all = config.getboolean(section, "bypass-if-copying-all")
@@ -546,9 +610,43 @@ class ReadSettings:
             except:
                 self.artwork = True
                 self.log.error("Invalid download-artwork value, defaulting to 'poster'.")
+        self.artwork_size = config.get(section, "artwork-size").lower()
+        if self.artwork_size not in ArtworkCache.SIZES:
+            self.log.error("Invalid artwork-size value %s, should be one of %s, defaulting to 'original' [artwork-size]." % (self.artwork_size, ", ".join(ArtworkCache.SIZES)))
+            self.artwork_size = 'original'
         self.sanitize_disposition = config.getlist(section, "sanitize-disposition")
         self.strip_metadata = config.getboolean(section, "strip-metadata")
         self.keep_titles = config.getboolean(section, "keep-titles")
+        self.single_pass_tagging = config.getboolean(section, "single-pass-tagging")
+
+        # Cache
+        section = "Cache"
+        self.cache_dir = config.getdirectory(section, "directory")
+        self.cache_probe_entries = config.getint(section, "probe-entries")
+        self.duplicate_content = config.get(section, "duplicate-content").lower()
+        self.tmdb_cache = config.getboolean(section, "tmdb-cache")
+        self.artwork_max_size = config.getint(section, "artwork-max-size")
+        if self.duplicate_content and self.duplicate_content not in DuplicateAction.choices():
+            self.log.error("Invalid duplicate-content value %s, should be one of %s, disabling [duplicate-content]." % (self.duplicate_content, ", ".join(DuplicateAction.choices())))
+            self.duplicate_content = ''
+
+        # Batch
+        section = "Batch"
+        self.batch_jobs = config.getint(section, "jobs")
+        self.batch_remux_jobs = config.getint(section, "remux-jobs")
+        self.batch_device_jobs = config.getint(section, "device-jobs")
+        self.batch_probe_workers = config.getint(section, "probe-workers")
+
+        # Daemon
+        section = "Daemon"
+        self.Daemon = {}
+        self.Daemon['enabled'] = config.getboolean(section, "enabled")
+        self.Daemon['host'] = config.get(section, "host")
+        self.Daemon['port'] = config.getint(section, "port")
+        self.Daemon['apikey'] = config.get(section, "apikey")
+        self.Daemon['database'] = config.getpath(section, "database")
+        self.Daemon['max-attempts'] = config.getint(section, "max-attempts")
+        self.Daemon['output-directories'] = config.getdirectories(section, "output-directories")
 
         # Video
         section = "Video"
@@ -851,6 +949,11 @@ class ReadSettings:
         self.Plex['ignore-certs'] = config.getboolean(section, 'ignore-certs')
         self.Plex['path-mapping'] = config.getdict(section, "path-mapping", dictseparator="=", lower=False, replace=[])
 
+    # Hash of the given settings, OUTPUT_SETTINGS by default, so unrelated edits like API keys or hosts don't invalidate stored results
+    def fingerprint(self, keys=None):
+        values = {k: getattr(self, k, None) for k in (keys or self.OUTPUT_SETTINGS)}
+        return hashlib.sha1(json.dumps(values, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
     def writeConfig(self, config, cfgfile):
         if not os.path.isdir(os.path.dirname(cfgfile)):
             os.makedirs(os.path.dirname(cfgfile))
@@ -0,0 +1,177 @@
+import os
+import sys
+import errno
+import shutil
+import hashlib
+import logging
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class Replicator:
+    """
+    Copies a file into several directories using the cheapest method each
+    destination allows, in order: a hardlink when the destination is on the
+    same filesystem and hardlinks are allowed, a reflink (FICLONE) on
+    filesystems that share extents such as btrfs and XFS, an in-kernel
+    copy_file_range and finally shutil.copyfile, which uses sendfile where
+    available.
+
+    Destinations on different devices are copied in parallel while copies
+    to the same device run one after another so they don't compete for the
+    same disk. With verify set every copy is checked against a checksum of
+    the source, which is only computed once.
+    """
+    FICLONE = 0x40049409
+    CHUNK = 64 * 1024 * 1024
+    HASH_BLOCK = 1024 * 1024
+
+    def __init__(self, hardlink=False, verify=False, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.hardlink = hardlink
+        self.verify = verify
+        self._checksums = {}
+
+    @staticmethod
+    def device(path):
+        return os.stat(path).st_dev
+
+    def checksum(self, path):
+        h = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(self.HASH_BLOCK), b''):
+                h.update(block)
+        return h.hexdigest()
+
+    def sourceChecksum(self, path):
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        if key not in self._checksums:
+            self._checksums[key] = self.checksum(path)
+        return self._checksums[key]
+
+    def link(self, src, dst):
+        if not self.hardlink or self.device(src) != self.device(os.path.dirname(dst)):
+            return False
+        try:
+            os.link(src, dst)
+            return True
+        except OSError:
+            self.log.debug("Unable to hardlink %s to %s." % (src, dst))
+            return False
+
+    def clone(self, src, dst):
+        if not fcntl or not sys.platform.startswith('linux'):
+            return False
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            try:
+                fcntl.ioctl(fdst.fileno(), self.FICLONE, fsrc.fileno())
+                return True
+            except OSError:
+                return False
+
+    def copyRange(self, src, dst):
+        if not hasattr(os, 'copy_file_range'):
+            return False
+        with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+            size = os.fstat(fsrc.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    n = os.copy_file_range(fsrc.fileno(), fdst.fileno(), min(self.CHUNK, size - copied))
+                    if n == 0:
+                        break
+                    copied += n
+            except OSError as e:
+                if e.errno in [errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EBADF]:
+                    return False
+                raise
+            return copied == size
+
+    def copy(self, src, dst):
+        """
+        Copy src to the destination path dst, replacing any existing file.
+        Returns the name of the method that was used.
+        """
+        if os.path.lexists(dst):
+            if os.path.exists(dst) and os.path.samefile(src, dst):
+                return 'existing'
+            os.remove(dst)
+
+        if self.link(src, dst):
+            return 'hardlink'
+
+        if self.clone(src, dst):
+            method = 'reflink'
+        elif self.copyRange(src, dst):
+            method = 'copy_file_range'
+        else:
+            shutil.copyfile(src, dst)
+            method = 'copyfile'
+        shutil.copymode(src, dst)
+
+        if self.verify and self.checksum(dst) != self.sourceChecksum(src):
+            os.remove(dst)
+            raise IOError("Checksum of %s does not match %s." % (dst, src))
+        return method
+
+    def _copyGroup(self, src, directories):
+        results = {}
+        for d in directories:
+            dst = os.path.join(d, os.path.basename(src))
+            try:
+                method = self.copy(src, dst)
+                self.log.debug("%s copied to %s using %s." % (src, d, method))
+                results[d] = dst
+            except KeyboardInterrupt:
+                raise
+            except:
+                self.log.exception("Unable to create additional copy of file in %s." % (d))
+                results[d] = None
+        return results
+
+    def replicate(self, src, directories):
+        """
+        Copy src into each directory. Returns a list of (directory,
+        destination) tuples in the order given, with a destination of None
+        for copies that failed.
+        """
+        groups = {}
+        for d in directories:
+            try:
+                groups.setdefault(self.device(d), []).append(d)
+            except OSError:
+                groups.setdefault(d, []).append(d)
+
+        if self.verify and len(directories) > 1:
+            self.sourceChecksum(src)
+
+        results = {}
+        if len(groups) > 1:
+            with ThreadPoolExecutor(max_workers=len(groups)) as executor:
+                for r in executor.map(lambda g: self._copyGroup(src, g), groups.values()):
+                    results.update(r)
+        else:
+            for g in groups.values():
+                results.update(self._copyGroup(src, g))
+        return [(d, results.get(d)) for d in directories]
+
+    def move(self, src, directory):
+        """
+        Move src into directory, renaming when it is on the same device and
+        copying then removing the source otherwise. Returns the new path.
+        """
+        dst = os.path.join(directory, os.path.basename(src))
+        try:
+            os.replace(src, dst)
+            return dst
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+        method = self.copy(src, dst)
+        self.log.debug("%s copied to %s using %s before removing the source." % (src, directory, method))
+        os.remove(src)
+        return dst
@@ -0,0 +1,82 @@
+import os
+import time
+import bisect
+import threading
+import logging
+
+
+class SidecarIndex:
+    """
+    Index of the files in a directory used to find the sidecar files of a
+    video (subtitles, metadata, posters), which share the video's file name
+    as a prefix. Each directory is read once with os.scandir and kept as a
+    sorted list of names, so prefix lookups are a binary search and repeated
+    lookups for the same video are a dictionary hit.
+
+    A directory is read again when its modification time changes. Like git's
+    racy index handling, a listing taken within RACY_WINDOW of the last
+    change isn't trusted since a file created in the same timestamp tick
+    wouldn't change the modification time.
+    """
+    RACY_WINDOW = 2 * 1000000000
+
+    def __init__(self, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self._lock = threading.Lock()
+        self._dirs = {}
+
+    def _directory(self, directory):
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError:
+            return None
+        entry = self._dirs.get(directory)
+        if entry and entry['mtime_ns'] == mtime_ns and entry['scanned'] - mtime_ns > self.RACY_WINDOW:
+            return entry
+
+        scanned = time.time_ns()
+        try:
+            with os.scandir(directory) as it:
+                names = sorted(x.name for x in it if x.is_file())
+        except OSError:
+            self.log.debug("Unable to scan directory %s for sidecar files." % directory)
+            return None
+        entry = self._dirs[directory] = {'mtime_ns': mtime_ns, 'scanned': scanned, 'names': names, 'prefixes': {}}
+        self.log.debug("Indexed %d files in %s." % (len(names), directory))
+        return entry
+
+    def files(self, directory, prefix=""):
+        """
+        Return the names of the files in directory starting with prefix.
+        """
+        directory = os.path.abspath(directory)
+        with self._lock:
+            entry = self._directory(directory)
+            if not entry:
+                return []
+            matches = entry['prefixes'].get(prefix)
+            if matches is None:
+                names = entry['names']
+                start = bisect.bisect_left(names, prefix)
+                end = start
+                while end < len(names) and names[end].startswith(prefix):
+                    end += 1
+                matches = entry['prefixes'][prefix] = names[start:end]
+            return list(matches)
+
+    def sidecars(self, path, suffix=None):
+        """
+        Return the paths of the files next to path whose names start with
+        its file name without extension, optionally limited to names ending
+        with suffix. Path itself is not included.
+        """
+        directory, filename = os.path.split(os.path.abspath(path))
+        prefix = os.path.splitext(filename)[0]
+        return [os.path.join(directory, x) for x in self.files(directory, prefix) if x != filename and (not suffix or x.endswith(suffix))]
+
+    def invalidate(self, directory=None):
+        with self._lock:
+            if directory:
+                self._dirs.pop(os.path.abspath(directory), None)
+            else:
+                self._dirs = {}
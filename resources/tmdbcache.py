@@ -0,0 +1,191 @@
+import os
+import re
+import time
+import sqlite3
+import threading
+import logging
+import requests
+import tmdbsimple as tmdb
+from collections import OrderedDict
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from urllib.parse import urlsplit, urlencode
+except ImportError:
+    from urlparse import urlsplit
+    from urllib import urlencode
+
+
+HOUR = 3600
+DAY = 24 * HOUR
+
+
+class TMDBSession(requests.Session):
+    """
+    Pooled requests session for tmdbsimple that caches GET responses in
+    memory and, when a path is given, in SQLite so documents shared by many
+    files (the series and season of a season pack, a movie that is
+    processed again) are only fetched once per TTL.
+
+    Responses are keyed by endpoint and query parameters without the API
+    key, which covers the id and language of every lookup. Each endpoint
+    has its own TTL since episode listings change as a season airs while
+    external ids practically never do. Concurrent requests for the same
+    document wait for the first one instead of fetching it again.
+
+    Rate limited and failed requests are retried, honouring Retry-After.
+
+    >>> TMDBSession.install('/tmp/sma-cache')
+    """
+    DEFAULT_FILENAME = 'tmdb.db'
+    SCHEMA_VERSION = 1
+    # First matching pattern wins
+    TTLS = [
+        (re.compile(r'/search/'), DAY),
+        (re.compile(r'/find/'), 30 * DAY),
+        (re.compile(r'/external_ids$'), 30 * DAY),
+        (re.compile(r'/(release_dates|content_ratings)$'), 7 * DAY),
+        (re.compile(r'/tv/\d+/season/'), 12 * HOUR),
+        (re.compile(r'/tv/'), DAY),
+        (re.compile(r'/movie/'), 7 * DAY),
+    ]
+    DEFAULT_TTL = DAY
+    IGNORED_PARAMS = ['api_key']
+    POOL_SIZE = 16
+
+    def __init__(self, path=None, memory_entries=1024, logger=None):
+        super(TMDBSession, self).__init__()
+        self.log = logger or logging.getLogger(__name__)
+        self.memory_entries = memory_entries
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+        self.location = path
+
+        retry = Retry(total=3, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504], allowed_methods=['GET'], respect_retry_after_header=True)
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.POOL_SIZE, max_retries=retry)
+        self.mount('https://', adapter)
+        self.mount('http://', adapter)
+
+        self.path = None
+        self._conn = None
+        if path:
+            if os.path.isdir(path):
+                path = os.path.join(path, self.DEFAULT_FILENAME)
+            self.path = path
+            self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            if self._conn.execute('PRAGMA user_version').fetchone()[0] != self.SCHEMA_VERSION:
+                self._conn.execute('DROP TABLE IF EXISTS response')
+            self._conn.execute('''CREATE TABLE IF NOT EXISTS response (
+                                  key TEXT PRIMARY KEY,
+                                  body BLOB NOT NULL,
+                                  expires REAL NOT NULL)''')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS response_expires ON response (expires)')
+            self._conn.execute('DELETE FROM response WHERE expires < ?', (time.time(),))
+            self._conn.execute('PRAGMA user_version = %d' % self.SCHEMA_VERSION)
+
+    @classmethod
+    def install(cls, path=None, logger=None):
+        """
+        Make a session the one used by every tmdbsimple request and return
+        it. The installed session is kept if it uses the same path.
+        """
+        session = tmdb.REQUESTS_SESSION
+        if isinstance(session, cls) and session.location == path:
+            return session
+        tmdb.REQUESTS_SESSION = cls(path, logger=logger)
+        return tmdb.REQUESTS_SESSION
+
+    def ttl(self, path):
+        for pattern, ttl in self.TTLS:
+            if pattern.search(path):
+                return ttl
+        return self.DEFAULT_TTL
+
+    def key(self, url, params):
+        params = sorted((k, str(v)) for k, v in (params or {}).items() if k not in self.IGNORED_PARAMS)
+        return urlsplit(url).path + ('?' + urlencode(params) if params else '')
+
+    def _cached(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry:
+                if entry[1] > now:
+                    self._memory.move_to_end(key)
+                    return entry[0]
+                del self._memory[key]
+            if self._conn:
+                row = self._conn.execute('SELECT body, expires FROM response WHERE key = ?', (key,)).fetchone()
+                if row and row[1] > now:
+                    self._remember(key, bytes(row[0]), row[1])
+                    return bytes(row[0])
+        return None
+
+    def _store(self, key, body, ttl):
+        expires = time.time() + ttl
+        with self._lock:
+            self._remember(key, body, expires)
+            if self._conn:
+                try:
+                    self._conn.execute('INSERT OR REPLACE INTO response (key, body, expires) VALUES (?, ?, ?)', (key, sqlite3.Binary(body), expires))
+                except sqlite3.Error:
+                    self.log.exception("Unable to store TMDB response in %s." % self.path)
+
+    def _remember(self, key, body, expires):
+        self._memory[key] = (body, expires)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    @staticmethod
+    def response(url, body):
+        response = requests.Response()
+        response.status_code = 200
+        response.url = url
+        response._content = body
+        response.encoding = 'utf-8'
+        return response
+
+    def request(self, method, url, params=None, **kwargs):
+        if method.upper() != 'GET':
+            return super(TMDBSession, self).request(method, url, params=params, **kwargs)
+
+        key = self.key(url, params)
+        body = self._cached(key)
+        if body is not None:
+            return self.response(url, body)
+
+        # Only one thread fetches a document, the others use its result
+        with self._lock:
+            fetching = self._inflight.get(key)
+            if not fetching:
+                fetching = self._inflight[key] = threading.Lock()
+        with fetching:
+            body = self._cached(key)
+            if body is not None:
+                return self.response(url, body)
+            try:
+                response = super(TMDBSession, self).request(method, url, params=params, **kwargs)
+                if response.status_code == 200:
+                    self._store(key, response.content, self.ttl(urlsplit(url).path))
+                return response
+            finally:
+                with self._lock:
+                    self._inflight.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._conn:
+                self._conn.execute('DELETE FROM response')
+
+    def close(self):
+        super(TMDBSession, self).close()
+        with self._lock:
+            if self._conn:
+                self._conn.close()
+                self._conn = None
@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import copy
+import time
+import threading
+import argparse
+import logging
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from resources.log import getLogger
+from resources.readsettings import ReadSettings
+from resources.metadata import MediaType
+from resources.mediaprocessor import MediaProcessor, JobClass
+from resources.batch import JobScheduler
+from resources.daemon import REMOTE_METHODS, OVERRIDABLE_SETTINGS
+from resources.jobqueue import JobQueue
+
+log = getLogger("DAEMON")
+
+logging.getLogger("subliminal").setLevel(logging.CRITICAL)
+logging.getLogger("requests").setLevel(logging.WARNING)
+logging.getLogger("enzyme").setLevel(logging.WARNING)
+logging.getLogger("qtfaststart").setLevel(logging.CRITICAL)
+logging.getLogger("rebulk").setLevel(logging.WARNING)
+
+
+class SMADaemon:
+    """
+    Keeps MediaProcessors warm and runs jobs submitted by the downloader
+    hooks. Jobs are stored in a durable JobQueue so they survive restarts,
+    and concurrency is limited per job class using the [Batch] settings so
+    simultaneous hooks don't compete for the same resources. Conversions
+    are probed when submitted and only claimed once a worker of their class
+    is free, other methods run on a small separate pool.
+    """
+    IDLE_WAIT = 30
+    RETRYABLE_METHODS = ['fullprocess', 'process']
+    LIGHT = 'light'
+    LIGHT_WORKERS = 2
+
+    def __init__(self, settings, queue, logger=None):
+        self.log = logger or logging.getLogger(__name__)
+        self.settings = settings
+        self.queue = queue
+        self.scheduler = JobScheduler(settings.batch_jobs, settings.batch_remux_jobs, settings.batch_device_jobs, logger=self.log)
+        self.executors = self.scheduler.executors('sma-daemon')
+        self.executors[self.LIGHT] = ThreadPoolExecutor(max_workers=self.LIGHT_WORKERS, thread_name_prefix='sma-daemon-light')
+        self.slots = {queue: threading.BoundedSemaphore(self.scheduler.limits.get(queue) or self.LIGHT_WORKERS) for queue in self.executors}
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.condition = threading.Condition()
+        self.progress = {}
+        self._local = threading.local()
+
+    # One MediaProcessor per worker thread for each ffmpeg build in use, reused between jobs
+    def getMediaProcessor(self, settings):
+        processors = getattr(self._local, 'processors', None)
+        if processors is None:
+            processors = self._local.processors = {}
+        key = (settings.ffmpeg, settings.ffprobe, settings.cache_dir)
+        mp = processors.get(key)
+        if not mp:
+            mp = processors[key] = MediaProcessor(settings, logger=self.log)
+            mp.scheduler = self.scheduler
+        mp.settings = settings
+        mp.deletesubs = set()
+        return mp
+
+    # Only accept whitelisted overrides, binaries and scripts are never taken from a request
+    def filterSettings(self, snapshot, inputfile=None):
+        overrides = {k: v for k, v in (snapshot or {}).items() if k in OVERRIDABLE_SETTINGS}
+        output_dir = overrides.get('output_dir')
+        if output_dir is not None and not self.allowedOutputDirectory(output_dir, inputfile):
+            raise ValueError("Output directory %s is not an output directory configured for the daemon, add it to output-directories in [Daemon]." % output_dir)
+        return overrides
+
+    # Output directories the hooks are configured with
+    def outputDirectories(self):
+        directories = [self.settings.output_dir, self.settings.SAB['output-dir'], self.settings.deluge['output-dir'], self.settings.qBittorrent['output-dir'], self.settings.uTorrent['output-dir']]
+        return [x for x in directories + self.settings.Daemon['output-directories'] if x]
+
+    # Hooks place output inside a configured output directory or in a directory next to the download being processed
+    def allowedOutputDirectory(self, path, inputfile=None):
+        if not isinstance(path, str):
+            return False
+        path = os.path.realpath(path)
+        for root in self.outputDirectories():
+            root = os.path.realpath(root)
+            if path == root or path.startswith(root + os.sep):
+                return True
+        if isinstance(inputfile, str):
+            parent = os.path.dirname(path)
+            if parent != os.path.dirname(parent) and os.path.realpath(inputfile).startswith(parent + os.sep):
+                return True
+        return False
+
+    def jobSettings(self, overrides):
+        settings = copy.copy(self.settings)
+        settings.__dict__.update({k: v for k, v in (overrides or {}).items() if k in OVERRIDABLE_SETTINGS})
+        return settings
+
+    @staticmethod
+    def decodeValue(value):
+        if isinstance(value, dict) and value.get('__enum__') == 'MediaType':
+            return MediaType(value['value'])
+        return value
+
+    @staticmethod
+    def encodeResult(result):
+        if hasattr(result, 'json'):
+            try:
+                return result.json
+            except:
+                return True
+        return result
+
+    def start(self):
+        recovered = self.queue.recover()
+        if recovered:
+            self.log.info("Recovered %d interrupted job(s)." % recovered)
+        threading.Thread(target=self.dispatch, name="dispatcher", daemon=True).start()
+
+    def stop(self):
+        self.stopping.set()
+        self.wakeup.set()
+        # Claimed jobs that haven't started are put back in the queue by recover on the next start
+        for executor in self.executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, payload):
+        if payload.get('method') not in REMOTE_METHODS:
+            raise ValueError("Unsupported method %s" % payload.get('method'))
+        args = payload.get('args') or []
+        kwargs = payload.get('kwargs') or {}
+        inputfile = args[0] if args else kwargs.get('inputfile')
+        settings = self.filterSettings(payload.get('settings'), inputfile)
+        jobclass = self.classify(payload['method'], inputfile, settings)
+        jobid = self.queue.add(payload['method'], args, kwargs, settings, jobclass)
+        self.log.info("Queued %s job %d with %s jobs." % (payload['method'], jobid, jobclass))
+        self.wakeup.set()
+        return self.jobJson(self.queue.get(jobid))
+
+    # Probe conversions on the submitting request's thread so the dispatcher knows which workers a job needs
+    def classify(self, method, inputfile, settings):
+        if method not in self.RETRYABLE_METHODS:
+            return self.LIGHT
+        try:
+            mp = self.getMediaProcessor(self.jobSettings(settings))
+            info = mp.isValidSource(inputfile)
+            jobclass = mp.predictJobClass(info) if info else JobClass.CPU
+        except KeyboardInterrupt:
+            raise
+        except:
+            self.log.exception("Unable to classify job for %s, queueing as CPU bound." % inputfile)
+            jobclass = JobClass.CPU
+        return self.scheduler.queue(jobclass)
+
+    def queueFor(self, job):
+        if job['jobclass'] == self.LIGHT:
+            return self.LIGHT
+        return self.scheduler.queue(job['jobclass'] or JobClass.CPU)
+
+    # Job classes that are waited on by the given worker pools
+    def claimable(self, queues):
+        classes = [c for c in [JobClass.CPU, JobClass.IO, JobClass.DEVICE] if self.scheduler.queue(c) in queues]
+        if self.LIGHT in queues:
+            classes.append(self.LIGHT)
+        return classes
+
+    # Only claim a due job once a worker of its class is free so waiting jobs stay queued
+    def dispatch(self):
+        while not self.stopping.is_set():
+            free = [queue for queue, slot in self.slots.items() if slot.acquire(blocking=False)]
+            job = None
+            if free:
+                try:
+                    job = self.queue.claim(self.claimable(free), JobClass.CPU)
+                except:
+                    self.log.exception("Unable to claim job from queue.")
+            queue = self.queueFor(job) if job else None
+            for q in free:
+                if q != queue:
+                    self.slots[q].release()
+            if job:
+                try:
+                    self.executors[queue].submit(self.run, job)
+                except RuntimeError:
+                    # Shutting down, recover puts the job back in the queue
+                    self.slots[queue].release()
+                continue
+            due = self.queue.nextDue(self.claimable(free), JobClass.CPU) if free else None
+            self.wakeup.wait(min(due, self.IDLE_WAIT) if due is not None else self.IDLE_WAIT)
+            self.wakeup.clear()
+
+    def run(self, job):
+        jobid = job['id']
+        mp = None
+        try:
+            job['attempts'] = self.queue.start(jobid)
+            self.log.info("Running %s job %d attempt %d for %s." % (job['method'], jobid, job['attempts'], job['input']))
+            mp = self.getMediaProcessor(self.jobSettings(job['settings']))
+            mp.journal = lambda **fields: self.queue.journal(jobid, **fields)
+            args = [self.decodeValue(x) for x in job['args'] or []]
+            kwargs = {k: self.decodeValue(v) for k, v in (job['kwargs'] or {}).items()}
+            if kwargs.get('reportProgress'):
+                kwargs['progressOutput'] = lambda timecode, debug: self.updateProgress(jobid, timecode, debug)
+            result = getattr(mp, job['method'])(*args, **kwargs)
+            # No result means the file was skipped, same as with a local MediaProcessor, only exceptions are retried
+            result = json.loads(json.dumps(self.encodeResult(result), default=str))
+            self.queue.complete(jobid, result, mp.settings.output_dir)
+            state = 'done'
+        except KeyboardInterrupt:
+            raise
+        except Exception as e:
+            self.log.exception("Error running %s job %d." % (job['method'], jobid))
+            state = self.queue.fail(jobid, str(e))
+        finally:
+            if mp:
+                mp.journal = None
+            self.progress.pop(jobid, None)
+            self.slots[self.queueFor(job)].release()
+            self.wakeup.set()
+            with self.condition:
+                self.condition.notify_all()
+        self.log.info("Finished %s job %d [%s]." % (job['method'], jobid, state))
+
+    def updateProgress(self, jobid, timecode, debug):
+        self.progress[jobid] = (timecode, debug)
+
+    def jobJson(self, job):
+        progress, debug = self.progress.get(job['id'], (None, None))
+        return {'id': job['id'],
+                'method': job['method'],
+                'input': job['input'],
+                'state': job['state'],
+                'attempts': job['attempts'],
+                'result': job['result'],
+                'output_dir': job['output_dir'],
+                'error': job['error'],
+                'progress': progress,
+                'debug': debug,
+                'created': job['created'],
+                'finished': job['finished']}
+
+    def wait(self, jobid, timeout):
+        try:
+            jobid = int(jobid)
+        except ValueError:
+            return None
+        deadline = time.time() + (timeout or 0)
+        with self.condition:
+            job = self.queue.get(jobid)
+            while job and job['state'] not in ['done', 'failed'] and time.time() < deadline:
+                self.condition.wait(deadline - time.time())
+                job = self.queue.get(jobid)
+        return self.jobJson(job) if job else None
+
+    def status(self):
+        return {'jobs': self.queue.counts()}
+
+
+class DaemonRequestHandler(BaseHTTPRequestHandler):
+    server_version = "SMADaemon"
+
+    def log_message(self, format, *args):
+        log.debug("%s - %s" % (self.address_string(), format % args))
+
+    def respond(self, code, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def authorized(self):
+        apikey = self.server.sma.settings.Daemon.get('apikey')
+        if not apikey or self.headers.get('X-Api-Key') != apikey:
+            self.respond(401, {'error': 'Invalid API key'})
+            return False
+        return True
+
+    def do_GET(self):
+        if not self.authorized():
+            return
+        url = urlparse(self.path)
+        parts = [x for x in url.path.split('/') if x]
+        if parts == ['status']:
+            self.respond(200, self.server.sma.status())
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            try:
+                timeout = float(parse_qs(url.query).get('wait', [0])[0])
+            except ValueError:
+                timeout = 0
+            job = self.server.sma.wait(parts[1], timeout)
+            if job:
+                self.respond(200, job)
+            else:
+                self.respond(404, {'error': 'Job not found'})
+        else:
+            self.respond(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if not self.authorized():
+            return
+        if urlparse(self.path).path.strip('/') != 'jobs':
+            self.respond(404, {'error': 'Not found'})
+            return
+        # Browsers can send cross site text/plain posts without a preflight, only accept JSON
+        if self.headers.get('Content-Type', '').split(';')[0].strip().lower() != 'application/json':
+            self.respond(415, {'error': 'Content-Type must be application/json'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            payload = json.loads(self.rfile.read(length).decode('utf-8'))
+            job = self.server.sma.submit(payload)
+        except (ValueError, KeyError) as e:
+            self.respond(400, {'error': str(e)})
+            return
+        self.respond(202, job)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Long running job daemon for sickbeard_mp4_automator, serves jobs submitted by the post processing hooks")
+    parser.add_argument('-c', '--config', help='Specify an alternate configuration file location')
+    parser.add_argument('--host', help='Override the address the daemon listens on')
+    parser.add_argument('-p', '--port', type=int, help='Override the port the daemon listens on')
+    args = vars(parser.parse_args())
+
+    settings = ReadSettings(args['config'], logger=log) if args['config'] else ReadSettings(logger=log)
+    host = args['host'] or settings.Daemon['host']
+    if not settings.Daemon['apikey']:
+        log.error("No apikey set in [Daemon], refusing to start. Set the same apikey in the configuration used by the hooks.")
+        sys.exit(1)
+    port = args['port'] or settings.Daemon['port']
+
+    database = settings.Daemon['database'] or os.path.join(os.path.dirname(settings._configFile), 'jobs.db')
+    queue = JobQueue(database, max_attempts=settings.Daemon['max-attempts'], logger=log)
+    log.info("Using job database %s." % database)
+
+    server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+    server.sma = SMADaemon(settings, queue, logger=log)
+    server.sma.start()
+    log.info("SMA daemon listening on %s:%d." % (host, port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        log.info("SMA daemon shutting down.")
+    finally:
+        server.server_close()
+        server.sma.stop()
+
+
+if __name__ == '__main__':
+    main()
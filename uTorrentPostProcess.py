@@ -5,7 +5,7 @@ import shutil
 from autoprocess import autoProcessTV, autoProcessTVSR, sonarr, radarr
 from resources.log import getLogger
 from resources.readsettings import ReadSettings
-from resources.mediaprocessor import MediaProcessor
+from resources.daemon import getMediaProcessor
 
 log = getLogger("uTorrentPostProcess")
 
@@ -143,7 +143,7 @@ try:
                 except:
                     log.exception("Error creating output sub directory.")
 
-        mp = MediaProcessor(settings)
+        mp = getMediaProcessor(settings)
 
         if kind == 'single':
             inputfile = os.path.join(path, filename)